@@ -0,0 +1,1009 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: aioprotocol.py
+Description: the asyncio email protocol wrapper, implement SMTP / POP3 / IMAP
+    on asyncio streams, used by "EmailBot.run_async()"
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import asyncio
+import base64
+import re
+import ssl as ssllib
+import time
+
+import config
+import metrics
+import mime
+import protocol
+from utils import logger
+
+# the seconds of waiting server response
+TIMEOUT = 60
+# the max line length of server response
+LINE_LIMIT = 1024 * 1024
+
+#**********************************************************************
+# @Class: SMTPReplyError
+# @Description: the SMTP server replies an unexpected code, the refused is
+#   the {address: (code, message)} dict when all the recipients are refused
+#**********************************************************************
+class SMTPReplyError(Exception):
+    def __init__(self, code, message, refused=None):
+        super().__init__("smtp reply %d %s" % (code, message))
+        self.code = code
+        self.refused = refused or {}
+# end class
+
+#**********************************************************************
+# @Class: Stream
+# @Description: the connected asyncio stream, wrapper reader and writer
+#**********************************************************************
+class Stream:
+    #**********************************************************************
+    # @Function: __init__(self, reader, writer)
+    # @Description: Stream object initialize
+    # @Parameter: reader, the asyncio.StreamReader object
+    # @Parameter: writer, the asyncio.StreamWriter object
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # the smtp server supports PIPELINING, set by "AsyncSMTP"
+        self.pipelining = False
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: open(address, port, ssl)
+    # @Description: connect the server, and create Stream object
+    # @Parameter: address, the server address
+    # @Parameter: port, the server port
+    # @Parameter: ssl, ssl is required to connect to the server
+    # @Return: stream, the Stream object
+    #**********************************************************************
+    @staticmethod
+    async def open(address, port, ssl):
+        context = ssllib.create_default_context() if ssl else None
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            address, port, ssl=context, limit=LINE_LIMIT), TIMEOUT)
+        return Stream(reader, writer)
+    # end open()
+
+    #**********************************************************************
+    # @Function: readline(self, timeout=TIMEOUT)
+    # @Description: read a line from server
+    # @Parameter: timeout=TIMEOUT, the max waiting seconds, None is forever
+    # @Return: line, the line bytes include "\r\n"
+    #**********************************************************************
+    async def readline(self, timeout=TIMEOUT):
+        line = await asyncio.wait_for(self.reader.readline(), timeout)
+        if not line:
+            raise ConnectionError("connection closed by server")
+        return line
+    # end readline()
+
+    #**********************************************************************
+    # @Function: readexactly(self, size)
+    # @Description: read the specified size bytes from server
+    # @Parameter: size, the bytes size
+    # @Return: data, the bytes
+    #**********************************************************************
+    async def readexactly(self, size):
+        return await asyncio.wait_for(self.reader.readexactly(size), TIMEOUT)
+    # end readexactly()
+
+    #**********************************************************************
+    # @Function: send(self, data)
+    # @Description: send data to server, wait until it's flushed
+    # @Parameter: data, the bytes
+    # @Return: None
+    #**********************************************************************
+    async def send(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), TIMEOUT)
+    # end send()
+
+    #**********************************************************************
+    # @Function: close(self)
+    # @Description: close the connection
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def close(self):
+        self.writer.close()
+    # end close()
+# end class
+
+#**********************************************************************
+# @Class: AsyncSMTP
+# @Description: the asyncio version of "protocol.SMTP", the authed sessions
+#   are pooled, and the concurrent sending sessions are limited by
+#   "SMTP_POOL_SIZE"
+#**********************************************************************
+class AsyncSMTP:
+    #**********************************************************************
+    # @Function: __init__(self, address, port, ssl, user, passwd)
+    # @Description: AsyncSMTP object initialize
+    # @Parameter: address, the SMTP server address
+    # @Parameter: port, the SMTP server port
+    # @Parameter: ssl, ssl is required to connect to the SMTP
+    # @Parameter: username, the mailbox username
+    # @Parameter: password, the mailbox password
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, address, port, ssl, user, passwd):
+        self.address = address
+        self.port    = port
+        self.ssl     = ssl
+        self.user    = user
+        self.passwd  = passwd
+
+        # the idle session pool, each item is [stream, create_time, last_used_time]
+        self._pool = []
+        # created in the running event loop by "send()"
+        self._limit = None
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _reply(self, stream)
+    # @Description: read the SMTP reply, include multiline reply
+    # @Parameter: stream, the connected Stream object
+    # @Return: (code, lines), the reply code and text lines
+    #**********************************************************************
+    async def _reply(self, stream):
+        lines = []
+        while True:
+            line = await stream.readline()
+            lines.append(line[4:].strip())
+            # the last line is "250 xxx", others are "250-xxx"
+            if line[3:4] != b"-":
+                break
+        # end while
+        return int(line[:3]), lines
+    # end _reply()
+
+    #**********************************************************************
+    # @Function: _command(self, stream, cmd, expect)
+    # @Description: send SMTP command and check the reply code
+    # @Parameter: stream, the connected Stream object
+    # @Parameter: cmd, the command string
+    # @Parameter: expect, the expected reply code tuple
+    # @Return: (code, lines), the reply code and text lines
+    #**********************************************************************
+    async def _command(self, stream, cmd, expect):
+        await stream.send(cmd.encode("utf-8") + b"\r\n")
+        code, lines = await self._reply(stream)
+        if code not in expect:
+            raise SMTPReplyError(code, b" ".join(lines))
+        return code, lines
+    # end _command()
+
+    #**********************************************************************
+    # @Function: _login_server(self)
+    # @Description: connect and login in SMTP server, auth by PLAIN or LOGIN
+    # @Parameter: None
+    # @Return: (status, stream), the connectd Stream object
+    #**********************************************************************
+    async def _login_server(self):
+        stream = None
+        try:
+            stream = await Stream.open(self.address, self.port, self.ssl)
+            code, _ = await self._reply(stream)
+            if code != 220:
+                raise SMTPReplyError(code, b"greeting")
+            _, lines = await self._command(stream, "EHLO emailbot", (250,))
+            features = b" ".join(lines[1:]).upper()
+            stream.pipelining = b"PIPELINING" in features
+
+            if b"PLAIN" in features:
+                token = ("\0%s\0%s" % (self.user, self.passwd)).encode("utf-8")
+                await self._command(stream, "AUTH PLAIN " +
+                    base64.b64encode(token).decode("ascii"), (235,))
+            else:
+                await self._command(stream, "AUTH LOGIN", (334,))
+                await self._command(stream, base64.b64encode(
+                    self.user.encode("utf-8")).decode("ascii"), (334,))
+                await self._command(stream, base64.b64encode(
+                    self.passwd.encode("utf-8")).decode("ascii"), (235,))
+            # end if-else
+        except Exception as e:
+            logger.error(e)
+            if stream != None:
+                stream.close()
+            return False, None
+
+        return True, stream
+    # end _login_server()
+
+    #**********************************************************************
+    # @Function: _acquire(self)
+    # @Description: get an authed session from the pool, the session exceeds
+    #   max-age or idle time is closed; if there is no available session, login
+    #   a new one. (the dead session is detected by sending, then reconnect)
+    # @Parameter: None
+    # @Return: (status, stream, created), the Stream object and its create time
+    #**********************************************************************
+    async def _acquire(self):
+        while len(self._pool) > 0:
+            stream, created, used = self._pool.pop()
+            now = time.time()
+            if (now - created > config.SMTP_POOL_MAXAGE or
+                now - used > config.SMTP_POOL_IDLE):
+                stream.close()
+                continue
+            return True, stream, created
+        # end while
+
+        status, stream = await self._login_server()
+        return status, stream, time.time()
+    # end _acquire()
+
+    #**********************************************************************
+    # @Function: _sendmail(self, stream, email, reset)
+    # @Description: send the email by one transaction, when the server supports
+    #   PIPELINING, the "RSET/MAIL/RCPT/DATA" commands are sent by one write.
+    #   all the replies are read before checking, so the session is still in
+    #   sync on failure; it fails only if all recipients are refused. the
+    #   envelope is quoted and checked by "protocol.envelope()"
+    # @Parameter: stream, the connected Stream object
+    # @Parameter: email, the mime email object
+    # @Parameter: reset, reset the session by RSET before the transaction
+    # @Return: refused, the refused recipients dict {address: (code, message)},
+    #   raise SMTPReplyError when the server refuses the email
+    #**********************************************************************
+    async def _sendmail(self, stream, email, reset):
+        sender, recipients, invalid = protocol.envelope(email)
+        if sender == None:
+            raise SMTPReplyError(553, b"invalid address")
+        if len(recipients) == 0:
+            raise SMTPReplyError(553, b"no valid recipient")
+        cmds = ["RSET"] if reset else []
+        cmds.append("MAIL FROM:%s" % sender)
+        cmds += ["RCPT TO:%s" % quoted for _, quoted in recipients]
+        cmds.append("DATA")
+
+        replies = []
+        if stream.pipelining:
+            await stream.send(("\r\n".join(cmds) + "\r\n").encode("utf-8"))
+            for _ in cmds:
+                replies.append(await self._reply(stream))
+        else:
+            for cmd in cmds:
+                await stream.send(cmd.encode("utf-8") + b"\r\n")
+                replies.append(await self._reply(stream))
+        # end if-else
+        if reset:
+            replies.pop(0)
+
+        mail, data = replies[0], replies[-1]
+        refused = {}
+        for (addr, _), (code, lines) in zip(recipients, replies[1:-1]):
+            if code != 250 and code != 251:
+                refused[addr] = (code, b" ".join(lines))
+        # end for
+        failed = mail[0] != 250 or len(refused) == len(recipients)
+        if data[0] == 354 and failed:
+            # the server accepts DATA anyway, end it with an empty email
+            await stream.send(b".\r\n")
+            await self._reply(stream)
+        # end if
+        if mail[0] != 250:
+            raise SMTPReplyError(mail[0], b" ".join(mail[1]))
+        if failed and len(refused) > 0:
+            code, message = next(iter(refused.values()))
+            raise SMTPReplyError(code, message, dict(refused, **invalid))
+        if failed or data[0] != 354:
+            raise SMTPReplyError(data[0], b" ".join(data[1]))
+
+        for chunk in email.data():
+            await stream.send(chunk)
+        code, lines = await self._reply(stream)
+        if code != 250:
+            raise SMTPReplyError(code, b" ".join(lines))
+        refused.update(invalid)
+        return refused
+    # end _sendmail()
+
+    #**********************************************************************
+    # @Function: send(self, email)
+    # @Description: send email through SMTP server, the session is taken from
+    #   the pool, when the pooled session is disconnected, we will reconnect
+    #   and send again transparently
+    # @Parameter: email, the mime email object
+    # @Return: status, return True when email send success
+    #**********************************************************************
+    async def send(self, email):
+        return (await self.send_batch([email]))[0][0] == 250
+    # end send()
+
+    #**********************************************************************
+    # @Function: send_batch(self, emails)
+    # @Description: the asyncio version of "SMTP.send_batch()", send the
+    #   emails over one pooled session in order
+    # @Parameter: emails, the mime email object list
+    # @Return: list, the (code, refused) of each email, see "SMTP.send_batch()"
+    #**********************************************************************
+    async def send_batch(self, emails):
+        if self._limit == None:
+            self._limit = asyncio.Semaphore(config.SMTP_POOL_SIZE)
+
+        results = [(0, {})] * len(emails)
+        async with self._limit:
+            i, retries = 0, 0
+            while i < len(emails) and retries < 2:
+                status, stream, created = await self._acquire()
+                if status == False:
+                    break
+
+                reset = False
+                try:
+                    while i < len(emails):
+                        try:
+                            refused = await self._sendmail(stream, emails[i], reset)
+                            results[i] = (250, {a: r[0] for a, r in refused.items()})
+                            retries = 0
+                        except SMTPReplyError as e:
+                            # the session is still alive, reset it by the next one
+                            logger.error(e)
+                            results[i] = (e.code, {a: r[0] for a, r in e.refused.items()})
+                        # RSET costs a round trip without PIPELINING, so it's
+                        # only sent after the failed transaction
+                        reset = results[i][0] != 250 or stream.pipelining
+                        i += 1
+                    # end while
+                except (OSError, asyncio.IncompleteReadError,
+                        asyncio.TimeoutError) as e:
+                    # the pooled session may be closed by server
+                    logger.warning("smtp session disconnected, reconnect (%s)" % e)
+                    stream.close()
+                    retries += 1
+                    continue
+                except Exception as e:
+                    # such as the attachment is unreadable in DATA, the session
+                    # is out of sync, and the email is failed
+                    logger.error(e)
+                    stream.close()
+                    i += 1
+                    continue
+
+                # reset the failed transaction before reuse the session
+                if i > 0 and results[i-1][0] != 250:
+                    try:
+                        await self._command(stream, "RSET", (250,))
+                    except Exception:
+                        stream.close()
+                        continue
+                self._release(stream, created)
+            # end while
+        return results
+    # end send_batch()
+
+    #**********************************************************************
+    # @Function: _release(self, stream, created)
+    # @Description: put the session back to the pool
+    # @Parameter: stream, the connected Stream object
+    # @Parameter: created, the session create time
+    # @Return: None
+    #**********************************************************************
+    def _release(self, stream, created):
+        self._pool.append([stream, created, time.time()])
+        while len(self._pool) > config.SMTP_POOL_SIZE:
+            self._pool.pop(0)[0].close()
+    # end _release()
+
+    #**********************************************************************
+    # @Function: close(self)
+    # @Description: close all the sessions in the pool
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def close(self):
+        for item in self._pool:
+            item[0].close()
+        self._pool = []
+    # end close()
+# end class
+
+#**********************************************************************
+# @Class: AsyncPOP3
+# @Description: the asyncio version of "protocol.POP3", the commands are
+#   executed over "AsyncPOP3Session"
+#**********************************************************************
+class AsyncPOP3:
+    #**********************************************************************
+    # @Function: __init__(self, address, port, ssl, user, passwd)
+    # @Description: AsyncPOP3 object initialize
+    # @Parameter: address, the POP3 server address
+    # @Parameter: port, the POP3 server port
+    # @Parameter: ssl, ssl is required to connect to the POP3
+    # @Parameter: username, the mailbox username
+    # @Parameter: password, the mailbox password
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, address, port, ssl, user, passwd):
+        self.address = address
+        self.port    = port
+        self.ssl     = ssl
+        self.user    = user
+        self.passwd  = passwd
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: session(self)
+    # @Description: create a POP3 session, using as async context manager:
+    #     async with pop3.session() as s:
+    #         lines = await s.uidl()
+    # @Parameter: None
+    # @Return: session, the AsyncPOP3Session object
+    #**********************************************************************
+    def session(self):
+        return AsyncPOP3Session(self)
+    # end session()
+# end class
+
+#**********************************************************************
+# @Class: AsyncPOP3Session
+# @Description: the asyncio version of "protocol.POP3Session", login once
+#   and execute multiple commands over the same connection
+#**********************************************************************
+class AsyncPOP3Session:
+    #**********************************************************************
+    # @Function: __init__(self, pop3)
+    # @Description: AsyncPOP3Session object initialize
+    # @Parameter: pop3, the AsyncPOP3 object which provide server and user/pass
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, pop3):
+        self.pop3 = pop3
+
+        # set value by "__aenter__()"
+        self.status = False
+        self.stream = None
+        # the server supports "TOP" or not, None until the first "TOP" is
+        # replied; it's disabled only if the first one fails, the later
+        # "-ERR" means the message is deleted during polling
+        self.top_supported = None
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _command(self, cmd)
+    # @Description: send POP3 command and check the "+OK" response
+    # @Parameter: cmd, the command string
+    # @Return: resp, the response line
+    #**********************************************************************
+    async def _command(self, cmd):
+        await self.stream.send(cmd.encode("utf-8") + b"\r\n")
+        resp = await self.stream.readline()
+        if not resp.startswith(b"+OK"):
+            raise ValueError("pop3 '%s' response %s" % (cmd.split(" ")[0], resp.strip()))
+        return resp
+    # end _command()
+
+    #**********************************************************************
+    # @Function: _multiline(self)
+    # @Description: read the multi-line response which end with ".", and
+    #   remove the dot-stuffing
+    # @Parameter: None
+    # @Return: lines, the line list without "\r\n"
+    #**********************************************************************
+    async def _multiline(self):
+        lines = []
+        while True:
+            line = (await self.stream.readline()).rstrip(b"\r\n")
+            if line == b".":
+                break
+            if line.startswith(b".."):
+                line = line[1:]
+            lines.append(line)
+        # end while
+        return lines
+    # end _multiline()
+
+    #**********************************************************************
+    # @Function: __aenter__(self)
+    # @Description: connect and login in POP3 server
+    # @Parameter: None
+    # @Return: session, the AsyncPOP3Session object itself
+    #**********************************************************************
+    async def __aenter__(self):
+        try:
+            self.stream = await Stream.open(self.pop3.address, self.pop3.port, self.pop3.ssl)
+            resp = await self.stream.readline()
+            if not resp.startswith(b"+OK"):
+                raise ValueError("pop3 greeting %s" % resp.strip())
+            await self._command("USER %s" % self.pop3.user)
+            await self._command("PASS %s" % self.pop3.passwd)
+        except Exception as e:
+            self._broken(e)
+            return self
+
+        self.status = True
+        return self
+    # end __aenter__()
+
+    #**********************************************************************
+    # @Function: __aexit__(self, exc_type, exc_value, traceback)
+    # @Description: quit the POP3 session
+    # @Parameter: exc_type, exc_value, traceback, the exception information
+    # @Return: False, don't suppress the exception
+    #**********************************************************************
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.status:
+            try:
+                await self._command("QUIT")
+            except Exception as e:
+                logger.error(e)
+            self.stream.close()
+        self.status = False
+        self.stream = None
+        return False
+    # end __aexit__()
+
+    #**********************************************************************
+    # @Function: _broken(self, e)
+    # @Description: the command fails, close the connection and set session
+    #   broken, the POP3 server state is unknown after error
+    # @Parameter: e, the exception
+    # @Return: None
+    #**********************************************************************
+    def _broken(self, e):
+        logger.error(e)
+        if self.stream != None:
+            self.stream.close()
+        self.status = False
+        self.stream = None
+    # end _broken()
+
+    #**********************************************************************
+    # @Function: uidl(self)
+    # @Description: get all message hash
+    # @Parameter: None
+    # @Return: result, the email hash list, while error will return None
+    #   the single hash example: b'1 ZC3130-wi6DhoW5iDuIEDhYOkraUbh'
+    #**********************************************************************
+    async def uidl(self):
+        if self.status == False:
+            return None
+
+        try:
+            await self._command("UIDL")
+            return await self._multiline()
+        except Exception as e:
+            self._broken(e)
+            return None
+    # end uidl()
+
+    #**********************************************************************
+    # @Function: recv(self, which)
+    # @Description: get the email content of the specified id, the original
+    #   content of the received email is parsed through MIME.
+    # @Parameter: which, the email id
+    # @Return: email, our internal warpper Email object
+    #**********************************************************************
+    async def recv(self, which):
+        if self.status == False:
+            return None
+
+        try:
+            await self._command("RETR %d" % which)
+        except ValueError as e:
+            # the server reply "-ERR", the session is still available
+            logger.warning(e)
+            return None
+        except Exception as e:
+            self._broken(e)
+            return None
+
+        # read the multi-line response until ".", and remove dot-stuffing
+        lines = []
+        try:
+            while True:
+                line = await self.stream.readline()
+                if line.rstrip(b"\r\n") == b".":
+                    break
+                if line.startswith(b".."):
+                    line = line[1:]
+                lines.append(line)
+            # end while
+        except Exception as e:
+            self._broken(e)
+            return None
+
+        # the raw bytes are handed to MIME, the body is parsed on first access
+        source = b"".join(lines)
+        metrics.RECV_EMAILS.inc(1, "pop3")
+        metrics.RECV_BYTES.inc(len(source), "pop3")
+        return mime.Email(source=source)
+    # end recv()
+
+    #**********************************************************************
+    # @Function: top(self, which)
+    # @Description: get the email headers of the specified id by "TOP n 0"
+    # @Parameter: which, the email id
+    # @Return: email, the Email object with headers only, while error or the
+    #   server doesn't support "TOP" will return None
+    #**********************************************************************
+    async def top(self, which):
+        if self.status == False or self.top_supported == False:
+            return None
+
+        try:
+            await self._command("TOP %d 0" % which)
+        except ValueError as e:
+            # the server reply "-ERR" to the first "TOP", use "RETR" in this
+            # session; the later one means the message is deleted
+            if self.top_supported == None:
+                logger.warning("%s, use RETR instead" % e)
+                self.top_supported = False
+            else:
+                logger.warning("pop3 TOP %d: %s" % (which, e))
+            return None
+        except Exception as e:
+            self._broken(e)
+            return None
+
+        try:
+            lines = await self._multiline()
+        except Exception as e:
+            self._broken(e)
+            return None
+
+        self.top_supported = True
+        return mime.Email(source=b"\r\n".join(lines))
+    # end top()
+# end class
+
+# the IMAP literal at the end of line, eg: b'* 1 FETCH (UID 5 BODY[] {128}\r\n'
+_LITERAL = re.compile(rb"\{(\d+)\}\r\n$")
+
+#**********************************************************************
+# @Class: AsyncIMAP
+# @Description: the asyncio version of "protocol.IMAP", keep one long-lived
+#   connection to the mailbox, and wait for new emails by IDLE
+#**********************************************************************
+class AsyncIMAP:
+    #**********************************************************************
+    # @Function: __init__(self, address, port, ssl, user, passwd, mailbox="INBOX")
+    # @Description: AsyncIMAP object initialize
+    # @Parameter: address, the IMAP server address
+    # @Parameter: port, the IMAP server port
+    # @Parameter: ssl, ssl is required to connect to the IMAP
+    # @Parameter: username, the mailbox username
+    # @Parameter: password, the mailbox password
+    # @Parameter: mailbox="INBOX", the selected mailbox
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, address, port, ssl, user, passwd, mailbox="INBOX"):
+        self.address = address
+        self.port    = port
+        self.ssl     = ssl
+        self.user    = user
+        self.passwd  = passwd
+        self.mailbox = mailbox
+
+        # the long-lived connection, set by "connect()"
+        self.stream    = None
+        self.idle      = False
+        self.condstore = False
+        self._tag      = 0
+        # the mailbox status, updated by the untagged responses, see
+        # "_untagged()"
+        self.uidvalidity = 0
+        self.uidnext     = 0
+        self.modseq      = 0
+        self.changed     = False
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _quote(self, s)
+    # @Description: quote the IMAP string argument
+    # @Parameter: s, the string
+    # @Return: str, the quoted string
+    #**********************************************************************
+    def _quote(self, s):
+        return '"%s"' % s.replace("\\", "\\\\").replace('"', '\\"')
+    # end _quote()
+
+    #**********************************************************************
+    # @Function: _response(self, tag)
+    # @Description: read the responses until the tagged response, the literal
+    #   data is read as the part of the untagged response
+    # @Parameter: tag, the command tag bytes, b"" means read a single response
+    # @Return: (typ, untagged), the tagged result like "OK" and the untagged
+    #   response list, each item is (line, [literal, ...])
+    #**********************************************************************
+    async def _response(self, tag):
+        untagged = []
+        while True:
+            line = await self.stream.readline()
+            if tag != b"" and line.startswith(tag + b" "):
+                typ = line[len(tag)+1:].split(b" ", 1)[0]
+                return typ.strip().decode("utf-8"), untagged
+            # end if
+
+            literals = []
+            m = _LITERAL.search(line)
+            while m:
+                literals.append(await self.stream.readexactly(int(m.group(1))))
+                more = await self.stream.readline()
+                line += more
+                m = _LITERAL.search(more)
+            # end while
+            untagged.append((line, literals))
+            if tag == b"":
+                return "", untagged
+        # end while
+    # end _response()
+
+    #**********************************************************************
+    # @Function: _command(self, cmd)
+    # @Description: send IMAP command and wait the tagged response, the
+    #   untagged responses update the mailbox status
+    # @Parameter: cmd, the command string
+    # @Return: (typ, untagged), same as "_response()"
+    #**********************************************************************
+    async def _command(self, cmd):
+        self._tag += 1
+        tag = b"E%04d" % self._tag
+        await self.stream.send(tag + b" " + cmd.encode("utf-8") + b"\r\n")
+        typ, untagged = await self._response(tag)
+        self._untagged(protocol.untagged_responses(line for line, _ in untagged))
+        return typ, untagged
+    # end _command()
+
+    #**********************************************************************
+    # @Function: _untagged(self, responses)
+    # @Description: update the mailbox status by the untagged responses, same
+    #   as "protocol.IMAP._untagged()"
+    # @Parameter: responses, the dict returned by "protocol.untagged_responses()"
+    # @Return: None
+    #**********************************************************************
+    def _untagged(self, responses):
+        if "EXISTS" in responses or "RECENT" in responses:
+            self.changed = True
+            self.uidnext = 0
+            self.modseq  = 0
+        for name, attr in (("UIDVALIDITY", "uidvalidity"), ("UIDNEXT", "uidnext"),
+                           ("HIGHESTMODSEQ", "modseq")):
+            if name in responses:
+                setattr(self, attr, int(responses[name][-1]))
+        # end for
+    # end _untagged()
+
+    #**********************************************************************
+    # @Function: connect(self)
+    # @Description: connect and login the long-lived IMAP session, and select
+    #   the mailbox if it is not connected
+    # @Parameter: None
+    # @Return: status, return True when the session is ready
+    #**********************************************************************
+    async def connect(self):
+        if self.stream != None:
+            return True
+
+        try:
+            self.stream = await Stream.open(self.address, self.port, self.ssl)
+            await self.stream.readline()
+            typ, _ = await self._command("LOGIN %s %s" % (
+                self._quote(self.user), self._quote(self.passwd)))
+            if typ != "OK":
+                raise ValueError("imap login failed")
+            typ, untagged = await self._command("CAPABILITY")
+            caps = b" ".join(line for line, _ in untagged).upper().split()
+            # the status is reported by the responses of EXAMINE
+            self.uidvalidity = 0
+            self.uidnext     = 0
+            self.modseq      = 0
+            typ, untagged = await self._command("EXAMINE %s" % self._quote(self.mailbox))
+            if typ != "OK":
+                raise ValueError("imap select %s failed" % self.mailbox)
+        except Exception as e:
+            self._broken(e)
+            return False
+
+        self.idle = b"IDLE" in caps
+        self.condstore = b"CONDSTORE" in caps
+        # the emails may arrive while it's disconnected, so it needs sync
+        self.changed = True
+        return True
+    # end connect()
+
+    #**********************************************************************
+    # @Function: _broken(self, e)
+    # @Description: the command fails, close the connection, it will be
+    #   reconnected by "connect()"
+    # @Parameter: e, the exception
+    # @Return: None
+    #**********************************************************************
+    def _broken(self, e):
+        logger.error(e)
+        if self.stream != None:
+            self.stream.close()
+        self.stream = None
+    # end _broken()
+
+    #**********************************************************************
+    # @Function: close(self)
+    # @Description: logout the long-lived IMAP session
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    async def close(self):
+        if self.stream == None:
+            return
+        try:
+            await self._command("LOGOUT")
+        except Exception as e:
+            logger.error(e)
+        self.stream.close()
+        self.stream = None
+    # end close()
+
+    #**********************************************************************
+    # @Function: sync_status(self)
+    # @Description: get the mailbox sync status reported by EXAMINE and the
+    #   following untagged responses, same as "protocol.IMAP.sync_status()"
+    # @Parameter: None
+    # @Return: result, the dict like {"UIDVALIDITY": 1, "UIDNEXT": 5,
+    #   "HIGHESTMODSEQ": 9, "CHANGED": True}, the unknown item is 0, while it's
+    #   not connected will return None
+    #**********************************************************************
+    async def sync_status(self):
+        if self.stream == None:
+            return None
+        return {"UIDVALIDITY": self.uidvalidity, "UIDNEXT": self.uidnext,
+                "HIGHESTMODSEQ": self.modseq, "CHANGED": self.changed}
+    # end sync_status()
+
+    #**********************************************************************
+    # @Function: _search(self, criteria)
+    # @Description: execute UID SEARCH command
+    # @Parameter: criteria, the search criteria
+    # @Return: uids, the uid list, while error will return None
+    #**********************************************************************
+    async def _search(self, criteria):
+        if self.stream == None:
+            return None
+
+        try:
+            typ, untagged = await self._command("UID SEARCH %s" % criteria)
+        except Exception as e:
+            self._broken(e)
+            return None
+        if typ != "OK":
+            return None
+
+        uids = []
+        for line, _ in untagged:
+            if line.startswith(b"* SEARCH"):
+                uids += [int(u) for u in line[8:].split()]
+        # end for
+        return uids
+    # end _search()
+
+    #**********************************************************************
+    # @Function: last_uid(self)
+    # @Description: get the uid of the newest email in the mailbox
+    # @Parameter: None
+    # @Return: uid, the newest email uid (0 when mailbox is empty), while
+    #   error will return None
+    #**********************************************************************
+    async def last_uid(self):
+        if self.uidnext > 0:
+            return self.uidnext - 1
+        uids = await self._search("ALL")
+        if uids == None:
+            return None
+        return max(uids) if len(uids) > 0 else 0
+    # end last_uid()
+
+    #**********************************************************************
+    # @Function: search(self, last)
+    # @Description: search the emails which uid is greater than last uid
+    # @Parameter: last, the last processed email uid
+    # @Return: uids, the new email uid list in ascending order, while error
+    #   will return None
+    #**********************************************************************
+    async def search(self, last):
+        uids = await self._search("UID %d:*" % (last+1))
+        if uids == None:
+            return None
+        return sorted(u for u in uids if u > last)
+    # end search()
+
+    #**********************************************************************
+    # @Function: recv(self, uid)
+    # @Description: get the email content of the specified uid, the original
+    #   content of the received email is parsed through MIME.
+    # @Parameter: uid, the email uid
+    # @Return: email, our internal warpper Email object
+    #**********************************************************************
+    async def recv(self, uid):
+        if self.stream == None:
+            return None
+
+        try:
+            typ, untagged = await self._command("UID FETCH %d (BODY.PEEK[])" % uid)
+        except Exception as e:
+            self._broken(e)
+            return None
+        if typ != "OK":
+            return None
+
+        for line, literals in untagged:
+            if len(literals) > 0:
+                metrics.RECV_EMAILS.inc(1, "imap")
+                metrics.RECV_BYTES.inc(len(literals[0]), "imap")
+                return mime.Email(source=literals[0])
+        # end for
+        return None
+    # end recv()
+
+    #**********************************************************************
+    # @Function: wait(self, timeout)
+    # @Description: wait for the new email notification by IDLE, and fallback
+    #   to sleep and NOOP polling. it returns at once if the new emails have
+    #   been reported by the responses of the last commands
+    # @Parameter: timeout, the max waiting seconds
+    # @Return: status, return False when the connection is broken
+    #**********************************************************************
+    async def wait(self, timeout):
+        if self.stream == None:
+            return False
+        if self.changed:
+            return True
+
+        try:
+            if self.idle:
+                await self._idle(timeout)
+            else:
+                await asyncio.sleep(timeout)
+                await self._command("NOOP")
+        except Exception as e:
+            self._broken(e)
+            return False
+        return True
+    # end wait()
+
+    #**********************************************************************
+    # @Function: _idle(self, timeout)
+    # @Description: execute the IDLE command, return when the server pushes
+    #   "EXISTS"/"RECENT" or timeout, reference from rfc2177. the pushed
+    #   responses update the mailbox status
+    # @Parameter: timeout, the max waiting seconds
+    # @Return: notified, return True when new email arrives
+    #**********************************************************************
+    async def _idle(self, timeout):
+        self._tag += 1
+        tag = b"E%04d" % self._tag
+        await self.stream.send(tag + b" IDLE\r\n")
+        line = await self.stream.readline()
+        if not line.startswith(b"+"):
+            raise ValueError("IDLE failed: %s" % line)
+
+        # wait for the server push
+        deadline = time.time() + timeout
+        while not self.changed:
+            remain = deadline - time.time()
+            if remain <= 0:
+                break
+            try:
+                line = await self.stream.readline(timeout=remain)
+            except asyncio.TimeoutError:
+                break
+            self._untagged(protocol.untagged_responses([line]))
+        # end while
+
+        # terminate IDLE, and wait the tagged response
+        await self.stream.send(b"DONE\r\n")
+        typ, untagged = await self._response(tag)
+        self._untagged(protocol.untagged_responses(line for line, _ in untagged))
+        if typ != "OK":
+            raise ValueError("IDLE failed: %s" % typ)
+        return self.changed
+    # end _idle()
+# end class
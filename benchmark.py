@@ -0,0 +1,734 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: benchmark.py
+Description: the EmailBot micro benchmarks, measure the hot paths without
+    real mailbox, and the end to end benchmarks which drive EmailBot with the
+    in-process fake servers(see "fakeserver.py"),
+    usage: python3 benchmark.py [-h] [name ...]
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import argparse
+import contextlib
+import logging
+import time
+
+# patch import path
+import os
+import sys
+module_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(module_path)
+
+#**********************************************************************
+# @Function: timeit(func, repeat=5)
+# @Description: execute the function several times and get the best time
+# @Parameter: func, the function to be measured
+# @Parameter: repeat=5, the execute times
+# @Return: seconds, the best execute time
+#**********************************************************************
+def timeit(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        cost = time.perf_counter() - start
+        if best == None or cost < best:
+            best = cost
+    # end for
+    return best
+# end timeit()
+
+#**********************************************************************
+# @Function: percentile(values, p)
+# @Description: get the percentile by nearest rank
+# @Parameter: values, the number list
+# @Parameter: p, the percent, 0 ~ 100
+# @Return: number, 0 if values is empty
+#**********************************************************************
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))]
+# end percentile()
+
+#**********************************************************************
+# @Function: peak_rss()
+# @Description: get the peak resident set size of the process, it includes
+#   the in-process fake servers
+# @Parameter: None
+# @Return: MB, None if it's not supported(windows)
+#**********************************************************************
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # the unit is bytes on macOS, and KB on linux
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+# end peak_rss()
+
+#**********************************************************************
+# @Function: e2e(**configs)
+# @Description: the context of end to end benchmark, set the configures and
+#   mute the logger, they are restored at exit. the default servers are
+#   cleared, only the given fake servers are connected without ssl
+# @Parameter: configs, the {name: value} of config.py
+# @Return: None
+#**********************************************************************
+@contextlib.contextmanager
+def e2e(**configs):
+    import config
+    from utils import logger
+    configs = dict(SMTP_SERVER="", SMTP_SSL=False, POP3_SERVER="", POP3_SSL=False,
+                   IMAP_SERVER="", IMAP_SSL=False, METRICS_PORT=0, **configs)
+    saved = {name: getattr(config, name) for name in configs}
+    level = logger.level
+    for name, value in configs.items():
+        setattr(config, name, value)
+    logger.setLevel(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(config, name, value)
+        logger.setLevel(level)
+# end e2e()
+
+#**********************************************************************
+# @Function: wait_until(check, timeout=60)
+# @Description: wait until the check function returns True
+# @Parameter: check, the function
+# @Parameter: timeout=60, the max seconds
+# @Return: status, False when timeout
+#**********************************************************************
+def wait_until(check, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    # end while
+    return True
+# end wait_until()
+
+#**********************************************************************
+# @Function: make_uidl(start, count)
+# @Description: generate the uidl() response lines
+# @Parameter: start, the first email hash sequence
+# @Parameter: count, the email count
+# @Return: lines, the uidl() list, eg: b'1 ZC3130-wi6DhoW5iDuIEDhYOkraUbh'
+#**********************************************************************
+def make_uidl(start, count):
+    return [b"%d ZC%010d-wi6DhoW5iDuIEDh" % (i+1, start+i) for i in range(count)]
+# end make_uidl()
+
+#**********************************************************************
+# @Function: legacy_parse_uidl_line(line)
+# @Description: parse uidl single line data, used by EmailBot v0.2
+# @Parameter: line, the single line uidl data
+# @Return: (id, hash), the email id and hash
+#**********************************************************************
+def legacy_parse_uidl_line(line):
+    array = line.decode("utf-8").split(" ")
+    return int(array[0]), array[1]
+# end legacy_parse_uidl_line()
+
+#**********************************************************************
+# @Function: legacy_uidl_news(old_cache, new_cache)
+# @Description: the nested reversed loop algorithm which find the new email
+#   start position, used by EmailBot v0.2
+# @Parameter: old_cache, the uidl() list of the last polling
+# @Parameter: new_cache, the uidl() list of the current polling
+# @Return: news, the new email id list
+#**********************************************************************
+def legacy_uidl_news(old_cache, new_cache):
+    position = -1
+    for oc in reversed(old_cache):
+        for nc in reversed(new_cache):
+            _, ohash = legacy_parse_uidl_line(oc)
+            nid, nhash = legacy_parse_uidl_line(nc)
+            if ohash == nhash:
+                position = nid
+                break
+        # end for
+        if position >= 0:
+            break
+    # end for
+    return list(range(position+1, len(new_cache)+1))
+# end legacy_uidl_news()
+
+#**********************************************************************
+# @Function: bench_uidl(size=20000, news=50)
+# @Description: compare the new email detection between the legacy nested
+#   loop and the hash index diff "EmailBot._diff_uidl()", include scenes:
+#     append: new emails are appended to the mailbox
+#     deleted: the latest known emails are deleted, and new emails arrive
+# @Parameter: size=20000, the mailbox size
+# @Parameter: news=50, the new email count
+# @Return: None
+#**********************************************************************
+def bench_uidl(size=20000, news=50):
+    import emailbot
+    eb = emailbot.EmailBot.__new__(emailbot.EmailBot)
+
+    old = make_uidl(0, size)
+    scenes = {
+        "append": make_uidl(news, size),
+        # the last 20 known emails are deleted
+        "deleted": make_uidl(0, size-20) + make_uidl(size+news, news),
+    }
+    for name, new in scenes.items():
+        legacy = timeit(lambda: legacy_uidl_news(old, new), repeat=1)
+        cache, _ = eb._diff_uidl(None, old)
+        index = timeit(lambda: eb._diff_uidl(cache, new))
+        print("uidl %-8s size=%d news=%d legacy=%.4fs index=%.4fs" % (
+            name, size, news, legacy, index))
+    # end for
+# end bench_uidl()
+
+#**********************************************************************
+# @Function: make_corpus(count)
+# @Description: generate the received email corpus
+# @Parameter: count, the email count
+# @Return: emails, the mime.Email list
+#**********************************************************************
+def make_corpus(count):
+    import mime
+    emails = []
+    for i in range(count):
+        e = mime.Email(sender="user%d@host%d.example.com" % (i, i % 50),
+                       receiver="bot@example.com",
+                       subject="[report] daily summary %d" % i,
+                       content="hello bot,\n" + "this is the line %d of the report.\n" % i * 40)
+        emails.append(e)
+    # end for
+    return emails
+# end make_corpus()
+
+#**********************************************************************
+# @Function: legacy_rule_match(r, email)
+# @Description: the rule matching of EmailBot v0.2, all the raw regexp rules
+#   are searched on every email, and the custom function is always called
+# @Parameter: r, the Rule object
+# @Parameter: email, the email object
+# @Return: match, rule matched or not
+#**********************************************************************
+def legacy_rule_match(r, email):
+    import re
+    match_sender  = re.search(r.sender, email.sender, re.M|re.I)
+    match_subject = re.search(r.subject, email.subject, re.M|re.I)
+    match_content = re.search(r.content, email.content, re.M|re.I)
+    if r.func != None:
+        match_func, _ = r.func(email)
+    else:
+        match_func = True
+    return bool(match_sender and match_subject and match_content and match_func)
+# end legacy_rule_match()
+
+#**********************************************************************
+# @Function: bench_rules(size=2000, count=20)
+# @Description: compare the rule set matching between the legacy raw regexp
+#   search and the compiled short-circuit "Rule.match()", every email of the
+#   corpus is checked by all the rules
+# @Parameter: size=2000, the rule count
+# @Parameter: count=20, the email count of corpus
+# @Return: None
+#**********************************************************************
+def bench_rules(size=2000, count=20):
+    import rule
+    def func(email):
+        return "report" in email.content, {}
+    rules = []
+    for i in range(size):
+        rules.append(rule.Rule(None, sender=r"^admin%d@host%d\.example\.com$" % (i, i % 50),
+                               subject=r"\[cmd\] task-%d" % i, content=r"id=(\d+)",
+                               func=func if i % 2 else None))
+    # end for
+    emails = make_corpus(count)
+
+    def run(match):
+        for e in emails:
+            for r in rules:
+                match(r, e)
+    # end run()
+    legacy = timeit(lambda: run(legacy_rule_match), repeat=1)
+    compiled = timeit(lambda: run(rule.Rule.match), repeat=3)
+    print("rules size=%d emails=%d legacy=%.4fs compiled=%.4fs" % (
+        size, count, legacy, compiled))
+# end bench_rules()
+
+#**********************************************************************
+# @Function: bench_dispatch(size=5000, count=200)
+# @Description: compare the first matched rule dispatching between the linear
+#   scan of all rules and the "RuleIndex" candidates, the rule set is mostly
+#   keyed by sender address/domain, some by subject prefix, and a few true
+#   regexp rules
+# @Parameter: size=5000, the rule count
+# @Parameter: count=200, the email count of corpus
+# @Return: None
+#**********************************************************************
+def bench_dispatch(size=5000, count=200):
+    import rule
+    rules = []
+    for i in range(size):
+        if i % 10 == 0:
+            r = rule.Rule(None, subject=r"^\[cmd-%d\] " % i)
+        elif i % 50 == 1:
+            r = rule.Rule(None, sender=r"admin\d+@", content=r"id=(\d+)")
+        elif i % 2 == 0:
+            r = rule.Rule(None, sender=r"@host%d\.example\.com$" % i)
+        else:
+            r = rule.Rule(None, sender=r"^user%d@host%d\.example\.com" % (i, i-1))
+        rules.append(r)
+    # end for
+    emails = make_corpus(count)
+    index = rule.RuleIndex()
+    index.sync(rules)
+
+    def linear():
+        result = []
+        for e in emails:
+            result.append(next((r for r in rules if r.match(e)[0]), None))
+        return result
+    # end linear()
+    def indexed():
+        result = []
+        for e in emails:
+            result.append(next((r for r in index.candidates(e) if r.match(e)[0]), None))
+        return result
+    # end indexed()
+    if linear() != indexed():
+        print("dispatch result mismatch")
+        return
+    print("dispatch size=%d emails=%d linear=%.4fs index=%.4fs" % (
+        size, count, timeit(linear, repeat=1), timeit(indexed)))
+# end bench_dispatch()
+
+#**********************************************************************
+# @Function: make_source(i, size)
+# @Description: generate the received MIME email source, a multipart email
+#   with text and html parts, and an attachment
+# @Parameter: i, the email sequence
+# @Parameter: size, the attachment size
+# @Return: source, the MIME email string
+#**********************************************************************
+def make_source(i, size):
+    import mime
+    with open("/dev/urandom", "rb") as f:
+        data = f.read(size)
+    e = mime.Email(sender="user%d@host%d.example.com" % (i, i % 50),
+                   receiver="bot@example.com", subject="[report] daily summary %d" % i,
+                   content="hello bot,\n" + "this is the line %d of the report.\n" % i * 200)
+    e.MIME.add_alternative("<p>%s</p>" % e.content, subtype="html")
+    e.MIME.add_attachment(data, maintype="application", subtype="octet-stream",
+                          filename="report.bin")
+    return e.MIME.as_string()
+# end make_source()
+
+#**********************************************************************
+# @Function: bench_parse(count=50, size=200*1024)
+# @Description: compare the received email parsing between the eager full
+#   parsing of EmailBot v0.2, and the lazy headers-first "mime.Email" which
+#   is only read the headers (rejected by header rules) or also the content
+# @Parameter: count=50, the email count
+# @Parameter: size=200*1024, the attachment size
+# @Return: None
+#**********************************************************************
+def bench_parse(count=50, size=200*1024):
+    import mime
+    from email.parser import Parser
+    sources = [make_source(i, size) for i in range(count)]
+
+    def eager():
+        for s in sources:
+            e = mime.Email.__new__(mime.Email)
+            msg = Parser().parsestr(s)
+            e._get_header(msg, "From", "")
+            e._get_header(msg, "Subject", "")
+            e._parse_content(msg)
+    # end eager()
+    def headers():
+        for s in sources:
+            mime.Email(source=s).sender
+    # end headers()
+    def content():
+        for s in sources:
+            mime.Email(source=s).content
+    # end content()
+    print("parse emails=%d size=%d eager=%.4fs lazy_headers=%.4fs lazy_content=%.4fs" % (
+        count, size, timeit(eager), timeit(headers), timeit(content)))
+# end bench_parse()
+
+#**********************************************************************
+# @Function: bench_sendqueue(size=20000)
+# @Description: compare draining the send queue between the list slicing of
+#   EmailBot v0.2 and "sendqueue.SendQueue", one by one and by batch
+# @Parameter: size=20000, the queued email count
+# @Return: None
+#**********************************************************************
+def bench_sendqueue(size=20000):
+    import threading
+    import sendqueue
+
+    def legacy():
+        queue, mutex = list(range(size)), threading.Lock()
+        while len(queue) > 0:
+            mutex.acquire()
+            e = queue[0]
+            queue = queue[1:]
+            mutex.release()
+        # end while
+    # end legacy()
+    def deque():
+        queue = sendqueue.SendQueue()
+        for i in range(size):
+            queue.put(i)
+        while queue.get(timeout=0) != None:
+            pass
+    # end deque()
+    def batch():
+        queue = sendqueue.SendQueue()
+        for i in range(size):
+            queue.put(i)
+        while len(queue.get_batch(100, timeout=0)) > 0:
+            pass
+    # end batch()
+    print("sendqueue size=%d legacy=%.4fs queue=%.4fs batch=%.4fs" % (
+        size, timeit(legacy, repeat=1), timeit(deque), timeit(batch)))
+# end bench_sendqueue()
+
+#**********************************************************************
+# @Function: bench_spool(count=2000, threads=8)
+# @Description: measure the enqueue throughput of send spool, compare the
+#   memory queue, the spool fsynced on each put (sequential), the spool with
+#   group commit by concurrent threads, and the spool with fsync interval
+# @Parameter: count=2000, the email count
+# @Parameter: threads=8, the concurrent enqueue threads
+# @Return: None
+#**********************************************************************
+def bench_spool(count=2000, threads=8):
+    import shutil
+    import tempfile
+    import threading
+    import mime
+    import sendqueue
+    import spool
+
+    emails = [mime.Email("bot@example.com", "user%d@example.com" % i,
+                         subject="subject %d" % i, content="content " * 100)
+              for i in range(count)]
+
+    def memory():
+        queue = sendqueue.SendQueue()
+        for e in emails:
+            queue.put(sendqueue.SendTask(e))
+    # end memory()
+    def spooled(interval, workers):
+        path = tempfile.mkdtemp()
+        try:
+            s = spool.Spool(path, interval)
+            def put(part):
+                for e in part:
+                    s.put(e)
+            # end put()
+            ts = [threading.Thread(target=put, args=(emails[i::workers],))
+                  for i in range(workers)]
+            start = time.perf_counter()
+            for t in ts:
+                t.start()
+            for t in ts:
+                t.join()
+            s.flush()
+            return time.perf_counter() - start
+        finally:
+            shutil.rmtree(path)
+    # end spooled()
+
+    cost = timeit(memory, repeat=3)
+    print("spool count=%d memory=%.4fs (%d/s)" % (count, cost, count / cost))
+    for name, interval, workers in (("sync", 0, 1), ("group", 0, threads),
+                                    ("interval", 0.05, 1)):
+        cost = spooled(interval, workers)
+        print("spool count=%d %s(threads=%d)=%.4fs (%d/s)" % (
+            count, name, workers, cost, count / cost))
+    # end for
+# end bench_spool()
+
+#**********************************************************************
+# @Function: bench_sendmany(count=200, size=1024*1024)
+# @Description: compare rendering the SMTP DATA of a report sent to many
+#   recipients, between "send_email()" in a loop and "send_many()"
+# @Parameter: count=200, the recipient count
+# @Parameter: size=1MB, the attachment size
+# @Return: None
+#**********************************************************************
+def bench_sendmany(count=200, size=1024*1024):
+    import tempfile
+    import emailbot
+    import mime
+    eb = emailbot.EmailBot.__new__(emailbot.EmailBot)
+    eb.username = "bot@example.com"
+    recipients = ["user%d@example%d.com" % (i, i % 10) for i in range(count)]
+
+    with tempfile.NamedTemporaryFile(suffix=".bin") as f:
+        f.write(os.urandom(size))
+        f.flush()
+
+        def loop():
+            for addr in recipients:
+                e = mime.Email(eb.username, addr, "", "report", "content", f.name)
+                for chunk in e.data():
+                    pass
+        # end loop()
+        def many():
+            emails, _ = eb._build_many(recipients, "report", "content", f.name)
+            for e in emails:
+                for chunk in e.data():
+                    pass
+        # end many()
+        print("sendmany count=%d size=%d loop=%.4fs send_many=%.4fs" % (
+            count, size, timeit(loop, repeat=1), timeit(many, repeat=3)))
+    # end with
+# end bench_sendmany()
+
+#**********************************************************************
+# @Function: bench_template(count=2000)
+# @Description: compare rendering personalized emails, between building a
+#   new "mime.Email" for each recipient and "mime.Template.render()"
+# @Parameter: count=2000, the recipient count
+# @Return: None
+#**********************************************************************
+def bench_template(count=2000):
+    import string
+    import mime
+    subject = "weekly report of $name"
+    content = "hi $name,\n\n" + "the report line of this week.\n" * 50 + "\nthanks\n"
+    recipients = [("user%d@example.com" % i, {"name": "user%d" % i}) for i in range(count)]
+
+    def build():
+        s, c = string.Template(subject), string.Template(content)
+        for addr, variables in recipients:
+            e = mime.Email("bot@example.com", addr, "", s.substitute(variables),
+                           c.substitute(variables))
+            b"".join(e.stream())
+    # end build()
+    def render():
+        t = mime.Template("bot@example.com", subject, content)
+        for addr, variables in recipients:
+            b"".join(t.render(addr, variables).stream())
+    # end render()
+    print("template count=%d email=%.4fs template=%.4fs" % (
+        count, timeit(build, repeat=1), timeit(render, repeat=3)))
+# end bench_template()
+
+#**********************************************************************
+# @Function: bench_e2e_send(count=2000, probe=200, latency=0.001, error_rate=0.01)
+# @Description: send emails by EmailBot to the fake smtp server end to end,
+#   with both the thread and asyncio engines, measure the latency from
+#   "send_email()" to the email delivered one by one, and the throughput of a
+#   burst of emails; the transient errors are injected, the failed emails are
+#   retried
+# @Parameter: count=2000, the email count of throughput measurement
+# @Parameter: probe=200, the email count of latency measurement
+# @Parameter: latency=0.001, the server reply latency seconds
+# @Parameter: error_rate=0.01, the RCPT failure probability
+# @Return: None
+#**********************************************************************
+def bench_e2e_send(count=2000, probe=200, latency=0.001, error_rate=0.01):
+    import asyncio
+    import threading
+    import emailbot
+    import fakeserver
+    import metrics
+
+    def failed():
+        return metrics.REGISTRY.snapshot()["emailbot_send_emails_total"].get(("failed",), 0)
+    # end failed()
+
+    with e2e(SEND_RETRY_BASE=0.05, SEND_RETRY_MAX=0.2, SEND_SPOOL="",
+             SEND_RATE=0, SEND_RATE_DOMAIN=0):
+        for engine in ("thread", "asyncio"):
+            server = fakeserver.SMTPServer(latency, error_rate).start()
+            eb = emailbot.EmailBot(smtp="127.0.0.1", smtp_port=server.port)
+            eb.login("bot@example.com", "bench")
+            if engine == "thread":
+                target = eb._send_manager
+            else:
+                target = lambda: asyncio.run(eb.run_async())
+            threading.Thread(target=target, daemon=True).start()
+            time.sleep(0.1)
+
+            retries = failed()
+            latencies = []
+            for i in range(probe):
+                start = time.perf_counter()
+                eb.send_email("user%d@example%d.com" % (i, i % 10), subject="probe %d" % i,
+                              content="hello %d" % i)
+                if not wait_until(lambda: len(server.messages) > i, 10):
+                    break
+                latencies.append(server.messages[-1][0] - start)
+            # end for
+            start = time.perf_counter()
+            for i in range(count):
+                eb.send_email("user%d@example%d.com" % (i, i % 10), subject="bench %d" % i,
+                              content="hello %d" % i)
+            # end for
+            done = wait_until(lambda: len(server.messages) >= probe + count)
+            cost = server.messages[-1][0] - start
+            print("e2e_send engine=%s latency=%.1fms errors=%.1f%% probe=%d p50=%.1fms "
+                  "p99=%.1fms count=%d time=%.3fs rate=%d msg/s retries=%d%s" % (
+                  engine, latency * 1000, error_rate * 100, len(latencies),
+                  percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                  count, cost, count / cost, failed() - retries, "" if done else " TIMEOUT"))
+            server.stop()
+        # end for
+    # end with
+    print("e2e_send peak_rss=%sMB" % ("%.1f" % peak_rss() if peak_rss() != None else "n/a"))
+# end bench_e2e_send()
+
+#**********************************************************************
+# @Function: bench_e2e_recv(sizes=(1000, 10000, 50000), news=500,
+#   latency=0.0002, error_rate=0.0)
+# @Description: receive emails by EmailBot from the fake pop3 server end to
+#   end, for each mailbox size, measure the cpu time of polling without new
+#   email (the uidl diff), and the throughput of receiving and dispatching
+#   the new emails to the rule callbacks, with the latency from the polling
+#   start to each callback
+# @Parameter: sizes=(1000, 10000, 50000), the mailbox sizes
+# @Parameter: news=500, the new email count
+# @Parameter: latency=0.0002, the server reply latency seconds
+# @Parameter: error_rate=0.0, the RETR failure probability, the failed email
+#   is skipped
+# @Return: None
+#**********************************************************************
+def bench_e2e_recv(sizes=(1000, 10000, 50000), news=500, latency=0.0002, error_rate=0.0):
+    import emailbot
+    import fakeserver
+
+    def poll(eb):
+        start, cpu = time.perf_counter(), time.thread_time()
+        with eb.pop3.session() as session:
+            eb._recv_poll(session)
+        return time.perf_counter() - start, time.thread_time() - cpu
+    # end poll()
+
+    with e2e(POP3_TOP=True, RECV_STORE=""):
+        for size in sizes:
+            server = fakeserver.POP3Server(latency, error_rate).start()
+            server.add(*[fakeserver.make_email(i) for i in range(size)])
+            eb = emailbot.EmailBot(pop3="127.0.0.1", pop3_port=server.port)
+            eb.login("bot@example.com", "bench")
+            called = []
+            def callback(eb, e, regx):
+                called.append(time.perf_counter())
+            # end callback()
+            eb.rule = []
+            eb.add_rule(callback, subject=r"^bench", content=r"name=(\w+)")
+
+            # the first polling initializes the cache
+            poll(eb)
+            idle, idle_cpu = min(poll(eb) for _ in range(3))
+            server.add(*[fakeserver.make_email(size + i) for i in range(news)])
+            start = time.perf_counter()
+            cost, cpu = poll(eb)
+            wait_until(lambda: eb.executor.stats()["completed"] >= eb.executor.stats()["submitted"])
+            latencies = [t - start for t in called]
+            print("e2e_recv size=%d poll_idle=%.4fs poll_idle_cpu=%.4fs news=%d poll=%.3fs "
+                  "poll_cpu=%.3fs rate=%d msg/s dispatched=%d p50=%.1fms p99=%.1fms" % (
+                  size, idle, idle_cpu, news, cost, cpu, news / cost, len(called),
+                  percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+            server.stop()
+        # end for
+    # end with
+    print("e2e_recv peak_rss=%sMB" % ("%.1f" % peak_rss() if peak_rss() != None else "n/a"))
+# end bench_e2e_recv()
+
+#**********************************************************************
+# @Function: bench_e2e_imap(count=200, burst=1000, latency=0.0002)
+# @Description: receive emails by EmailBot from the fake imap server end to
+#   end, the new email is pushed by IDLE, measure the dispatch latency from
+#   the email arrived in the mailbox to its callback, one by one; and the
+#   throughput of a burst of new emails
+# @Parameter: count=200, the email count of latency measurement
+# @Parameter: burst=1000, the email count of throughput measurement
+# @Parameter: latency=0.0002, the server reply latency seconds
+# @Return: None
+#**********************************************************************
+def bench_e2e_imap(count=200, burst=1000, latency=0.0002):
+    import threading
+    import emailbot
+    import fakeserver
+
+    with e2e(IMAP_STATE=""):
+        server = fakeserver.IMAPServer(latency).start()
+        server.add(*[fakeserver.make_email(i) for i in range(100)])
+        eb = emailbot.EmailBot(imap="127.0.0.1", imap_port=server.port)
+        eb.login("bot@example.com", "bench")
+        called = []
+        event = threading.Event()
+        def callback(eb, e, regx):
+            called.append(time.perf_counter())
+            event.set()
+        # end callback()
+        eb.rule = []
+        eb.add_rule(callback, subject=r"^bench", content=r"name=(\w+)")
+        threading.Thread(target=eb._imap_manager, daemon=True).start()
+        time.sleep(0.5)
+
+        latencies = []
+        for i in range(count):
+            event.clear()
+            start = time.perf_counter()
+            server.add(fakeserver.make_email(100 + i))
+            if not event.wait(10):
+                break
+            latencies.append(called[-1] - start)
+        # end for
+        start = time.perf_counter()
+        server.add(*[fakeserver.make_email(100 + count + i) for i in range(burst)])
+        done = wait_until(lambda: len(called) >= count + burst)
+        cost = called[-1] - start
+        print("e2e_imap count=%d p50=%.1fms p99=%.1fms burst=%d time=%.3fs rate=%d msg/s%s" % (
+              len(latencies), percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+              burst, cost, burst / cost, "" if done else " TIMEOUT"))
+        server.stop()
+    # end with
+    print("e2e_imap peak_rss=%sMB" % ("%.1f" % peak_rss() if peak_rss() != None else "n/a"))
+# end bench_e2e_imap()
+
+BENCHMARKS = {
+    "uidl":  bench_uidl,
+    "rules": bench_rules,
+    "dispatch": bench_dispatch,
+    "parse": bench_parse,
+    "sendqueue": bench_sendqueue,
+    "spool": bench_spool,
+    "sendmany": bench_sendmany,
+    "template": bench_template,
+    "e2e_send": bench_e2e_send,
+    "e2e_recv": bench_e2e_recv,
+    "e2e_imap": bench_e2e_imap,
+}
+
+#**********************************************************************
+# @Function: main()
+# @Description: main entry point
+# @Parameter: None
+# @Return: None
+#**********************************************************************
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EmailBot micro benchmarks")
+    parser.add_argument("name", nargs="*", help="the benchmark name (%s), "
+                        "run all if empty" % ", ".join(BENCHMARKS))
+    args = parser.parse_args()
+
+    for name in args.name or BENCHMARKS:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % name)
+        BENCHMARKS[name]()
+# end main()
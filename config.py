@@ -24,6 +24,120 @@ SMTP_SSL    = True
 POP3_SERVER = "pop.exmail.qq.com"
 POP3_PORT   = 995
 POP3_SSL    = True
+# fetch the email headers by pop3 "TOP n 0" first, the whole email is received
+# by "RETR" only when the headers match some rule's sender/subject; it falls
+# back to "RETR" if the server doesn't support "TOP"
+POP3_TOP    = True
+# set imap server address/port/ssl, using receive email instead of pop3, keep
+# IMAP_SERVER empty to receive email by pop3
+IMAP_SERVER = ""
+IMAP_PORT   = 993
+IMAP_SSL    = True
+# set imap waiting new email seconds, the IDLE command will be reissued after
+# timeout (rfc2177 suggests less than 29 minutes); it's the NOOP polling
+# interval when the server doesn't support IDLE
+IMAP_IDLE_TIMEOUT = 300
+IMAP_POLL_INTERVAL = 60
+# set the file which persists the imap sync state(UIDVALIDITY and the last
+# processed uid), then the sync continues after restart; keep it empty to
+# disable, then the existing emails are skipped at startup
+IMAP_STATE = ""
+
+# set smtp connection pool, the authenticated smtp sessions are kept alive and
+# reused by all senders, instead of login smtp server for every email
+# SMTP_POOL_SIZE: the max number of idle sessions kept in the pool
+# SMTP_POOL_IDLE: the session idle more than seconds will be evicted
+# SMTP_POOL_MAXAGE: the session alive more than seconds will be reconnected
+# SMTP_POOL_KEEPALIVE: check session by NOOP when it idle more than seconds
+SMTP_POOL_SIZE      = 4
+SMTP_POOL_IDLE      = 120
+SMTP_POOL_MAXAGE    = 600
+SMTP_POOL_KEEPALIVE = 30
+
+# set the file which persists the hash of processed emails, then the emails
+# arrived while emailbot is stopped will be received after restart; keep it
+# empty to disable, then the existing emails are skipped at startup
+RECV_STORE = ""
+
+# set the callback executor, the matched rule callbacks run in a bounded
+# worker pool, instead of starting a new thread for each email
+# CALLBACK_WORKERS: the number of worker threads
+# CALLBACK_QUEUE_SIZE: the max number of callbacks waiting in the queue
+# CALLBACK_QUEUE_POLICY: when the queue is full, "block" the receive manager,
+#   "drop" the callback, or "spill" the callback into CALLBACK_SPILL_PATH
+#   directory (the callback should be a module level function)
+CALLBACK_WORKERS      = 8
+CALLBACK_QUEUE_SIZE   = 1000
+CALLBACK_QUEUE_POLICY = "block"
+CALLBACK_SPILL_PATH   = ""
+
+# set the received attachments, the attachment is decoded into memory when
+# it's smaller than ATTACHMENT_MEMORY_SIZE(bytes), otherwise into temporary
+# file of ATTACHMENT_TEMP_DIR (system temporary directory if empty)
+ATTACHMENT_MEMORY_SIZE = 1024 * 1024
+ATTACHMENT_TEMP_DIR    = ""
+
+# set the send workers, the queued emails are sent by SEND_WORKERS workers
+# concurrently, and at most SEND_DOMAIN_CONCURRENCY(0 is unlimited) emails to
+# the same recipient domain are being sent; the failed email is retried after
+# SEND_RETRY_BASE seconds, and the delay is doubled(with jitter) for each
+# failure up to SEND_RETRY_MAX seconds, it's dropped after SEND_RETRY_LIMIT
+# failures(0 is retry forever); the email refused permanently(5xx reply) is
+# dropped without retry
+SEND_WORKERS            = 4
+SEND_DOMAIN_CONCURRENCY = 2
+SEND_RETRY_BASE         = 10
+SEND_RETRY_MAX          = 600
+SEND_RETRY_LIMIT        = 0
+# set the max number of emails sent by a worker over one smtp session, the
+# queued emails are shared by the workers, so the batch is smaller when the
+# queue is short
+SEND_BATCH_SIZE         = 20
+# set the max number of recipients folded into one email by "send_many()"
+SEND_MANY_RCPT          = 50
+
+# set the send rate limit, the emails per second of the account(SEND_RATE) and
+# each recipient domain(SEND_RATE_DOMAIN), 0 is unlimited; SEND_RATE_BURST
+# emails can be sent at once after idle. the rate is halved when the server
+# throttles the sending by 421/451/452 replies, and ramps back up to the limit
+# when the emails are sent
+SEND_RATE               = 0
+SEND_RATE_DOMAIN        = 0
+SEND_RATE_BURST         = 10
+
+# set the directory of crash-safe send spool, the queued emails are written
+# into it, replayed after restart and removed after they are sent; keep it
+# empty to disable, then the queued emails are lost when emailbot stops
+# SEND_SPOOL_SYNC: the fsync interval seconds, 0 means "send_email()" returns
+#   after the email is fsynced (the concurrent emails share one fsync), >0
+#   means the emails of the last interval may be lost by power failure
+# SEND_SPOOL_SEGMENT_SIZE: the max bytes of a spool segment file
+SEND_SPOOL              = ""
+SEND_SPOOL_SYNC         = 0
+SEND_SPOOL_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# set the LRU cache size of the encoded headers and bodies of "mime.Template",
+# the same subject or content of outbound emails is encoded only once
+MIME_TEMPLATE_CACHE = 1024
+
+# set the local http endpoint of metrics(prometheus text format), the metrics
+# are served at http://METRICS_ADDRESS:METRICS_PORT/metrics; 0 is disabled,
+# the metrics can be read by "metrics.REGISTRY.snapshot()" as well
+METRICS_ADDRESS = "127.0.0.1"
+METRICS_PORT    = 0
+
+# set the profiling of rules and callbacks, it's disabled by default
+# PROFILE_RULES: count the cumulative time and calls of each rule matching and
+#   callback, read them by "profiler.PROFILER.stats()"
+# PROFILE_SLOW_RULE: log the rule matching slower than seconds, 0 is disabled
+# PROFILE_SIGNAL: the signal which dumps the statistics and the stacks of all
+#   threads sampled for PROFILE_SAMPLE_SECONDS into PROFILE_DUMP directory
+#   (system temporary directory if empty), keep it empty to disable
+PROFILE_RULES          = False
+PROFILE_SLOW_RULE      = 0.1
+PROFILE_SIGNAL         = "SIGUSR1"
+PROFILE_SAMPLE_SECONDS = 30
+PROFILE_DUMP           = ""
 
 # set email username and password
 # Attention: the password is the email client password, not the account password
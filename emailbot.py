@@ -9,8 +9,10 @@ Time: 2021.06.21
 """
 
 import argparse
+import asyncio
 import threading
 import time
+from email.utils import parseaddr
 
 # patch import path
 import os
@@ -18,11 +20,19 @@ import sys
 module_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(module_path)
 
+import aioprotocol
 import config
+import executor
 import interact
+import metrics
 import mime
+import profiler
 import protocol
+import ratelimit
 import rule
+import sendqueue
+import spool
+import store
 import utils
 from utils import logger
 
@@ -37,7 +47,7 @@ VERSION = "EmailBot v0.2 (build 20220113)"
 class EmailBot:
     #**********************************************************************
     # @Function: __init__(self, smtp="", pop3="", smtp_port=0, pop3_port=0,
-    #            smtp_ssl=False, pop3_ssl=False)
+    #            smtp_ssl=False, pop3_ssl=False, imap="", imap_port=0, imap_ssl=False)
     # @Description: the EmailBot object initialize
     # @Parameter: smtp="", the SMTP server address, using configure if empty
     # @Parameter: pop3="", the POP3 server address, using configure if empty
@@ -47,10 +57,15 @@ class EmailBot:
     #             using configure if empty
     # @Parameter: pop3_ssl=False, ssl is required to connect to the POP3,
     #             using configure if empty
+    # @Parameter: imap="", the IMAP server address, using configure if empty,
+    #             when it is set, receive email by IMAP instead of POP3
+    # @Parameter: imap_port=0, the IMAP server port, using configure if empty
+    # @Parameter: imap_ssl=False, ssl is required to connect to the IMAP,
+    #             using configure if empty
     # @Return: None
     #**********************************************************************
     def __init__(self, smtp="", pop3="", smtp_port=0, pop3_port=0,
-                smtp_ssl=False, pop3_ssl=False):
+                smtp_ssl=False, pop3_ssl=False, imap="", imap_port=0, imap_ssl=False):
         # initialize field
         self.smtp_address = smtp      if smtp else config.SMTP_SERVER
         self.smtp_port    = smtp_port if smtp_port else config.SMTP_PORT
@@ -58,65 +73,344 @@ class EmailBot:
         self.pop3_address = pop3      if pop3 else config.POP3_SERVER
         self.pop3_port    = pop3_port if pop3_port else config.POP3_PORT
         self.pop3_ssl     = pop3_ssl  if pop3_ssl else config.POP3_SSL
+        self.imap_address = imap      if imap else config.IMAP_SERVER
+        self.imap_port    = imap_port if imap_port else config.IMAP_PORT
+        self.imap_ssl     = imap_ssl  if imap_ssl else config.IMAP_SSL
 
         # reset/initialize value by "self.login()"
         self.username = config.USERNAME
         self.password = config.PASSWORD
         self.smtp = None
         self.pop3 = None
+        self.imap = None
+        # the asyncio protocol objects, set by "run_async()"
+        self.asmtp = None
+        self.apop3 = None
+        self.aimap = None
 
         # email send/receive mananger
-        self._send_queue = []
-        self._mutex = threading.Lock()
+        self._send_queue = sendqueue.SendQueue()
+        self._send_limit = sendqueue.DomainLimit(config.SEND_DOMAIN_CONCURRENCY)
+        self._send_rate  = ratelimit.RateLimit(config.SEND_RATE, config.SEND_RATE_DOMAIN,
+                                               config.SEND_RATE_BURST)
+        # the queue depth of all the EmailBot objects
+        metrics.SEND_QUEUE.add_function(self._send_queue.__len__)
+        # the opt-in profiling of rules and callbacks
+        if config.PROFILE_RULES:
+            profiler.enable(config.PROFILE_SLOW_RULE, config.PROFILE_DUMP,
+                            config.PROFILE_SAMPLE_SECONDS)
+        # the crash-safe spool of queued emails, the emails spooled before
+        # restart are queued again
+        self._spool = None
+        if config.SEND_SPOOL != "":
+            self._spool = spool.Spool(config.SEND_SPOOL, config.SEND_SPOOL_SYNC,
+                                      config.SEND_SPOOL_SEGMENT_SIZE)
+            for key, recipients, source in self._spool.replay():
+                # the email is sent to the spooled recipients only, such as
+                # the refused ones of a sent email
+                e = mime.Email(source=source).copy_to(recipients)
+                self._send_queue.put(sendqueue.SendTask(e, key))
+            if len(self._send_queue) > 0:
+                logger.info("replay %d spooled emails" % len(self._send_queue))
+        # end if
+        # the {hash: id} dict of the last uidl() polling
         self._recv_cache = None
+        # the persistent store of processed email hash, set by "_recv_manager()"
+        self._recv_store = None
+        # the (loop, asyncio.Event) which wakes up the asyncio send manager
+        self._send_wakeup = None
+        # the running asyncio callback tasks/futures
+        self._tasks = set()
+        self._async_limit = None
+
+        # the bounded executor of rule callbacks
+        self.executor = executor.CallbackExecutor(config.CALLBACK_WORKERS,
+                        config.CALLBACK_QUEUE_SIZE, config.CALLBACK_QUEUE_POLICY,
+                        config.CALLBACK_SPILL_PATH, self)
 
         # the rule list, add it by "interact.py" && "add_rule()"
         self.rule = []
         for name in interact.INTERACTS:
             logger.debug("load [%s] rule from config.py" % name)
             self.rule.append(interact.INTERACTS[name])
+        # the rule index for dispatching, it follows the "self.rule" list
+        self.rule_index = rule.RuleIndex()
     # end __init__()
 
     #**********************************************************************
     # @Function: _send_manager(self)
     # @Description: send email manager, when the user sends a email, the email to
-    #   be sent is added to the queue, and the manager will be sent one by one in
-    #   order; when the sending is wrong, manager will automatically retry until it
-    #   succeeds (usually due to network reasons or temporary failures, because
-    #   login() check has been passed)
+    #   be sent is added to the queue, and SEND_WORKERS workers send them
+    #   concurrently in order, each worker sends a batch of emails over one
+    #   smtp session; when the sending is wrong, the email will be
+    #   automatically retried later (usually due to network reasons or temporary
+    #   failures, because login() check has been passed), and the other emails
+    #   are not blocked.
     # @Parameter: None
     # @Return: None
     #**********************************************************************
     def _send_manager(self):
+        workers = []
+        for _ in range(config.SEND_WORKERS):
+            t = threading.Thread(target=self._send_worker, daemon=True)
+            t.start()
+            workers.append(t)
+        # end for
+        for t in workers:
+            t.join()
+    # end _send_manager()
+
+    #**********************************************************************
+    # @Function: _send_worker(self)
+    # @Description: the send worker, take a batch of emails whose recipient
+    #   domains are not busy, and send them over one smtp session
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _send_worker(self):
         while True:
-            # check and get the email waiting to be sent
-            self._mutex.acquire()
-            wait_count = len(self._send_queue)
-            if wait_count > 0:
-                e = self._send_queue[0]
-            else:
-                e = None
-            self._mutex.release()
+            # wait and get the emails waiting to be sent
+            held = set()
+            tasks = self._send_queue.get_batch(self._send_batch_size(),
+                    accept=lambda task: self._send_accept(task, held))
+            for task in tasks:
+                logger.info("send email [%s] to %s" % (task.email.subject, task.email.receiver))
 
-            if e == None:
-                time.sleep(10)
-                continue
+            start = time.perf_counter()
+            try:
+                results = self.smtp.send_batch([task.email for task in tasks])
+            finally:
+                self._send_limit.release(held)
+                self._send_queue.notify()
+            metrics.SEND_BATCH_SECONDS.observe(time.perf_counter() - start)
+            self._send_results(tasks, results)
+        # end while
+    # end _send_worker()
 
-            logger.info("send email [%s] to %s" % (e.subject, e.receiver))
-            # send email, when it fails, we will not remove this email,
-            # it will try again in the next loop
-            result = self.smtp.send(e)
-            if result == False:
-                # wait a little longer
-                time.sleep(60)
+    #**********************************************************************
+    # @Function: _send_accept(self, task, held)
+    # @Description: check the email can be sent now, it's limited by the send
+    #   rate and the concurrency of recipient domains
+    # @Parameter: task, the SendTask object
+    # @Parameter: held, the domain set taken by the batch
+    # @Return: status, True if it's taken, or the seconds to wait for the rate
+    #   limit, or False if the recipient domain is busy
+    #**********************************************************************
+    def _send_accept(self, task, held):
+        wait = self._send_rate.check(task)
+        if wait > 0:
+            return wait
+        if not self._send_limit.acquire(task, held):
+            return False
+        self._send_rate.take(task)
+        return True
+    # end _send_accept()
+
+    #**********************************************************************
+    # @Function: _send_batch_size(self)
+    # @Description: get the batch size of a worker, the queued emails are
+    #   shared by all the workers, up to SEND_BATCH_SIZE
+    # @Parameter: None
+    # @Return: int
+    #**********************************************************************
+    def _send_batch_size(self):
+        return max(1, min(config.SEND_BATCH_SIZE, len(self._send_queue) // config.SEND_WORKERS))
+    # end _send_batch_size()
+
+    #**********************************************************************
+    # @Function: _send_results(self, tasks, results)
+    # @Description: report the send results of a batch to the queue, the sent
+    #   emails are acknowledged, and the failed ones are retried later; the
+    #   refused recipients are handled by "_send_refused()". the reply codes
+    #   adapt the send rate
+    # @Parameter: tasks, the SendTask list
+    # @Parameter: results, the (code, refused) list of tasks, see
+    #   "SMTP.send_batch()"
+    # @Return: None
+    #**********************************************************************
+    def _send_results(self, tasks, results):
+        now = time.monotonic()
+        for task, (code, refused) in zip(tasks, results):
+            self._send_rate.feedback(task, code)
+            if code != 250 and len(refused) == 0:
+                metrics.SEND_EMAILS.inc(1, "failed")
+                self._send_retry(task, code)
                 continue
-            
-            # send success, remove this email
-            self._mutex.acquire()
-            self._send_queue = self._send_queue[1:]
-            self._mutex.release()
-        # end while
-    # end _send_manager()
+
+            if code != 250:
+                metrics.SEND_EMAILS.inc(1, "failed")
+            else:
+                metrics.SEND_EMAILS.inc(1, "sent")
+                metrics.SEND_SECONDS.observe(now - task.created)
+            self._send_refused(task, refused)
+            self._send_ack(task)
+        # end for
+    # end _send_results()
+
+    #**********************************************************************
+    # @Function: _send_refused(self, task, refused)
+    # @Description: the recipients refused by the transient failure(4xx) are
+    #   retried by a new email of them only, such as 452 "too many recipients"
+    #   of the folded email; the permanent failure(5xx) ones are dropped
+    # @Parameter: task, the SendTask object
+    # @Parameter: refused, the {address: reply code} dict of refused recipients
+    # @Return: None
+    #**********************************************************************
+    def _send_refused(self, task, refused):
+        retry = [addr for addr, code in refused.items() if code < 500]
+        dropped = [addr for addr, code in refused.items() if code >= 500]
+        e = task.email
+        if len(dropped) > 0:
+            logger.error("send email [%s] to %s refused, drop them" % (
+                e.subject, ", ".join(dropped)))
+        if len(retry) == 0:
+            return
+
+        # the retry email is spooled before the sent one is acknowledged
+        again = sendqueue.SendTask(e.copy_to(", ".join(retry)))
+        again.attempts = task.attempts
+        again.created  = task.created
+        if self._spool != None:
+            try:
+                again.key = self._spool.put(again.email)
+            except OSError as err:
+                logger.error("spool email [%s] failed (%s)" % (e.subject, err))
+        # end if
+        code = max(refused[addr] for addr in retry)
+        self._send_rate.feedback(again, code)
+        self._send_retry(again, code)
+    # end _send_refused()
+
+    #**********************************************************************
+    # @Function: _send_observe(self, code, start)
+    # @Description: count the email sent directly(blocking mode) into the send
+    #   metrics, same as the queued emails
+    # @Parameter: code, the smtp reply code of sending
+    # @Parameter: start, the monotonic time of sending start
+    # @Return: None
+    #**********************************************************************
+    def _send_observe(self, code, start):
+        if code != 250:
+            metrics.SEND_EMAILS.inc(1, "failed")
+            return
+        metrics.SEND_EMAILS.inc(1, "sent")
+        metrics.SEND_SECONDS.observe(time.monotonic() - start)
+    # end _send_observe()
+
+    #**********************************************************************
+    # @Function: _send_direct(self, emails)
+    # @Description: send the emails directly(blocking mode), they wait for
+    #   the send rate and the concurrency of recipient domains by
+    #   "_send_accept()", and adapt the send rate by the reply codes, same as
+    #   the queued emails
+    # @Parameter: emails, the mime email object list
+    # @Return: list, the (code, refused) of each email, see "SMTP.send_batch()"
+    #**********************************************************************
+    def _send_direct(self, emails):
+        tasks = [sendqueue.SendTask(e) for e in emails]
+        held = set()
+        for task in tasks:
+            while True:
+                status = self._send_accept(task, held)
+                if status is True:
+                    break
+                # wait for the rate token, or the busy domain is released
+                time.sleep(0.1 if status is False else status)
+            # end while
+        # end for
+
+        try:
+            results = self.smtp.send_batch(emails)
+        finally:
+            self._send_limit.release(held)
+            self._send_queue.notify()
+            self._notify_send()
+        for task, (code, _) in zip(tasks, results):
+            self._send_rate.feedback(task, code)
+            self._send_observe(code, task.created)
+        # end for
+        return results
+    # end _send_direct()
+
+    #**********************************************************************
+    # @Function: _send_direct_async(self, emails)
+    # @Description: the asyncio version of "_send_direct()"
+    # @Parameter: emails, the mime email object list
+    # @Return: list, the (code, refused) of each email, see "SMTP.send_batch()"
+    #**********************************************************************
+    async def _send_direct_async(self, emails):
+        tasks = [sendqueue.SendTask(e) for e in emails]
+        held = set()
+        for task in tasks:
+            while True:
+                status = self._send_accept(task, held)
+                if status is True:
+                    break
+                # wait for the rate token, or the busy domain is released
+                await asyncio.sleep(0.1 if status is False else status)
+            # end while
+        # end for
+
+        try:
+            results = await self.asmtp.send_batch(emails)
+        finally:
+            self._send_limit.release(held)
+            self._send_queue.notify()
+            self._notify_send()
+        for task, (code, _) in zip(tasks, results):
+            self._send_rate.feedback(task, code)
+            self._send_observe(code, task.created)
+        # end for
+        return results
+    # end _send_direct_async()
+
+    #**********************************************************************
+    # @Function: _send_retry(self, task, code=0)
+    # @Description: reschedule the failed email by exponential backoff with
+    #   jitter, or drop it after SEND_RETRY_LIMIT failures. only the transient
+    #   failures(4xx reply, or 0 when there is no reply such as the network
+    #   error) are retried, the permanent 5xx reply drops the email at once
+    # @Parameter: task, the SendTask object
+    # @Parameter: code=0, the smtp reply code of the failure
+    # @Return: None
+    #**********************************************************************
+    def _send_retry(self, task, code=0):
+        task.attempts += 1
+        e = task.email
+        if code >= 500:
+            logger.error("send email [%s] to %s refused by %d, drop it" % (
+                e.subject, e.receiver, code))
+            metrics.SEND_EMAILS.inc(1, "dropped")
+            self._send_ack(task)
+            return
+        if config.SEND_RETRY_LIMIT > 0 and task.attempts >= config.SEND_RETRY_LIMIT:
+            logger.error("send email [%s] to %s failed %d times, drop it" % (
+                e.subject, e.receiver, task.attempts))
+            metrics.SEND_EMAILS.inc(1, "dropped")
+            self._send_ack(task)
+            return
+
+        delay = sendqueue.backoff(task.attempts, config.SEND_RETRY_BASE, config.SEND_RETRY_MAX)
+        logger.warning("send email [%s] to %s failed, retry in %.1fs" % (
+            e.subject, e.receiver, delay))
+        self._send_queue.put_later(task, delay)
+        self._notify_send()
+    # end _send_retry()
+
+    #**********************************************************************
+    # @Function: _send_ack(self, task)
+    # @Description: remove the sent or dropped email from the spool
+    # @Parameter: task, the SendTask object
+    # @Return: None
+    #**********************************************************************
+    def _send_ack(self, task):
+        if self._spool == None or task.key == None:
+            return
+        try:
+            self._spool.ack(task.key)
+        except OSError as e:
+            logger.error(e)
+    # end _send_ack()
 
     #**********************************************************************
     # @Function: _recv_manager(self)
@@ -136,79 +430,255 @@ class EmailBot:
     #   every time we poll the hash of the inbox mail through uidl(), if there are
     #   too many inbox mails and the time range for receiving mail is not set, it
     #   will cause additional resource cost; the user can manually set the time
-    #   range for receiving mail in the mailbox to optimize the problem
+    #   range for receiving mail in the mailbox to optimize the problem.
+    #   the lists are compared by hash index(see "_diff_uidl()"), so the cost of
+    #   each polling is linear with the size of mailbox.
     # @Parameter: None
     # @Return: None
     #**********************************************************************
     def _recv_manager(self):
-        while True:
-            old_cache = self._recv_cache
-            self._recv_cache = self.pop3.uidl()
+        # load the processed email hash, the emails arrived while emailbot is
+        # stopped will be received at the first polling
+        if config.RECV_STORE != "" and self._recv_store == None:
+            self._recv_store = store.UIDStore(config.RECV_STORE)
 
+        while True:
+            # one pop3 session for each polling, the uidl() and all the
+            # following recv() share the same connection
+            start = time.perf_counter()
+            with self.pop3.session() as session:
+                ready = self._recv_poll(session)
+            metrics.POLL_SECONDS.observe(time.perf_counter() - start, "pop3")
             # _recv_manager() need initialize or get uidl error
-            if old_cache == None or self._recv_cache == None:
+            if not ready:
+                time.sleep(10)
+                continue
+            time.sleep(60)
+        # end while
+    # end _recv_manager()
+
+    #**********************************************************************
+    # @Function: _recv_poll(self, session)
+    # @Description: poll the uidl() list once, and receive the new emails then
+    #   route them by rules
+    # @Parameter: session, the connected POP3Session object
+    # @Return: ready, False when need initialize or get uidl error
+    #**********************************************************************
+    def _recv_poll(self, session):
+        lines = session.uidl()
+        if lines == None:
+            return False
+        metrics.UIDL_SIZE.set(len(lines))
+
+        # the persisted hash is used to find new emails, unless the store is
+        # just created, it needs to be initialized like the memory cache
+        seen = self._recv_cache
+        if self._recv_store != None and not self._recv_store.created:
+            seen = self._recv_store
+        self._recv_cache, news = self._diff_uidl(seen, lines)
+
+        # _recv_manager() need initialize
+        if seen == None:
+            if self._recv_store != None:
+                self._recv_store.update(self._recv_cache)
+            return False
+        # end if
+
+        # receive or one or more emails
+        for i, h in news:
+            # check the headers first, skip the email which no rule cares
+            if config.POP3_TOP and self._skip_by_headers(session.top(i)):
+                if self._recv_store != None:
+                    self._recv_store.add(h)
+                continue
+            # receive new email
+            e = session.recv(i)
+            if e == None:
+                continue
+            logger.info("receive new email [%s] by %s" % (e.subject, e.sender))
+            # rule check and execute
+            self._route_by_rules(self, e)
+            # the email is processed, it will not be received again even if
+            # emailbot restart
+            if self._recv_store != None:
+                self._recv_store.add(h)
+        # end for
+
+        if self._recv_store != None:
+            self._recv_store.sync()
+            self._recv_store.retain(self._recv_cache)
+        return True
+    # end _recv_poll()
+
+    #**********************************************************************
+    # @Function: _imap_manager(self)
+    # @Description: receiver email manager by IMAP, keep one long-lived IMAP
+    #   connection, and wait for new email by IDLE push. the uid of IMAP is
+    #   strictly ascending, so the emails which uid is greater than the last
+    #   processed uid are new emails, only them are searched and fetched.
+    #
+    #   the sync is incremental, the UIDVALIDITY and the last processed uid
+    #   are kept(and persisted if "IMAP_STATE" is set), the mailbox status is
+    #   reported by the untagged responses of SELECT/NOOP/IDLE (not STATUS,
+    #   rfc3501 forbids it on the selected mailbox); the search is skipped
+    #   unless the server reports new emails, or the HIGHESTMODSEQ(CONDSTORE)
+    #   and UIDNEXT of SELECT show something changed since last sync; so the
+    #   cost of each polling is O(new emails), not O(mailbox).
+    #   if the UIDVALIDITY is changed, the old uid is invalid, we initialize
+    #   the state with the newest email again.
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _imap_manager(self):
+        state = store.IMAPState(config.IMAP_STATE)
+        while True:
+            # connect or reconnect the imap session
+            if not self.imap.connect():
                 time.sleep(10)
                 continue
             # end if
 
-            # find new email start position
-            # we start to compare the last item of old_cache with the new
-            # result. if it is not found, it means that the last email has been
-            # deleted. use the previous item of old_cache to continue to find
-            # the starting position of the new email.
-            position = -1
-            for oc in reversed(old_cache):
-                for nc in reversed(self._recv_cache):
-                    _, ohash = self._parse_uidl_line(oc)
-                    nid, nhash = self._parse_uidl_line(nc)
-                    if ohash == nhash:
-                        position = nid
-                        break
-                # end for
-                if position >= 0:
-                    break
-            # end for
+            start = time.perf_counter()
+            synced = self._imap_sync(state)
+            metrics.POLL_SECONDS.observe(time.perf_counter() - start, "imap")
+            if not synced:
+                time.sleep(10)
+                continue
+            # end if
+            # the reported new emails have been received
+            self.imap.changed = False
 
-            # receive or one or more emails
-            for i in range(position+1, len(self._recv_cache)+1):
-                # receive new email
-                e = self.pop3.recv(i)
-                if e == None:
-                    continue
-                logger.info("receive new email [%s] by %s" % (e.subject, e.sender))
-                # rule check and execute
-                self._route_by_rules(self, e)
-            # end for
-            time.sleep(60)
+            if self.imap.idle:
+                self.imap.wait(config.IMAP_IDLE_TIMEOUT)
+            else:
+                self.imap.wait(config.IMAP_POLL_INTERVAL)
         # end while
-    # end _recv_manager()
+    # end _imap_manager()
+
+    #**********************************************************************
+    # @Function: _imap_sync(self, state)
+    # @Description: sync the imap mailbox once, receive the new emails then
+    #   route them by rules
+    # @Parameter: state, the IMAPState object
+    # @Return: status, False when the imap command error
+    #**********************************************************************
+    def _imap_sync(self, state):
+        st = self.imap.sync_status()
+        if st == None:
+            return False
+
+        # initialize with the newest email, the existing emails are skipped
+        if state.uidvalidity != st["UIDVALIDITY"] or state.uidvalidity == 0:
+            if state.uidvalidity != 0:
+                logger.warning("imap uidvalidity changed %d => %d, resync" % (
+                    state.uidvalidity, st["UIDVALIDITY"]))
+            last = st["UIDNEXT"] - 1 if st["UIDNEXT"] > 0 else self.imap.last_uid()
+            if last == None:
+                return False
+            state.uidvalidity = st["UIDVALIDITY"]
+            state.last = last
+            state.modseq = st["HIGHESTMODSEQ"]
+            state.save()
+            return True
+        # end if
+
+        # nothing changed since last sync, the HIGHESTMODSEQ and UIDNEXT are
+        # unknown(0) after the server reports new emails
+        if not st["CHANGED"]:
+            return True
+        if st["HIGHESTMODSEQ"] > 0 and st["HIGHESTMODSEQ"] == state.modseq:
+            return True
+        if st["UIDNEXT"] > 0 and st["UIDNEXT"] <= state.last + 1:
+            state.modseq = st["HIGHESTMODSEQ"]
+            state.save()
+            return True
+        # end if
+
+        uids = self.imap.search(state.last)
+        if uids == None:
+            return False
+        for uid in uids:
+            # receive new email
+            e = self.imap.recv(uid)
+            if e == None:
+                # keep the progress, the rest are received by the next sync
+                state.save()
+                return False
+            logger.info("receive new email [%s] by %s" % (e.subject, e.sender))
+            # rule check and execute
+            self._route_by_rules(self, e)
+            # the email is processed, the state is saved once after all the
+            # new emails (at least once if emailbot crashes in the middle)
+            state.last = uid
+        # end for
+
+        state.modseq = st["HIGHESTMODSEQ"]
+        state.save()
+        return True
+    # end _imap_sync()
 
     #**********************************************************************
-    # @Function: _parse_uidl_line(self, line)
-    # @Description: parse uidl single line data
+    # @Function: _diff_uidl(self, cache, lines)
+    # @Description: compare the uidl() list with the cache of the last polling,
+    #   each line is parsed only once and indexed by hash, so the new emails
+    #   are found by hash lookup in O(n), every hash which is not in the cache
+    #   is a new email, no matter where it is located in the list.
     #   the uidl() single response format: b'1 ZC3130-wi6DhoW5iDuIEDhYOkraUbh'
-    # @Parameter: line, the single line uidl data
-    # @Return: (id, hash), the email id and hash
+    # @Parameter: cache, the {hash: id} dict of the last polling, or the
+    #   UIDStore object, or None
+    # @Parameter: lines, the uidl() list of the current polling
+    # @Return: (cache, news), the {hash: id} dict of the current polling and
+    #   the new email (id, hash) list in the order of uidl() list
+    #**********************************************************************
+    def _diff_uidl(self, cache, lines):
+        # the hash is kept as bytes, avoid decoding every line
+        current = {}
+        for line in lines:
+            nid, nhash = line.split(b" ", 1)
+            current[nhash] = int(nid)
+        # end for
+
+        if cache == None:
+            return current, []
+        news = [(nid, nhash) for nhash, nid in current.items() if nhash not in cache]
+        return current, news
+    # end _diff_uidl()
+
+    #**********************************************************************
+    # @Function: _skip_by_headers(self, e)
+    # @Description: check the email headers(sender and subject) with the rules,
+    #   the email body is required only if some rule matches the headers, the
+    #   callback may read the whole email
+    # @Parameter: e, the email object with headers, or None
+    # @Return: skip, return True if no rule matches the headers
     #**********************************************************************
-    def _parse_uidl_line(self, line):
-        # in the current context, the line has been checked, and the default
-        # line is the correct format here 
-        array = line.decode("utf-8").split(" ")
-        return int(array[0]), array[1]
-    # end _parse_uidl_line()
+    def _skip_by_headers(self, e):
+        if e == None:
+            return False
+
+        self.rule_index.sync(self.rule)
+        for r in self.rule_index.candidates(e):
+            if r.match_headers(e):
+                return False
+        # end for
+        logger.info("skip new email [%s] by %s, no rule matches" % (e.subject, e.sender))
+        return True
+    # end _skip_by_headers()
 
     #**********************************************************************
     # @Function: _route_by_rules(self, eb, e)
     # @Description: use all rules to match the content of new emails, when a rule
     #   is successfully matched, subsequent rules will no longer match.
     #   priority of routing rules, subject to the order of addition.
-    #   between multiple conditions is AND
+    #   between multiple conditions is AND; only the candidate rules from the
+    #   rule index(sender domain and subject prefix) are matched
     # @Parameter: eb, the emailbot object
     # @Parameter: e, the email object
     # @Return: None
     #**********************************************************************
     def _route_by_rules(self, eb, e):
-        for r in self.rule:
+        self.rule_index.sync(self.rule)
+        for r in self.rule_index.candidates(e):
             if r.execute(eb, e):
                 break
         # end for
@@ -228,8 +698,8 @@ class EmailBot:
             self.password = password
 
         result = False
-        if self.smtp_address == "" and self.pop3_address == "":
-            logger.error("at least one of smtp/pop3 needs to be started")
+        if self.smtp_address == "" and self.pop3_address == "" and self.imap_address == "":
+            logger.error("at least one of smtp/pop3/imap needs to be started")
             return result
 
         # check smtp && pop3 server status and user auth status
@@ -242,7 +712,15 @@ class EmailBot:
             else:
                 result = result & 0
         # end if
-        if self.pop3_address != "":
+        # receive email by imap instead of pop3
+        if self.imap_address != "":
+            self.imap = protocol.IMAP(self.imap_address, self.imap_port,
+                        self.imap_ssl, self.username, self.password)
+            if self.imap.check_status():
+                logger.info("imap server is ready, user auth success")
+            else:
+                result = result & 0
+        elif self.pop3_address != "":
             self.pop3 = protocol.POP3(self.pop3_address, self.pop3_port,
                         self.pop3_ssl, self.username, self.password)
             if self.pop3.check_status():
@@ -276,13 +754,15 @@ class EmailBot:
     # @Function: send_email(self, to, cc="", subject="", content="", attachment="", blocking=False)
     # @Description: the user calls this function to send email.
     #   if blocking=True, the email will be added to the queue to be sent, the
-    #   email will auto sent and retry.
+    #   email will auto sent and retry, it's written into the spool first if
+    #   SEND_SPOOL is set.
     #   if blocking=False, the email will send directly, and return send result
     # @Parameter: to, the email receiver
     # @Parameter: cc="", the email carbon copy
     # @Parameter: subject="", the email subject
     # @Parameter: content="", the email content
-    # @Parameter: attachment="", the email attachment file path
+    # @Parameter: attachment="", the email attachment file path, or the list of
+    #   file paths
     # @Parameter: blocking=False, blocking or not send mode
     # @Return: None
     #**********************************************************************
@@ -297,15 +777,168 @@ class EmailBot:
 
         # blocking send mode
         if blocking:
-            return self.smtp.send(e)
+            code, _ = self._send_direct([e])[0]
+            return code == 250
 
         # non-blocking send mode
-        # add new email into send queue
-        self._mutex.acquire()
-        self._send_queue.append(e)
-        self._mutex.release()
+        if not self._queue_email(e):
+            return False
     # end send_email()
 
+    #**********************************************************************
+    # @Function: _queue_email(self, e)
+    # @Description: add new email into spool and send queue
+    # @Parameter: e, the mime email object
+    # @Return: status, return False when the email can't be spooled
+    #**********************************************************************
+    def _queue_email(self, e):
+        task = sendqueue.SendTask(e)
+        if self._spool != None:
+            try:
+                task.key = self._spool.put(e)
+            except OSError as err:
+                logger.error("spool email [%s] failed (%s)" % (e.subject, err))
+                return False
+        # end if
+        self._send_queue.put(task)
+        self._notify_send()
+        return True
+    # end _queue_email()
+
+    #**********************************************************************
+    # @Function: _build_many(self, recipients, subject, content, attachment)
+    # @Description: render the emails of "send_many()" by "mime.Template",
+    #   the recipients with the same rendered subject and content are folded
+    #   into one email (at most SEND_MANY_RCPT recipients)
+    # @Parameter: recipients, the address list, or (address, variables) list
+    # @Parameter: subject, the subject template
+    # @Parameter: content, the content template
+    # @Parameter: attachment, the attachment file path, or the list of paths
+    # @Return: (emails, owners), the email list and the address list of each
+    #**********************************************************************
+    def _build_many(self, recipients, subject, content, attachment):
+        template = mime.Template(self.username, subject, content, attachment)
+        # group the recipients by rendered subject and content in order
+        groups = {}
+        for item in recipients:
+            addr, variables = (item, {}) if isinstance(item, str) else item
+            key = template.fill(dict({"to": addr}, **variables))
+            groups.setdefault(key, []).append(addr)
+        # end for
+
+        emails, owners = [], []
+        for (s, c), addrs in groups.items():
+            for i in range(0, len(addrs), config.SEND_MANY_RCPT):
+                chunk = addrs[i:i+config.SEND_MANY_RCPT]
+                if len(chunk) == 1:
+                    e = template.build(chunk[0], s, c)
+                else:
+                    # the recipients don't see each other
+                    e = template.build("undisclosed-recipients:;", s, c, bcc=", ".join(chunk))
+                emails.append(e)
+                owners.append(chunk)
+            # end for
+        # end for
+        return emails, owners
+    # end _build_many()
+
+    #**********************************************************************
+    # @Function: send_many(self, recipients, subject="", content="", attachment="", blocking=False)
+    # @Description: send the templated email to many recipients, the subject
+    #   and content are "string.Template", "$to" is the recipient address and
+    #   the others are the recipient variables. the recipients with the same
+    #   rendered email are sent by one SMTP transaction with multiple "RCPT
+    #   TO" (the "To" header is "undisclosed-recipients:;"), and the
+    #   attachments are read and encoded only once. the recipients refused by
+    #   transient failure(4xx, such as 452 too many recipients) are retried by
+    #   their own email in the send queue.
+    #   eg: send_many([("a@x.com", {"name": "a"})], "hi $name", "report")
+    # @Parameter: recipients, the address list, or (address, variables) list
+    # @Parameter: subject="", the email subject template
+    # @Parameter: content="", the email content template
+    # @Parameter: attachment="", the email attachment file path, or the list
+    #   of file paths
+    # @Parameter: blocking=False, send directly and return the results, or add
+    #   the emails into the send queue
+    # @Return: results, the {address: status} dict in blocking mode, the refused
+    #   recipient is False
+    #**********************************************************************
+    def send_many(self, recipients, subject="", content="", attachment="", blocking=False):
+        # check smtp object is ready
+        if self.smtp == None:
+            logger.error("smtp server not initialize")
+            return
+
+        emails, owners = self._build_many(recipients, subject, content, attachment)
+        logger.info("send email [%s] to %d recipients by %d emails" % (
+            subject, sum(len(o) for o in owners), len(emails)))
+
+        # blocking send mode
+        if blocking:
+            results = {}
+            for addrs, (code, refused) in zip(owners, self._send_direct(emails)):
+                # the refused recipients are keyed by bare address
+                for addr in addrs:
+                    results[addr] = (refused.get(parseaddr(addr)[1], code) == 250)
+            # end for
+            return results
+        # end if
+
+        # non-blocking send mode
+        for e in emails:
+            if not self._queue_email(e):
+                return False
+        # end for
+    # end send_many()
+
+    #**********************************************************************
+    # @Function: _notify_send(self)
+    # @Description: wake up the asyncio send manager if it is running, it can
+    #   be called from any thread
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _notify_send(self):
+        wakeup = self._send_wakeup
+        if wakeup != None:
+            loop, event = wakeup
+            loop.call_soon_threadsafe(event.set)
+    # end _notify_send()
+
+    #**********************************************************************
+    # @Function: send_email_async(self, to, cc="", subject="", content="", attachment="", blocking=False)
+    # @Description: the asyncio version of "send_email()", it can be called
+    #   by async callback when emailbot is running by "run_async()".
+    #   if blocking=True, await the email sent and return send result
+    #   if blocking=False, the email will be added to the queue to be sent
+    # @Parameter: to, the email receiver
+    # @Parameter: cc="", the email carbon copy
+    # @Parameter: subject="", the email subject
+    # @Parameter: content="", the email content
+    # @Parameter: attachment="", the email attachment file path, or the list of
+    #   file paths
+    # @Parameter: blocking=False, blocking or not send mode
+    # @Return: status, the send result in blocking mode
+    #**********************************************************************
+    async def send_email_async(self, to, cc="", subject="", content="", attachment="", blocking=False):
+        # check smtp object is ready
+        if self.asmtp == None:
+            logger.error("asyncio smtp not initialize, call run_async() first")
+            return False
+
+        if blocking:
+            e = mime.Email(self.username, to, cc, subject, content, attachment)
+            code, _ = (await self._send_direct_async([e]))[0]
+            return code == 250
+        # the spool may wait for fsync, don't block the event loop
+        if self._spool != None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.send_email, to, cc,
+                                              subject, content, attachment) != False
+        self.send_email(to, cc, subject, content, attachment)
+        return True
+    # end send_email_async()
+
     #**********************************************************************
     # @Function: run(self, daemon=False)
     # @Description: the emailbot launch entrypoint
@@ -314,10 +947,14 @@ class EmailBot:
     # @Return: None
     #**********************************************************************
     def run(self, daemon=False):
-        # "login()" is not called, or neither smtp/pop3 is set
-        if self.smtp_address == "" and self.pop3_address == "":
-            logger.critical("at least one of smtp/pop3 needs to be started")
+        # "login()" is not called, or neither smtp/pop3/imap is set
+        if self.smtp_address == "" and self.pop3_address == "" and self.imap_address == "":
+            logger.critical("at least one of smtp/pop3/imap needs to be started")
             return
+        if config.METRICS_PORT > 0:
+            metrics.serve(config.METRICS_ADDRESS, config.METRICS_PORT)
+        if profiler.PROFILER != None and config.PROFILE_SIGNAL != "":
+            profiler.PROFILER.install(config.PROFILE_SIGNAL)
 
         # user want to use smtp(send email)
         if self.smtp_address != "":
@@ -329,8 +966,16 @@ class EmailBot:
             ts.start()
         # end if
 
+        # user want to use imap(receive email)
+        if self.imap_address != "":
+            if self.imap == None or self.imap.status == False:
+                logger.error("imap/user status is not ready")
+                return
+            logger.info("initialize recv email manager by imap")
+            tr = threading.Thread(target=self._imap_manager)
+            tr.start()
         # user want to use pop3(receive email)
-        if self.pop3_address != "":
+        elif self.pop3_address != "":
             if self.pop3 == None or self.pop3.status == False:
                 logger.error("pop3/user status is not ready")
                 return
@@ -338,15 +983,339 @@ class EmailBot:
             tr = threading.Thread(target=self._recv_manager)
             tr.start()
         # end if
+        # replay the callbacks spilled before restart, without waiting for
+        # the new emails
+        if self.pop3_address != "" or self.imap_address != "":
+            self.executor.start()
 
         # set daemon
         if daemon == False:
             if self.smtp_address != "":
                 ts.join()
-            if self.pop3_address != "":
+            if self.pop3_address != "" or self.imap_address != "":
                 tr.join()
         # end if
     # end run()
+
+    #**********************************************************************
+    # @Function: _callback_done(self, future)
+    # @Description: the async callback task is done, log its exception and
+    #   release the concurrency limit
+    # @Parameter: future, the asyncio task
+    # @Return: None
+    #**********************************************************************
+    def _callback_done(self, future):
+        self._tasks.discard(future)
+        self._async_limit.release()
+        if not future.cancelled() and future.exception() != None:
+            logger.error("callback failed (%s)" % future.exception())
+    # end _callback_done()
+
+    #**********************************************************************
+    # @Function: _callback_async(self, callback, e, regx)
+    # @Description: run the "async def" callback, and count its duration
+    # @Parameter: callback, the callback function
+    # @Parameter: e, regx, the arguments of callback function
+    # @Return: None
+    #**********************************************************************
+    async def _callback_async(self, callback, e, regx):
+        start = time.perf_counter()
+        try:
+            await callback(self, e, regx)
+        finally:
+            cost = time.perf_counter() - start
+            metrics.CALLBACK_SECONDS.observe(cost, callback.__name__)
+            if profiler.PROFILER != None:
+                profiler.PROFILER.callback(callback, cost)
+    # end _callback_async()
+
+    #**********************************************************************
+    # @Function: _route_by_rules_async(self, e)
+    # @Description: the asyncio version of "_route_by_rules()", the "async def"
+    #   callback runs as task in the event loop, at most CALLBACK_WORKERS tasks
+    #   run concurrently; and the normal callback is submitted to the bounded
+    #   executor from the default executor thread, so the event loop is never
+    #   blocked by callback, and the queue policy works as well.
+    # @Parameter: e, the email object
+    # @Return: None
+    #**********************************************************************
+    async def _route_by_rules_async(self, e):
+        loop = asyncio.get_running_loop()
+        self.rule_index.sync(self.rule)
+        for r in self.rule_index.candidates(e):
+            match, regx = r.match(e)
+            if not match:
+                continue
+
+            logger.info("MATCH %s" % r)
+            if asyncio.iscoroutinefunction(r.callback):
+                if self._async_limit == None:
+                    self._async_limit = asyncio.Semaphore(config.CALLBACK_WORKERS)
+                await self._async_limit.acquire()
+                task = loop.create_task(self._callback_async(r.callback, e, regx))
+                self._tasks.add(task)
+                task.add_done_callback(self._callback_done)
+            else:
+                await loop.run_in_executor(None, self.executor.submit,
+                        r.callback, self, e, regx)
+            break
+        # end for
+    # end _route_by_rules_async()
+
+    #**********************************************************************
+    # @Function: _send_manager_async(self)
+    # @Description: the asyncio version of "_send_manager()", multiple sending
+    #   coroutines(SEND_WORKERS) take batches of emails from the queue, and
+    #   send each batch over one smtp session, they are woken
+    #   up by "send_email()" immediately. when the sending is wrong, the email
+    #   is rescheduled by "_send_retry()".
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    async def _send_manager_async(self):
+        event = asyncio.Event()
+        self._send_wakeup = (asyncio.get_running_loop(), event)
+
+        async def sender():
+            while True:
+                held = set()
+                tasks = self._send_queue.get_batch(self._send_batch_size(), timeout=0,
+                        accept=lambda task: self._send_accept(task, held))
+                if len(tasks) == 0:
+                    # wait for new email, or the next delayed email is due, or
+                    # the send rate allows
+                    due = self._send_queue.next_due()
+                    try:
+                        await asyncio.wait_for(event.wait(), 10 if due == None else min(10, due))
+                    except asyncio.TimeoutError:
+                        pass
+                    event.clear()
+                    continue
+                # end if
+
+                for task in tasks:
+                    logger.info("send email [%s] to %s" % (task.email.subject, task.email.receiver))
+                start = time.perf_counter()
+                try:
+                    results = await self.asmtp.send_batch([task.email for task in tasks])
+                finally:
+                    self._send_limit.release(held)
+                    event.set()
+                metrics.SEND_BATCH_SECONDS.observe(time.perf_counter() - start)
+                self._send_results(tasks, results)
+            # end while
+        # end sender()
+
+        await asyncio.gather(*[sender() for _ in range(config.SEND_WORKERS)])
+    # end _send_manager_async()
+
+    #**********************************************************************
+    # @Function: _recv_manager_async(self)
+    # @Description: the asyncio version of "_recv_manager()"
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    async def _recv_manager_async(self):
+        if config.RECV_STORE != "" and self._recv_store == None:
+            self._recv_store = store.UIDStore(config.RECV_STORE)
+
+        while True:
+            start = time.perf_counter()
+            async with self.apop3.session() as session:
+                ready = await self._recv_poll_async(session)
+            metrics.POLL_SECONDS.observe(time.perf_counter() - start, "pop3")
+            if not ready:
+                await asyncio.sleep(10)
+                continue
+            await asyncio.sleep(60)
+        # end while
+    # end _recv_manager_async()
+
+    #**********************************************************************
+    # @Function: _recv_poll_async(self, session)
+    # @Description: the asyncio version of "_recv_poll()"
+    # @Parameter: session, the connected AsyncPOP3Session object
+    # @Return: ready, False when need initialize or get uidl error
+    #**********************************************************************
+    async def _recv_poll_async(self, session):
+        lines = await session.uidl()
+        if lines == None:
+            return False
+        metrics.UIDL_SIZE.set(len(lines))
+
+        seen = self._recv_cache
+        if self._recv_store != None and not self._recv_store.created:
+            seen = self._recv_store
+        self._recv_cache, news = self._diff_uidl(seen, lines)
+
+        if seen == None:
+            if self._recv_store != None:
+                self._recv_store.update(self._recv_cache)
+            return False
+        # end if
+
+        for i, h in news:
+            if config.POP3_TOP and self._skip_by_headers(await session.top(i)):
+                if self._recv_store != None:
+                    self._recv_store.add(h)
+                continue
+            e = await session.recv(i)
+            if e == None:
+                continue
+            logger.info("receive new email [%s] by %s" % (e.subject, e.sender))
+            await self._route_by_rules_async(e)
+            if self._recv_store != None:
+                self._recv_store.add(h)
+        # end for
+
+        if self._recv_store != None:
+            self._recv_store.sync()
+            self._recv_store.retain(self._recv_cache)
+        return True
+    # end _recv_poll_async()
+
+    #**********************************************************************
+    # @Function: _imap_manager_async(self)
+    # @Description: the asyncio version of "_imap_manager()"
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    async def _imap_manager_async(self):
+        state = store.IMAPState(config.IMAP_STATE)
+        while True:
+            if not await self.aimap.connect():
+                await asyncio.sleep(10)
+                continue
+            start = time.perf_counter()
+            synced = await self._imap_sync_async(state)
+            metrics.POLL_SECONDS.observe(time.perf_counter() - start, "imap")
+            if not synced:
+                await asyncio.sleep(10)
+                continue
+            self.aimap.changed = False
+
+            if self.aimap.idle:
+                await self.aimap.wait(config.IMAP_IDLE_TIMEOUT)
+            else:
+                await self.aimap.wait(config.IMAP_POLL_INTERVAL)
+        # end while
+    # end _imap_manager_async()
+
+    #**********************************************************************
+    # @Function: _imap_sync_async(self, state)
+    # @Description: the asyncio version of "_imap_sync()"
+    # @Parameter: state, the IMAPState object
+    # @Return: status, False when the imap command error
+    #**********************************************************************
+    async def _imap_sync_async(self, state):
+        st = await self.aimap.sync_status()
+        if st == None:
+            return False
+
+        if state.uidvalidity != st["UIDVALIDITY"] or state.uidvalidity == 0:
+            if state.uidvalidity != 0:
+                logger.warning("imap uidvalidity changed %d => %d, resync" % (
+                    state.uidvalidity, st["UIDVALIDITY"]))
+            last = st["UIDNEXT"] - 1 if st["UIDNEXT"] > 0 else await self.aimap.last_uid()
+            if last == None:
+                return False
+            state.uidvalidity = st["UIDVALIDITY"]
+            state.last = last
+            state.modseq = st["HIGHESTMODSEQ"]
+            state.save()
+            return True
+        # end if
+
+        if not st["CHANGED"]:
+            return True
+        if st["HIGHESTMODSEQ"] > 0 and st["HIGHESTMODSEQ"] == state.modseq:
+            return True
+        if st["UIDNEXT"] > 0 and st["UIDNEXT"] <= state.last + 1:
+            state.modseq = st["HIGHESTMODSEQ"]
+            state.save()
+            return True
+        # end if
+
+        uids = await self.aimap.search(state.last)
+        if uids == None:
+            return False
+        for uid in uids:
+            e = await self.aimap.recv(uid)
+            if e == None:
+                state.save()
+                return False
+            logger.info("receive new email [%s] by %s" % (e.subject, e.sender))
+            await self._route_by_rules_async(e)
+            state.last = uid
+        # end for
+
+        state.modseq = st["HIGHESTMODSEQ"]
+        state.save()
+        return True
+    # end _imap_sync_async()
+
+    #**********************************************************************
+    # @Function: run_async(self)
+    # @Description: the emailbot asyncio launch entrypoint, the sending and
+    #   receiving are driven by the running event loop with asyncio protocol
+    #   clients, so one event loop can drive many emailbot objects:
+    #     await asyncio.gather(eb1.run_async(), eb2.run_async())
+    #   the rule callback can be "async def" or normal function, the normal
+    #   callback runs in the default executor. "login()" should be called
+    #   before it to check server and user/pass status.
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    async def run_async(self):
+        # "login()" is not called, or neither smtp/pop3/imap is set
+        if self.smtp_address == "" and self.pop3_address == "" and self.imap_address == "":
+            logger.critical("at least one of smtp/pop3/imap needs to be started")
+            return
+        if config.METRICS_PORT > 0:
+            metrics.serve(config.METRICS_ADDRESS, config.METRICS_PORT)
+        if profiler.PROFILER != None and config.PROFILE_SIGNAL != "":
+            profiler.PROFILER.install(config.PROFILE_SIGNAL)
+
+        managers = []
+        # user want to use smtp(send email)
+        if self.smtp_address != "":
+            if self.smtp == None or self.smtp.status == False:
+                logger.error("smtp/user status is not ready")
+                return
+            logger.info("initialize asyncio send email manager")
+            self.asmtp = aioprotocol.AsyncSMTP(self.smtp_address, self.smtp_port,
+                        self.smtp_ssl, self.username, self.password)
+            managers.append(self._send_manager_async())
+        # end if
+
+        # user want to use imap/pop3(receive email)
+        if self.imap_address != "":
+            if self.imap == None or self.imap.status == False:
+                logger.error("imap/user status is not ready")
+                return
+            logger.info("initialize asyncio recv email manager by imap")
+            self.aimap = aioprotocol.AsyncIMAP(self.imap_address, self.imap_port,
+                        self.imap_ssl, self.username, self.password)
+            managers.append(self._imap_manager_async())
+        elif self.pop3_address != "":
+            if self.pop3 == None or self.pop3.status == False:
+                logger.error("pop3/user status is not ready")
+                return
+            logger.info("initialize asyncio recv email manager")
+            self.apop3 = aioprotocol.AsyncPOP3(self.pop3_address, self.pop3_port,
+                        self.pop3_ssl, self.username, self.password)
+            managers.append(self._recv_manager_async())
+        # end if
+        if self.pop3_address != "" or self.imap_address != "":
+            self.executor.start()
+
+        try:
+            await asyncio.gather(*managers)
+        finally:
+            self._send_wakeup = None
+            if self.asmtp != None:
+                self.asmtp.close()
+    # end run_async()
 # end class
 
 #**********************************************************************
@@ -365,6 +1334,8 @@ if __name__ == "__main__":
     parser.add_argument("--smtpssl",  type=bool, default=False, help="connect SMTP server with ssl")
     parser.add_argument("--pop3",     type=str, default="", help="POP3 server address(address:port)")
     parser.add_argument("--pop3ssl",  type=bool, default=False, help="connect POP3 server with ssl")
+    parser.add_argument("--imap",     type=str, default="", help="IMAP server address(address:port)")
+    parser.add_argument("--imapssl",  type=bool, default=False, help="connect IMAP server with ssl")
 
     parser.add_argument("-v", "--version", help="print emailbot version", action="store_true")
     args = parser.parse_args()
@@ -377,15 +1348,17 @@ if __name__ == "__main__":
     # parse smtp/pop3 server address and port
     smtp, smtpport = utils.parse_args_server(args.smtp)
     pop3, pop3port = utils.parse_args_server(args.pop3)
+    imap, imapport = utils.parse_args_server(args.imap)
 
     # launch emailbot
     logger.info("launch Emailbot ...")
     eb = EmailBot(smtp=smtp, smtp_port=smtpport, smtp_ssl=args.smtpssl,
-                  pop3=pop3, pop3_port=pop3port, pop3_ssl=args.pop3ssl)
+                  pop3=pop3, pop3_port=pop3port, pop3_ssl=args.pop3ssl,
+                  imap=imap, imap_port=imapport, imap_ssl=args.imapssl)
 
     status = eb.login(args.username, args.password)
     if not status:
-        logger.error("Emailbot check SMTP/POP3/USER failed") 
+        logger.error("Emailbot check SMTP/POP3/IMAP/USER failed") 
         exit(0)
 
     #eb.add_rule()
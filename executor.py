@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: executor.py
+Description: the bounded executor of rule callback functions
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import os
+import pickle
+import queue
+import threading
+import time
+
+import metrics
+import mime
+import profiler
+from utils import logger
+
+#**********************************************************************
+# @Class: CallbackExecutor
+# @Description: execute the rule callbacks by a fixed number of worker
+#   threads, the callbacks are waiting in a bounded queue. when the queue is
+#   full, it works by the policy:
+#     "block": the submitter(receive manager) waits until there is room
+#     "drop":  the callback is dropped and logged
+#     "spill": the callback is pickled into the spill directory, and it will
+#              be loaded back when there is room (also after restart)
+#   the queue depth and callback latency are counted, see "stats()".
+#**********************************************************************
+class CallbackExecutor:
+    #**********************************************************************
+    # @Function: __init__(self, workers, size, policy="block", spill="",
+    #   emailbot=None)
+    # @Description: CallbackExecutor object initialize, the worker threads
+    #   are started by "start()" or the first "submit()"
+    # @Parameter: workers, the number of worker threads
+    # @Parameter: size, the max number of callbacks waiting in the queue
+    # @Parameter: policy="block", the full queue policy, "block"/"drop"/"spill"
+    # @Parameter: spill="", the spill directory, required by "spill" policy
+    # @Parameter: emailbot=None, the emailbot object of spilled callbacks, the
+    #   callbacks spilled before restart are loaded back with it; otherwise
+    #   the emailbot of the first spilled callback is used
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, workers, size, policy="block", spill="", emailbot=None):
+        self.workers = workers
+        self.size    = size
+        self.policy  = policy
+        self.spill   = spill
+        if self.policy == "spill" and self.spill == "":
+            logger.warning("callback spill directory is not set, block instead")
+            self.policy = "block"
+
+        self._queue   = queue.Queue(size)
+        self._threads = []
+        self._mutex   = threading.Lock()
+        # the emailbot object of spilled callbacks, it can't be pickled
+        self._emailbot = emailbot
+        self._seq      = 0
+
+        # statistics
+        self.submitted = 0
+        self.completed = 0
+        self.failed    = 0
+        self.dropped   = 0
+        self.spilled   = 0
+        self.latency_total = 0.0
+        self.latency_max   = 0.0
+
+        # the spilled callbacks which are not loaded back
+        self._pending = 0
+        if self.policy == "spill":
+            os.makedirs(self.spill, exist_ok=True)
+            # the claimed files are not loaded before restart
+            for name in os.listdir(self.spill):
+                if name.endswith(".spill.loading"):
+                    path = os.path.join(self.spill, name)
+                    os.replace(path, path[:-len(".loading")])
+            # end for
+            self._pending = len(self._spill_files())
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: start(self)
+    # @Description: start the worker threads if they are not running, the
+    #   pending spilled callbacks are loaded back by the workers
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def start(self):
+        if len(self._threads) > 0:
+            return
+
+        self._mutex.acquire()
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self._threads.append(t)
+        self._mutex.release()
+    # end start()
+
+    #**********************************************************************
+    # @Function: submit(self, callback, emailbot, email, regx)
+    # @Description: submit the callback into the queue
+    # @Parameter: callback, the callback function
+    # @Parameter: emailbot, email, regx, the arguments of callback function
+    # @Return: status, return False when the callback is dropped
+    #**********************************************************************
+    def submit(self, callback, emailbot, email, regx):
+        self.start()
+        task = (callback, emailbot, email, regx)
+        self._mutex.acquire()
+        self.submitted += 1
+        self._mutex.release()
+
+        if self.policy == "block":
+            self._queue.put(task)
+            return True
+
+        # keep the order, the new callback is spilled behind the pending ones
+        if self.policy != "spill" or self._pending == 0:
+            try:
+                self._queue.put_nowait(task)
+                return True
+            except queue.Full:
+                pass
+        # end if
+
+        if self.policy == "spill" and self._spill(task):
+            return True
+
+        logger.warning("callback queue is full, drop %s" % callback.__name__)
+        self._mutex.acquire()
+        self.dropped += 1
+        self._mutex.release()
+        return False
+    # end submit()
+
+    #**********************************************************************
+    # @Function: _spill_files(self)
+    # @Description: get the spilled callback files in order
+    # @Parameter: None
+    # @Return: list, the file name list
+    #**********************************************************************
+    def _spill_files(self):
+        return sorted(f for f in os.listdir(self.spill) if f.endswith(".spill"))
+    # end _spill_files()
+
+    #**********************************************************************
+    # @Function: _spill(self, task)
+    # @Description: pickle the callback and its arguments into spill directory,
+    #   the email is saved as MIME source(str or bytes), the callback should be
+    #   a module level function which can be pickled
+    # @Parameter: task, the (callback, emailbot, email, regx) tuple
+    # @Return: status, return False when the callback can't be pickled
+    #**********************************************************************
+    def _spill(self, task):
+        callback, emailbot, email, regx = task
+        try:
+            source = email.source
+            # the email is parsed from stream
+            if not isinstance(source, (str, bytes)):
+                source = source.as_bytes()
+            data = pickle.dumps((callback, source, regx))
+        except Exception as e:
+            logger.error("callback %s can't be spilled (%s)" % (callback.__name__, e))
+            return False
+
+        self._mutex.acquire()
+        if self._emailbot == None:
+            self._emailbot = emailbot
+        self._seq += 1
+        name = "%020d-%06d.spill" % (time.time_ns(), self._seq % 1000000)
+        self._mutex.release()
+
+        path = os.path.join(self.spill, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+        self._mutex.acquire()
+        self._pending += 1
+        self.spilled += 1
+        self._mutex.release()
+        return True
+    # end _spill()
+
+    #**********************************************************************
+    # @Function: _unspill(self)
+    # @Description: load the spilled callbacks back to the queue while there
+    #   is room, the file is claimed by renaming to ".loading", so the workers
+    #   load the different files without holding the mutex
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _unspill(self):
+        if self._emailbot == None:
+            return
+        for name in self._spill_files():
+            if self._queue.full():
+                break
+            path = os.path.join(self.spill, name)
+            try:
+                os.rename(path, path + ".loading")
+            except FileNotFoundError:
+                # claimed by other worker
+                continue
+
+            try:
+                with open(path + ".loading", "rb") as f:
+                    callback, source, regx = pickle.load(f)
+                task = (callback, self._emailbot, mime.Email(source=source), regx)
+                self._queue.put_nowait(task)
+            except queue.Full:
+                # filled by other worker, keep it for the next round
+                os.rename(path + ".loading", path)
+                break
+            except Exception as e:
+                logger.error("load spilled callback %s failed (%s)" % (name, e))
+            os.remove(path + ".loading")
+
+            self._mutex.acquire()
+            self._pending -= 1
+            self._mutex.release()
+        # end for
+    # end _unspill()
+
+    #**********************************************************************
+    # @Function: _worker(self)
+    # @Description: the worker thread, execute the callbacks in the queue
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _worker(self):
+        while True:
+            if self._pending > 0:
+                self._unspill()
+            try:
+                task = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            self._run(task)
+        # end while
+    # end _worker()
+
+    #**********************************************************************
+    # @Function: _run(self, task)
+    # @Description: execute the callback, and count the latency
+    # @Parameter: task, the (callback, emailbot, email, regx) tuple
+    # @Return: None
+    #**********************************************************************
+    def _run(self, task):
+        callback, emailbot, email, regx = task
+        failed = 0
+        start = time.perf_counter()
+        try:
+            callback(emailbot, email, regx)
+        except Exception as e:
+            logger.error("callback %s failed (%s)" % (callback.__name__, e))
+            failed = 1
+        cost = time.perf_counter() - start
+        metrics.CALLBACK_SECONDS.observe(cost, callback.__name__)
+        if profiler.PROFILER != None:
+            profiler.PROFILER.callback(callback, cost)
+
+        self._mutex.acquire()
+        self.completed += 1
+        self.failed += failed
+        self.latency_total += cost
+        self.latency_max = max(self.latency_max, cost)
+        self._mutex.release()
+    # end _run()
+
+    #**********************************************************************
+    # @Function: stats(self)
+    # @Description: get the executor statistics
+    # @Parameter: None
+    # @Return: dict, include queue depth, spilled pending count, callback
+    #   count and latency(seconds)
+    #**********************************************************************
+    def stats(self):
+        self._mutex.acquire()
+        result = {
+            "workers":   self.workers,
+            "queue":     self._queue.qsize(),
+            "pending":   self._pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed":    self.failed,
+            "dropped":   self.dropped,
+            "spilled":   self.spilled,
+            "latency_avg": self.latency_total / self.completed if self.completed > 0 else 0.0,
+            "latency_max": self.latency_max,
+        }
+        self._mutex.release()
+        return result
+    # end stats()
+# end class
@@ -0,0 +1,519 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: fakeserver.py
+Description: the in-process fake SMTP/POP3/IMAP servers, used by benchmark
+    instead of real mailbox
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import hashlib
+import random
+import select
+import socketserver
+import threading
+import time
+
+#**********************************************************************
+# @Class: FakeServer
+# @Description: the base of fake servers, it listens on a random localhost
+#   port, and serves each connection by a thread. the network latency and
+#   the errors can be injected:
+#     latency: the seconds before each reply is sent, the replies of the
+#              pipelined commands are sent together, so it's one round trip
+#     error_rate: the probability of the transient error reply, see the
+#              handlers for which command fails
+#**********************************************************************
+class FakeServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    #**********************************************************************
+    # @Function: __init__(self, handler, latency=0, error_rate=0, seed=0)
+    # @Description: FakeServer object initialize
+    # @Parameter: handler, the request handler class
+    # @Parameter: latency=0, the reply latency seconds
+    # @Parameter: error_rate=0, the error probability, 0 ~ 1
+    # @Parameter: seed=0, the random seed of error injection
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, handler, latency=0, error_rate=0, seed=0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency     = latency
+        self.error_rate  = error_rate
+        self.connections = 0
+        self.commands    = 0
+        self._random = random.Random(seed)
+        self._mutex  = threading.Lock()
+        self._thread = None
+    # end __init__()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+    # end port()
+
+    #**********************************************************************
+    # @Function: start(self)
+    # @Description: serve in a daemon thread
+    # @Parameter: None
+    # @Return: self
+    #**********************************************************************
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+    # end start()
+
+    #**********************************************************************
+    # @Function: stop(self)
+    # @Description: stop serving and close the listen socket
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    # end stop()
+
+    #**********************************************************************
+    # @Function: fail(self)
+    # @Description: decide whether the command fails by error_rate
+    # @Parameter: None
+    # @Return: bool
+    #**********************************************************************
+    def fail(self):
+        if self.error_rate <= 0:
+            return False
+        with self._mutex:
+            return self._random.random() < self.error_rate
+    # end fail()
+# end class
+
+#**********************************************************************
+# @Class: FakeHandler
+# @Description: the base of fake server handlers, read the lines by our own
+#   buffer, and queue the replies until all the received commands are handled,
+#   so the pipelined commands are answered in one round trip
+#**********************************************************************
+class FakeHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+    rbufsize = 0
+
+    def setup(self):
+        super().setup()
+        self._buf = b""
+        self._out = []
+        with self.server._mutex:
+            self.server.connections += 1
+    # end setup()
+
+    #**********************************************************************
+    # @Function: readline(self)
+    # @Description: read a line, the replies are flushed before blocking
+    # @Parameter: None
+    # @Return: bytes, the line with line ending, b"" when it's closed
+    #**********************************************************************
+    def readline(self):
+        while b"\n" not in self._buf:
+            self.flush()
+            data = self.connection.recv(1 << 16)
+            if not data:
+                line, self._buf = self._buf, b""
+                return line
+            self._buf += data
+        # end while
+        line, _, self._buf = self._buf.partition(b"\n")
+        return line + b"\n"
+    # end readline()
+
+    #**********************************************************************
+    # @Function: command(self)
+    # @Description: read a command line, and count it
+    # @Parameter: None
+    # @Return: str, the command without line ending, None when it's closed
+    #**********************************************************************
+    def command(self):
+        line = self.readline()
+        if line == b"":
+            return None
+        with self.server._mutex:
+            self.server.commands += 1
+        return line.decode("utf-8", "replace").rstrip("\r\n")
+    # end command()
+
+    #**********************************************************************
+    # @Function: reply(self, *lines)
+    # @Description: queue the reply lines
+    # @Parameter: lines, the str or bytes lines without line ending
+    # @Return: None
+    #**********************************************************************
+    def reply(self, *lines):
+        for line in lines:
+            if isinstance(line, str):
+                line = line.encode("utf-8")
+            self._out.append(line + b"\r\n")
+        # end for
+    # end reply()
+
+    #**********************************************************************
+    # @Function: flush(self, force=False)
+    # @Description: send the queued replies after the latency, unless more
+    #   commands are pending
+    # @Parameter: force=False, send even if the commands are pending
+    # @Return: None
+    #**********************************************************************
+    def flush(self, force=False):
+        if len(self._out) == 0:
+            return
+        if not force and select.select([self.connection], [], [], 0)[0]:
+            return
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.wfile.write(b"".join(self._out))
+        self._out = []
+    # end flush()
+# end class
+
+#**********************************************************************
+# @Class: SMTPHandler
+# @Description: the fake SMTP session, it accepts any AUTH, and supports
+#   PIPELINING if the server enables it. the injected error is the RCPT reply
+#   of server error_code(default 451, the transient error), and the RCPT
+#   beyond max_rcpt of a transaction is refused by 452
+#**********************************************************************
+class SMTPHandler(FakeHandler):
+    def handle(self):
+        srv = self.server
+        self.reply("220 emailbot fake smtp")
+        rcpts = []
+        while True:
+            cmd = self.command()
+            if cmd == None:
+                return
+            verb = cmd[:4].upper()
+            if verb == "EHLO":
+                self.reply("250-fake", "250-AUTH PLAIN LOGIN", "250-8BITMIME")
+                if srv.pipelining:
+                    self.reply("250-PIPELINING")
+                self.reply("250 SMTPUTF8")
+            elif verb == "HELO":
+                self.reply("250 fake")
+            elif verb == "AUTH":
+                self.reply("235 authenticated")
+            elif verb == "MAIL":
+                rcpts = []
+                self.reply("250 ok")
+            elif verb == "RCPT":
+                if srv.fail():
+                    self.reply("%d try again later" % srv.error_code)
+                elif srv.max_rcpt > 0 and len(rcpts) >= srv.max_rcpt:
+                    self.reply("452 too many recipients")
+                else:
+                    rcpts.append(cmd.partition(":")[2].strip().strip("<>"))
+                    self.reply("250 ok")
+            elif verb == "DATA":
+                if len(rcpts) == 0:
+                    self.reply("554 no valid recipients")
+                    continue
+                self.reply("354 end with .")
+                self.flush(force=True)
+                data = []
+                while True:
+                    line = self.readline()
+                    if line == b"":
+                        # the unterminated DATA is discarded like the real server
+                        return
+                    if line in (b".\r\n", b".\n"):
+                        break
+                    data.append(line[1:] if line.startswith(b"..") else line)
+                # end while
+                srv.deliver(b"".join(data), rcpts)
+                self.reply("250 queued")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 ok")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                self.flush(force=True)
+                return
+            else:
+                self.reply("502 not implemented")
+        # end while
+    # end handle()
+# end class
+
+#**********************************************************************
+# @Class: SMTPServer
+# @Description: the fake SMTP server, the delivered emails are kept with the
+#   arrival time
+#**********************************************************************
+class SMTPServer(FakeServer):
+    def __init__(self, latency=0, error_rate=0, error_code=451, pipelining=True, seed=0,
+                 max_rcpt=0):
+        super().__init__(SMTPHandler, latency, error_rate, seed)
+        self.error_code = error_code
+        self.pipelining = pipelining
+        self.max_rcpt   = max_rcpt
+        # the (perf_counter time, email bytes) list
+        self.messages = []
+        # the recipient list of each message
+        self.envelopes = []
+    # end __init__()
+
+    def deliver(self, data, rcpts):
+        with self._mutex:
+            self.messages.append((time.perf_counter(), data))
+            self.envelopes.append(rcpts)
+    # end deliver()
+# end class
+
+#**********************************************************************
+# @Class: POP3Handler
+# @Description: the fake POP3 session, the mailbox is snapshotted at login
+#   like the real server. the injected error is the "-ERR" reply of RETR
+#**********************************************************************
+class POP3Handler(FakeHandler):
+    def handle(self):
+        srv = self.server
+        self.reply("+OK emailbot fake pop3")
+        box = srv.snapshot()
+        while True:
+            cmd = self.command()
+            if cmd == None:
+                return
+            args = cmd.split()
+            if len(args) == 0:
+                continue
+            verb = args[0].upper()
+            if verb in ("USER", "PASS", "NOOP", "RSET"):
+                self.reply("+OK")
+            elif verb == "STAT":
+                self.reply("+OK %d %d" % (len(box), sum(len(m) for _, m in box)))
+            elif verb in ("UIDL", "LIST") and len(args) > 1:
+                i = int(args[1])
+                uid, m = box[i-1]
+                self.reply("+OK %d %s" % (i, uid if verb == "UIDL" else len(m)))
+            elif verb in ("UIDL", "LIST"):
+                self.reply("+OK")
+                self.reply(*["%d %s" % (i, uid if verb == "UIDL" else len(m))
+                             for i, (uid, m) in enumerate(box, 1)])
+                self.reply(".")
+            elif verb in ("RETR", "TOP"):
+                i = int(args[1])
+                if i < 1 or i > len(box) or (verb == "RETR" and srv.fail()):
+                    self.reply("-ERR no such message")
+                    continue
+                m = box[i-1][1]
+                if verb == "TOP":
+                    m = m.split(b"\r\n\r\n", 1)[0] + b"\r\n"
+                lines = [b"." + l if l.startswith(b".") else l for l in m.split(b"\r\n")]
+                self.reply("+OK", b"\r\n".join(lines), ".")
+            elif verb == "QUIT":
+                self.reply("+OK bye")
+                self.flush(force=True)
+                return
+            else:
+                self.reply("-ERR unknown command")
+        # end while
+    # end handle()
+# end class
+
+#**********************************************************************
+# @Class: POP3Server
+# @Description: the fake POP3 server, the mailbox is the (uid, email bytes)
+#   list, the uid is the md5 of email
+#**********************************************************************
+class POP3Server(FakeServer):
+    def __init__(self, latency=0, error_rate=0, seed=0):
+        super().__init__(POP3Handler, latency, error_rate, seed)
+        self.mailbox = []
+    # end __init__()
+
+    def add(self, *messages):
+        items = [(hashlib.md5(m).hexdigest(), m) for m in messages]
+        with self._mutex:
+            self.mailbox.extend(items)
+    # end add()
+
+    def snapshot(self):
+        with self._mutex:
+            return list(self.mailbox)
+    # end snapshot()
+# end class
+
+#**********************************************************************
+# @Class: IMAPHandler
+# @Description: the fake IMAP session, it supports the commands used by
+#   EmailBot: CAPABILITY, LOGIN, SELECT/EXAMINE, UID SEARCH, UID FETCH, NOOP,
+#   IDLE and LOGOUT. the new email is reported by "EXISTS" to the IDLE session
+#   and NOOP. the injected error is the "NO" reply of UID FETCH
+#**********************************************************************
+class IMAPHandler(FakeHandler):
+    def handle(self):
+        srv = self.server
+        self.idling = None
+        # the mailbox size known by the client
+        self.exists = 0
+        srv.attach(self)
+        try:
+            self._serve()
+        finally:
+            srv.detach(self)
+    # end handle()
+
+    def _serve(self):
+        srv = self.server
+        self.reply("* OK emailbot fake imap ready")
+        while True:
+            cmd = self.command()
+            if cmd == None:
+                return
+            if self.idling != None:
+                if cmd.upper() == "DONE":
+                    with srv._mutex:
+                        tag, self.idling = self.idling, None
+                    self.reply("%s OK IDLE terminated" % tag)
+                continue
+            # end if
+
+            args = cmd.split(" ")
+            tag, verb = args[0], args[1].upper() if len(args) > 1 else ""
+            uidnext, uidvalidity, modseq = srv.status()
+            if verb in ("SELECT", "EXAMINE"):
+                self.exists = uidnext - 1
+            if verb == "CAPABILITY":
+                self.reply("* CAPABILITY IMAP4rev1 IDLE CONDSTORE", tag + " OK done")
+            elif verb == "LOGIN":
+                self.reply(tag + " OK logged in")
+            elif verb in ("SELECT", "EXAMINE"):
+                self.reply("* %d EXISTS" % (uidnext - 1),
+                           "* OK [UIDVALIDITY %d] ok" % uidvalidity,
+                           "* OK [UIDNEXT %d] ok" % uidnext,
+                           "* OK [HIGHESTMODSEQ %d] ok" % modseq,
+                           tag + " OK [READ-ONLY] done")
+            elif verb == "NOOP":
+                # the emails added after the last status are reported
+                if uidnext - 1 > self.exists:
+                    self.exists = uidnext - 1
+                    self.reply("* %d EXISTS" % self.exists)
+                self.reply(tag + " OK done")
+            elif verb == "IDLE":
+                # the emails added after the last status are pushed at once
+                self.flush(force=True)
+                with srv._mutex:
+                    self.idling = tag
+                    self.wfile.write(b"+ idling\r\n")
+                    if len(srv.mailbox) > self.exists:
+                        self.push("* %d EXISTS" % len(srv.mailbox))
+                # end with
+            elif verb == "UID" and len(args) > 3 and args[2].upper() == "SEARCH":
+                uids = list(range(1, uidnext))
+                criteria = args[3:]
+                if criteria[0].upper() == "UID":
+                    # "n:*" always includes the last uid
+                    low = int(criteria[1].split(":")[0])
+                    uids = [u for u in uids if u >= low] or uids[-1:]
+                self.reply("* SEARCH " + " ".join(map(str, uids)), tag + " OK done")
+            elif verb == "UID" and len(args) > 3 and args[2].upper() == "FETCH":
+                uid = int(args[3])
+                m = srv.message(uid)
+                if m == None or srv.fail():
+                    self.reply(tag + " NO fetch failed")
+                    continue
+                self.reply(b"* %d FETCH (UID %d BODY[] {%d}\r\n" % (uid, uid, len(m)) + m + b")",
+                           tag + " OK done")
+            elif verb == "LOGOUT":
+                self.reply("* BYE", tag + " OK done")
+                self.flush(force=True)
+                return
+            else:
+                self.reply(tag + " BAD unknown command")
+        # end while
+    # end _serve()
+
+    #**********************************************************************
+    # @Function: push(self, line)
+    # @Description: push the untagged response to the IDLE session, it should
+    #   be called with the server lock
+    # @Parameter: line, the response line
+    # @Return: None
+    #**********************************************************************
+    def push(self, line):
+        if self.idling != None:
+            self.wfile.write(line.encode("utf-8") + b"\r\n")
+            self.exists = len(self.server.mailbox)
+    # end push()
+# end class
+
+#**********************************************************************
+# @Class: IMAPServer
+# @Description: the fake IMAP server with one mailbox, the uid of the email
+#   is its position in the mailbox
+#**********************************************************************
+class IMAPServer(FakeServer):
+    def __init__(self, latency=0, error_rate=0, seed=0):
+        super().__init__(IMAPHandler, latency, error_rate, seed)
+        self.mailbox     = []
+        self.uidvalidity = 1
+        self._sessions   = set()
+    # end __init__()
+
+    def attach(self, handler):
+        with self._mutex:
+            self._sessions.add(handler)
+    # end attach()
+
+    def detach(self, handler):
+        with self._mutex:
+            self._sessions.discard(handler)
+    # end detach()
+
+    def status(self):
+        with self._mutex:
+            # the modseq is changed by new emails only
+            return len(self.mailbox) + 1, self.uidvalidity, len(self.mailbox) + 1
+    # end status()
+
+    def message(self, uid):
+        with self._mutex:
+            if uid < 1 or uid > len(self.mailbox):
+                return None
+            return self.mailbox[uid-1]
+    # end message()
+
+    def add(self, *messages):
+        with self._mutex:
+            self.mailbox.extend(messages)
+            for handler in self._sessions:
+                try:
+                    handler.push("* %d EXISTS" % len(self.mailbox))
+                except OSError:
+                    pass
+            # end for
+        # end with
+    # end add()
+# end class
+
+#**********************************************************************
+# @Function: make_email(i, sender="alice@example.com", subject="", body="",
+#   size=0)
+# @Description: generate the plaintext email bytes
+# @Parameter: i, the email sequence
+# @Parameter: sender="alice@example.com", the sender address
+# @Parameter: subject="", the subject, "bench <i>" if it's empty
+# @Parameter: body="", the body, "name=bob id=<i>" if it's empty
+# @Parameter: size=0, pad the body to the bytes
+# @Return: bytes
+#**********************************************************************
+def make_email(i, sender="alice@example.com", subject="", body="", size=0):
+    subject = subject or "bench %d" % i
+    body = body or "hello\r\nname=bob\r\nid=%d\r\n" % i
+    if len(body) < size:
+        body += ("x" * 76 + "\r\n") * ((size - len(body)) // 78 + 1)
+    return ("From: %s\r\nTo: bot@example.com\r\nSubject: %s\r\n"
+            "Message-ID: <%d@bench.example.com>\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n\r\n%s" % (
+            sender, subject, i, body)).encode("utf-8")
+# end make_email()
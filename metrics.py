@@ -0,0 +1,515 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: metrics.py
+Description: the in-process metrics of send/receive pipeline
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import bisect
+import http.server
+import inspect
+import threading
+import weakref
+
+from utils import logger
+
+#**********************************************************************
+# @Class: Metric
+# @Description: the base class of metrics, the values are kept by the label
+#   values tuple, and updated with the lock, so the metric can be shared by
+#   all threads
+#**********************************************************************
+class Metric:
+    TYPE = ""
+
+    #**********************************************************************
+    # @Function: __init__(self, name, help, labels=())
+    # @Description: Metric object initialize
+    # @Parameter: name, the metric name
+    # @Parameter: help, the metric description
+    # @Parameter: labels=(), the label names
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, name, help, labels=()):
+        self.name   = name
+        self.help   = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._mutex  = threading.Lock()
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _key(self, labels)
+    # @Description: check the label values
+    # @Parameter: labels, the label values tuple
+    # @Return: tuple
+    #**********************************************************************
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("metric %s requires labels %s" % (self.name, self.labelnames))
+        return tuple(str(v) for v in labels)
+    # end _key()
+
+    #**********************************************************************
+    # @Function: labels(self, *labels)
+    # @Description: bind the label values, the bound metric is updated
+    #   without checking the labels, it's used by the hot path
+    # @Parameter: labels, the label values
+    # @Return: Bound
+    #**********************************************************************
+    def labels(self, *labels):
+        return Bound(self, self._key(labels))
+    # end labels()
+
+    #**********************************************************************
+    # @Function: collect(self)
+    # @Description: get a copy of the values
+    # @Parameter: None
+    # @Return: dict, the {label values: value} dict
+    #**********************************************************************
+    def collect(self):
+        with self._mutex:
+            return dict(self._values)
+    # end collect()
+
+    #**********************************************************************
+    # @Function: _samples(self)
+    # @Description: get the samples in prometheus text format
+    # @Parameter: None
+    # @Return: generator, the (name suffix, labels, value) samples
+    #**********************************************************************
+    def _samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield "", list(zip(self.labelnames, key)), value
+        # end for
+    # end _samples()
+
+    #**********************************************************************
+    # @Function: expose(self)
+    # @Description: format the metric in prometheus text format
+    # @Parameter: None
+    # @Return: str
+    #**********************************************************************
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        for suffix, labels, value in self._samples():
+            if len(labels) > 0:
+                pairs = ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+                lines.append("%s%s{%s} %s" % (self.name, suffix, pairs, _number(value)))
+            else:
+                lines.append("%s%s %s" % (self.name, suffix, _number(value)))
+        # end for
+        return "\n".join(lines) + "\n"
+    # end expose()
+# end class
+
+#**********************************************************************
+# @Class: Counter
+# @Description: the monotonically increasing count
+#**********************************************************************
+class Counter(Metric):
+    TYPE = "counter"
+
+    #**********************************************************************
+    # @Function: inc(self, amount=1, *labels)
+    # @Description: increase the count
+    # @Parameter: amount=1, the increment
+    # @Parameter: labels, the label values
+    # @Return: None
+    #**********************************************************************
+    def inc(self, amount=1, *labels):
+        self._inc(self._key(labels), amount)
+    # end inc()
+
+    def _inc(self, key, amount):
+        with self._mutex:
+            self._values[key] = self._values.get(key, 0) + amount
+    # end _inc()
+# end class
+
+#**********************************************************************
+# @Class: Gauge
+# @Description: the value which can go up and down, or be read from a
+#   function when it's collected
+#**********************************************************************
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    #**********************************************************************
+    # @Function: __init__(self, name, help, labels=())
+    # @Description: Gauge object initialize
+    # @Parameter: name, help, labels, see "Metric"
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # the weak references of value functions, see "add_function()"
+        self._functions = None
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: set(self, value, *labels)
+    # @Description: set the value
+    # @Parameter: value, the new value
+    # @Parameter: labels, the label values
+    # @Return: None
+    #**********************************************************************
+    def set(self, value, *labels):
+        self._set(self._key(labels), value)
+    # end set()
+
+    def _set(self, key, value):
+        with self._mutex:
+            self._values[key] = value
+    # end _set()
+
+    #**********************************************************************
+    # @Function: add_function(self, function)
+    # @Description: read the value from functions when it's collected, the
+    #   value is the sum of all the added functions, such as the queue depth
+    #   of multiple EmailBot objects. the bound method is referenced weakly,
+    #   it's removed when its object is released. the gauge should have no
+    #   label
+    # @Parameter: function, the function which returns the value
+    # @Return: None
+    #**********************************************************************
+    def add_function(self, function):
+        if inspect.ismethod(function):
+            ref = weakref.WeakMethod(function)
+        else:
+            ref = lambda: function
+        with self._mutex:
+            if self._functions == None:
+                self._functions = []
+            self._functions.append(ref)
+        # end with
+    # end add_function()
+
+    #**********************************************************************
+    # @Function: collect(self)
+    # @Description: get a copy of the values
+    # @Parameter: None
+    # @Return: dict, the {label values: value} dict
+    #**********************************************************************
+    def collect(self):
+        with self._mutex:
+            if self._functions == None:
+                return dict(self._values)
+            functions = [ref() for ref in self._functions]
+            self._functions = [ref for ref, f in zip(self._functions, functions) if f != None]
+        # end with
+        try:
+            return {(): sum(f() for f in functions if f != None)}
+        except Exception as e:
+            logger.error(e)
+            return {}
+    # end collect()
+# end class
+
+#**********************************************************************
+# @Class: Histogram
+# @Description: the distribution of observed values, counted by buckets, it's
+#   used for the latency(seconds) and size(bytes)
+#**********************************************************************
+class Histogram(Metric):
+    TYPE = "histogram"
+    # the default buckets of latency seconds
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    #**********************************************************************
+    # @Function: __init__(self, name, help, labels=(), buckets=BUCKETS)
+    # @Description: Histogram object initialize
+    # @Parameter: name, help, labels, see "Metric"
+    # @Parameter: buckets=BUCKETS, the ascending upper bounds of buckets, the
+    #   "+Inf" bucket is added
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: observe(self, value, *labels)
+    # @Description: count the value into its bucket
+    # @Parameter: value, the observed value
+    # @Parameter: labels, the label values
+    # @Return: None
+    #**********************************************************************
+    def observe(self, value, *labels):
+        self._observe(self._key(labels), value)
+    # end observe()
+
+    def _observe(self, key, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._mutex:
+            state = self._values.get(key)
+            if state == None:
+                # the counts of each bucket(not cumulative), sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+        # end with
+    # end _observe()
+
+    #**********************************************************************
+    # @Function: collect(self)
+    # @Description: get a copy of the values
+    # @Parameter: None
+    # @Return: dict, the {label values: {"count", "sum", "buckets"}} dict,
+    #   the buckets is the {upper bound: cumulative count} dict
+    #**********************************************************************
+    def collect(self):
+        with self._mutex:
+            values = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        result = {}
+        for key, counts, total, count in values:
+            cumulative, buckets = 0, {}
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                buckets[bound] = cumulative
+            # end for
+            result[key] = {"count": count, "sum": total, "buckets": buckets}
+        # end for
+        return result
+    # end collect()
+
+    #**********************************************************************
+    # @Function: _samples(self)
+    # @Description: get the samples in prometheus text format
+    # @Parameter: None
+    # @Return: generator, the (name suffix, labels, value) samples
+    #**********************************************************************
+    def _samples(self):
+        for key, value in sorted(self.collect().items()):
+            labels = list(zip(self.labelnames, key))
+            for bound, n in value["buckets"].items():
+                yield "_bucket", labels + [("le", _number(bound))], n
+            yield "_sum", labels, value["sum"]
+            yield "_count", labels, value["count"]
+        # end for
+    # end _samples()
+# end class
+
+#**********************************************************************
+# @Class: Bound
+# @Description: the metric with bound label values, see "Metric.labels()"
+#**********************************************************************
+class Bound:
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key    = key
+    # end __init__()
+
+    def inc(self, amount=1):
+        self.metric._inc(self.key, amount)
+    # end inc()
+
+    def set(self, value):
+        self.metric._set(self.key, value)
+    # end set()
+
+    def observe(self, value):
+        self.metric._observe(self.key, value)
+    # end observe()
+# end class
+
+#**********************************************************************
+# @Class: Registry
+# @Description: the collection of metrics, the metric is registered once by
+#   name, and shared by all the objects
+#**********************************************************************
+class Registry:
+    #**********************************************************************
+    # @Function: __init__(self)
+    # @Description: Registry object initialize
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def __init__(self):
+        self._metrics = {}
+        self._mutex   = threading.Lock()
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: register(self, cls, name, help, labels=(), **kwargs)
+    # @Description: create the metric, or get the registered one of name
+    # @Parameter: cls, the metric class
+    # @Parameter: name, help, labels, kwargs, the arguments of metric class
+    # @Return: metric, the metric object
+    #**********************************************************************
+    def register(self, cls, name, help, labels=(), **kwargs):
+        with self._mutex:
+            metric = self._metrics.get(name)
+            if metric == None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("metric %s is registered as %s" % (name, metric.TYPE))
+            return metric
+        # end with
+    # end register()
+
+    #**********************************************************************
+    # @Function: snapshot(self)
+    # @Description: read all the metrics by python api
+    # @Parameter: None
+    # @Return: dict, the {name: {label values: value}} dict, see "collect()"
+    #   of each metric class
+    #**********************************************************************
+    def snapshot(self):
+        with self._mutex:
+            metrics = list(self._metrics.values())
+        return {m.name: m.collect() for m in metrics}
+    # end snapshot()
+
+    #**********************************************************************
+    # @Function: expose(self)
+    # @Description: format all the metrics in prometheus text format
+    # @Parameter: None
+    # @Return: str
+    #**********************************************************************
+    def expose(self):
+        with self._mutex:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return "".join(m.expose() for m in metrics)
+    # end expose()
+# end class
+
+#**********************************************************************
+# @Function: _number(value)
+# @Description: format the number in prometheus text format
+# @Parameter: value, int or float
+# @Return: str
+#**********************************************************************
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+# end _number()
+
+#**********************************************************************
+# @Function: _escape(value)
+# @Description: escape the label value in prometheus text format
+# @Parameter: value, str
+# @Return: str
+#**********************************************************************
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+# end _escape()
+
+# the default registry, all the emailbot metrics are registered in it
+REGISTRY = Registry()
+
+#**********************************************************************
+# @Function: counter(name, help, labels=())
+# @Description: register the counter into the default registry
+# @Parameter: name, help, labels, see "Metric"
+# @Return: Counter
+#**********************************************************************
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter, name, help, labels)
+# end counter()
+
+#**********************************************************************
+# @Function: gauge(name, help, labels=())
+# @Description: register the gauge into the default registry
+# @Parameter: name, help, labels, see "Metric"
+# @Return: Gauge
+#**********************************************************************
+def gauge(name, help, labels=()):
+    return REGISTRY.register(Gauge, name, help, labels)
+# end gauge()
+
+#**********************************************************************
+# @Function: histogram(name, help, labels=(), buckets=Histogram.BUCKETS)
+# @Description: register the histogram into the default registry
+# @Parameter: name, help, labels, buckets, see "Histogram"
+# @Return: Histogram
+#**********************************************************************
+def histogram(name, help, labels=(), buckets=Histogram.BUCKETS):
+    return REGISTRY.register(Histogram, name, help, labels, buckets=buckets)
+# end histogram()
+
+#**********************************************************************
+# @Class: _Handler
+# @Description: the http handler of metrics endpoint, "GET /metrics" returns
+#   the metrics of default registry in prometheus text format
+#**********************************************************************
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    # end do_GET()
+
+    def log_message(self, format, *args):
+        logger.debug("metrics %s %s" % (self.address_string(), format % args))
+    # end log_message()
+# end class
+
+# the running metrics http server
+_server = None
+_server_mutex = threading.Lock()
+
+#**********************************************************************
+# @Function: serve(address, port)
+# @Description: start the metrics http endpoint in a daemon thread, it's
+#   started once, and shared by all the emailbot objects of the process
+# @Parameter: address, the listen address
+# @Parameter: port, the listen port
+# @Return: server, the http server object, None when it can't listen
+#**********************************************************************
+def serve(address, port):
+    global _server
+    with _server_mutex:
+        if _server != None:
+            return _server
+        try:
+            server = http.server.ThreadingHTTPServer((address, port), _Handler)
+        except OSError as e:
+            logger.error(e)
+            return None
+        server.daemon_threads = True
+        t = threading.Thread(target=server.serve_forever, daemon=True)
+        t.start()
+        _server = server
+    # end with
+    logger.info("metrics endpoint http://%s:%d/metrics" % server.server_address[:2])
+    return server
+# end serve()
+
+# the metrics of emailbot pipeline
+POLL_SECONDS    = histogram("emailbot_poll_seconds",
+                            "the duration of mailbox polling", ("protocol",))
+UIDL_SIZE       = gauge("emailbot_uidl_size", "the number of emails in the last uidl() list")
+RECV_EMAILS     = counter("emailbot_recv_emails_total",
+                          "the number of received emails", ("protocol",))
+RECV_BYTES      = counter("emailbot_recv_bytes_total",
+                          "the bytes of received emails(RETR/FETCH)", ("protocol",))
+PARSE_SECONDS   = histogram("emailbot_parse_seconds",
+                            "the duration of parsing email", ("part",))
+RULE_SECONDS    = histogram("emailbot_rule_match_seconds",
+                            "the duration of matching a rule", ("rule",))
+CALLBACK_SECONDS = histogram("emailbot_callback_seconds",
+                             "the duration of rule callback", ("callback",))
+SEND_SECONDS    = histogram("emailbot_send_seconds",
+                            "the latency from queueing an email to its sent")
+SEND_BATCH_SECONDS = histogram("emailbot_send_batch_seconds",
+                               "the duration of sending a batch over smtp session")
+SEND_EMAILS     = counter("emailbot_send_emails_total",
+                          "the number of send results", ("result",))
+SEND_QUEUE      = gauge("emailbot_send_queue_depth", "the number of emails waiting to be sent")
@@ -9,11 +9,27 @@ Author: 0x7F@knownsec404
 Time: 2021.06.25
 """
 
+import base64
+import binascii
+import copy
+import functools
 import mimetypes
+import mmap
 import os
-from email.header import decode_header, make_header
-from email.message import EmailMessage
-from email.parser import Parser
+import re
+import string
+import tempfile
+import time
+import uuid
+from email.header import Header, decode_header, make_header
+from email.message import EmailMessage, Message
+from email.parser import BytesParser, Parser
+from email.policy import SMTP as SMTP_POLICY
+from email.utils import getaddresses
+
+import config
+import metrics
+from utils import logger
 
 #**********************************************************************
 # @Class: Email
@@ -23,7 +39,7 @@ from email.parser import Parser
 class Email:
     #**********************************************************************
     # @Function: __init__(self, sender="", receiver="", cc="", subject="", content="",
-    #            attachment="", source=""):
+    #            attachment="", source="", bcc=""):
     # @Description: Email object initialize, and auto convert another format
     #   set plaintext email content, it will auto convert to MIME, otherwise.
     # @Parameter: sender="", the email sender
@@ -31,27 +47,42 @@ class Email:
     # @Parameter: cc="", the email carbon copy
     # @Parameter: subject="", the email subject
     # @Parameter: content="", the email content
-    # @Parameter: attachment="", the email attachment file path
-    # @Parameter: source="", the MIME email source data
+    # @Parameter: attachment="", the email attachment file path, or the list of
+    #   file paths
+    # @Parameter: source="", the MIME email source data, it can be str, bytes
+    #   or the parsed "email.message.Message" object; or the bytes chunks list
+    #   rendered by "Template", then the fields are given and not parsed
+    # @Parameter: bcc="", the email blind carbon copy, it's only used by SMTP
+    #   "RCPT TO", not in the headers
     # @Return: None
     #**********************************************************************
     def __init__(self, sender="", receiver="", cc="", subject="", content="",
-                attachment="", source=""):
+                attachment="", source="", bcc=""):
         # initliaze field
         self.sender     = sender
         self.receiver   = receiver
         self.cc         = cc
+        self.bcc        = bcc
         self.subject    = subject
+        # the content of received email is parsed on first access
+        self._content   = None
         self.content    = content
         self.attachment = attachment
         self.source     = source
         # MIME object
         self.MIME       = None
+        # the (placeholder, path) list of attachments, the attachment content
+        # is not in MIME object, it's encoded by "stream()"
+        self._attachments = []
+        # the {path: encoded bytes} of attachments, set by "preload()"
+        self._encoded     = {}
+        # the Attachment list of received email, set by "attachments"
+        self._handles     = None
 
         # convert email string to MIME, or MIME source to string
         if self.source == "":
             self._pack()
-        else:
+        elif not isinstance(self.source, list):
             self._unpack()
     # end __init()
 
@@ -74,45 +105,210 @@ class Email:
         # set attachment into MIME if need
         if self.attachment == None or self.attachment == "":
             return
-        # read attachment content
-        try:
-            with open(self.attachment, "rb") as f:
-                data = f.read()
-        except Exception as e:
-            logger.error(e)
+        paths = self.attachment
+        if isinstance(paths, str):
+            paths = [paths]
+        for path in paths:
+            if not os.path.isfile(path):
+                logger.error("attachment %s is not a file" % path)
+                continue
+            # get attachment type
+            types, _ = mimetypes.guess_type(path)
+            if types == None:
+                # no guess could be made, use a generic bag-of-bits type.
+                types = 'application/octet-stream'
+            # end if
+            maintype, subtype = types.split('/')
+            filename = os.path.basename(path)
+            # the attachment content is replaced by placeholder, it's read
+            # and encoded while sending
+            self.MIME.add_attachment(b"", maintype=maintype, subtype=subtype, filename=filename)
+            placeholder = "emailbot-attachment-%s" % uuid.uuid4().hex
+            self.MIME.get_payload()[-1].set_payload(placeholder)
+            self._attachments.append((placeholder, path))
+        # end for
+    # end _pack()
+
+    #**********************************************************************
+    # @Function: _encode_file(self, path, size)
+    # @Description: read the attachment file by chunks and encode with base64
+    # @Parameter: path, the attachment file path
+    # @Parameter: size, the chunk size, it's a multiple of 57 bytes which is
+    #   encoded as a 76 chars line
+    # @Return: generator, the base64 lines chunks, the last line without CRLF
+    #**********************************************************************
+    def _encode_file(self, path, size):
+        with open(path, "rb") as f:
+            data = f.read(size)
+            while data:
+                chunk = base64.encodebytes(data).replace(b"\n", b"\r\n")
+                data = f.read(size)
+                if not data:
+                    chunk = chunk[:-2]
+                yield chunk
+            # end while
+        # end with
+    # end _encode_file()
+
+    #**********************************************************************
+    # @Function: stream(self, size=57*1024)
+    # @Description: generate the MIME email bytes by chunks with CRLF line
+    #   ending, the attachments are streamed from the disk, so the memory is
+    #   bounded regardless of attachment size. the email parsed from bytes
+    #   source (such as the spooled email) is generated as its source
+    # @Parameter: size=57*1024, the attachment reading chunk size
+    # @Return: generator, the email bytes chunks
+    #**********************************************************************
+    def stream(self, size=57*1024):
+        if isinstance(self.source, list):
+            yield from self.source
+            return
+        if self.MIME == None and isinstance(self.source, bytes):
+            for i in range(0, len(self.source), size):
+                yield self.source[i:i+size]
             return
-        # get attachment type
-        types, _ = mimetypes.guess_type(self.attachment)
-        if types == None:
-            # no guess could be made, use a generic bag-of-bits type.
-            types = 'application/octet-stream'
         # end if
-        maintype, subtype = types.split('/')
-        filename = os.path.basename(self.attachment)
-        self.MIME.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename)
-    # end _pack()
+
+        msg = self.MIME
+        if msg == None:
+            msg = self._parse(headersonly=False)
+        data = msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+        for placeholder, path in self._attachments:
+            head, _, data = data.partition(placeholder.encode("ascii"))
+            yield head
+            if path in self._encoded:
+                yield self._encoded[path]
+            else:
+                yield from self._encode_file(path, size)
+        # end for
+        yield data
+    # end stream()
+
+    #**********************************************************************
+    # @Function: preload(self, cache)
+    # @Description: encode the attachments into memory, the cache is shared
+    #   by the emails with the same attachments (see "EmailBot.send_many()"),
+    #   so each attachment file is read and encoded only once
+    # @Parameter: cache, the {path: encoded bytes} dict
+    # @Return: None
+    #**********************************************************************
+    def preload(self, cache):
+        for _, path in self._attachments:
+            if path not in cache:
+                cache[path] = b"".join(self._encode_file(path, 57*1024))
+        # end for
+        self._encoded = cache
+    # end preload()
+
+    #**********************************************************************
+    # @Function: data(self, size=64*1024)
+    # @Description: generate the SMTP "DATA" content by chunks, it's the
+    #   "stream()" with dot-stuffing and the ending "."; the small chunks are
+    #   merged, so the socket is not written with tiny segments
+    # @Parameter: size=64*1024, the min chunk size except the last one
+    # @Return: generator, the DATA bytes chunks
+    #**********************************************************************
+    def data(self, size=64*1024):
+        buf, length = [], 0
+        # the chunk begins at the beginning of line
+        bol = True
+        for chunk in self.stream():
+            if chunk == b"":
+                continue
+            if bol and chunk.startswith(b"."):
+                chunk = b"." + chunk
+            chunk = chunk.replace(b"\n.", b"\n..")
+            bol = chunk.endswith(b"\n")
+            buf.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                yield b"".join(buf)
+                buf, length = [], 0
+        # end for
+        if not bol:
+            buf.append(b"\r\n")
+        buf.append(b".\r\n")
+        yield b"".join(buf)
+    # end data()
+
+    #**********************************************************************
+    # @Function: _parse(self, headersonly)
+    # @Description: parse the MIME email source, the bytes source is parsed
+    #   as it is, so each part is decoded by its own charset
+    # @Parameter: headersonly, only parse the header block
+    # @Return: msg, the MIMEMessage object
+    #**********************************************************************
+    def _parse(self, headersonly):
+        if isinstance(self.source, Message):
+            return self.source
+        if not headersonly:
+            if isinstance(self.source, bytes):
+                return BytesParser().parsebytes(self.source)
+            return Parser().parsestr(self.source)
+        # end if
+
+        # the header block ends with the first empty line
+        crlf, lf = ("\r\n\r\n", "\n\n") if isinstance(self.source, str) else (b"\r\n\r\n", b"\n\n")
+        end = len(self.source)
+        for sep in (crlf, lf):
+            pos = self.source.find(sep)
+            if pos >= 0 and pos < end:
+                end = pos + len(sep)
+        # end for
+        if isinstance(self.source, bytes):
+            return BytesParser().parsebytes(self.source[:end], headersonly=True)
+        return Parser().parsestr(self.source[:end], headersonly=True)
+    # end _parse()
 
     #**********************************************************************
     # @Function: _unpack(self)
-    # @Description: convert MIME email to plaintext
+    # @Description: convert MIME email headers to plaintext, the body is not
+    #   parsed until the "content" is accessed, so the email rejected by the
+    #   header rules is cheap
     # @Parameter: None
     # @Return: None
     #**********************************************************************
     def _unpack(self):
-        # parse the email string to a MIMEMessage object.
-        msg = Parser().parsestr(self.source)
+        start = time.perf_counter()
+        msg = self._parse(headersonly=True)
+        if isinstance(self.source, Message):
+            self.MIME = self.source
 
-        # 1.parse header
         self.sender = self._get_header(msg, "From", "")
         self.receiver = self._get_header(msg, "To", "")
         self.cc = self._get_header(msg, "Cc", "")
         self.subject = self._get_header(msg, "Subject", "")
-
-        # 2.parse body
-        # if the email contains multiple part
-        self.content = self._parse_content(msg)
+        self._content = None
+        metrics.PARSE_SECONDS.observe(time.perf_counter() - start, "headers")
     # end _unpack()
 
+    #**********************************************************************
+    # @Function: content(self)
+    # @Description: the email plaintext content, the received email body is
+    #   parsed and decoded on first access, and the result is cached
+    # @Parameter: None
+    # @Return: str
+    #**********************************************************************
+    @property
+    def content(self):
+        if self._content == None:
+            if self.source == "":
+                return ""
+            # parse the email source to a MIMEMessage object.
+            start = time.perf_counter()
+            msg = self._parse(headersonly=False)
+            # if the email contains multiple part
+            self._content = self._parse_content(msg)
+            metrics.PARSE_SECONDS.observe(time.perf_counter() - start, "content")
+        # end if
+        return self._content
+    # end content()
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+    # end content()
+
     #**********************************************************************
     # @Function: _get_header(self, msg, key, default)
     # @Description: parse email header data from MIME, and decode with UTF-8
@@ -124,8 +320,18 @@ class Email:
     def _get_header(self, msg, key, default):
         # get value by key with default
         value = msg.get(key, default)
+        # the raw 8bit header of bytes source is wrapped as "unknown-8bit"
+        # Header, it's usually utf-8
+        if isinstance(value, Header):
+            raw = b"".join(p if isinstance(p, bytes) else p.encode("utf-8")
+                           for p, _ in decode_header(value))
+            value = raw.decode("utf-8", "replace")
         # decode default method
-        return str(make_header(decode_header(value)))
+        try:
+            return str(make_header(decode_header(value)))
+        except Exception as e:
+            logger.error("header %s decode failed (%s)" % (key, e))
+            return str(value)
 
     #**********************************************************************
     # @Function: _parse_content(self, msg)
@@ -202,6 +408,56 @@ class Email:
         return result
     # end _parse_content()
 
+    #**********************************************************************
+    # @Function: attachments(self)
+    # @Description: the attachments of received email, the attachment parts
+    #   are found on first access, and each part is decoded when it's read
+    # @Parameter: None
+    # @Return: list, the Attachment object list
+    #**********************************************************************
+    @property
+    def attachments(self):
+        if self._handles == None:
+            self._handles = []
+            if self.source == "":
+                return self._handles
+            msg = self._parse(headersonly=False)
+            for part in msg.walk():
+                if Attachment.is_attachment(part):
+                    self._handles.append(Attachment(part))
+            # end for
+        # end if
+        return self._handles
+    # end attachments()
+
+    #**********************************************************************
+    # @Function: recipients(self)
+    # @Description: get all the email address of receiver, carbon copy and
+    #   blind carbon copy, which are used by SMTP "RCPT TO"
+    # @Parameter: None
+    # @Return: list, the email address list without duplicates
+    #**********************************************************************
+    def recipients(self):
+        fields = [f for f in (self.receiver, self.cc, self.bcc) if f]
+        return list(dict.fromkeys(addr for _, addr in getaddresses(fields) if addr))
+    # end recipients()
+
+    #**********************************************************************
+    # @Function: copy_to(self, recipients)
+    # @Description: get the copy of email which is sent to the recipients only,
+    #   the headers and content are shared, such as the refused recipients are
+    #   sent again, or the spooled email is sent to its spooled recipients
+    # @Parameter: recipients, the comma separated address string
+    # @Return: email, the Email object
+    #**********************************************************************
+    def copy_to(self, recipients):
+        e = copy.copy(self)
+        e.receiver = recipients
+        e.cc       = ""
+        e.bcc      = ""
+        return e
+    # end copy_to()
+
     #**********************************************************************
     # @Function: __repr__(self)
     # @Description: rewrite __str__ function, print complete "Email" plaintext
@@ -228,3 +484,367 @@ class Email:
         return self.__repr__()
     # end __str__()
 # end class
+
+# the printable ascii words separated by single space
+_SIMPLE_HEADER = re.compile(r"[!-~]+(?: [!-~]+)*")
+
+#**********************************************************************
+# @Function: _fold_header(name, value)
+# @Description: encode and fold the header line of template, the result is
+#   cached in LRU(MIME_TEMPLATE_CACHE) by the header value. the short printable
+#   ascii value needs neither encoding nor folding, it's written directly.
+#   the value with CR/LF is refused like "EmailMessage", it may inject the
+#   headers, such as the template variable taken from the received email
+# @Parameter: name, the header name
+# @Parameter: value, the header value
+# @Return: bytes, the header line with CRLF, raise ValueError when the value
+#   contains CR/LF
+#**********************************************************************
+@functools.lru_cache(maxsize=config.MIME_TEMPLATE_CACHE)
+def _fold_header(name, value):
+    if "\r" in value or "\n" in value:
+        raise ValueError("Header values may not contain linefeed or carriage return characters")
+    if (len(name) + len(value) + 2 <= SMTP_POLICY.max_line_length and
+        "=?" not in value and _SIMPLE_HEADER.fullmatch(value)):
+        return ("%s: %s\r\n" % (name, value)).encode("ascii")
+    return SMTP_POLICY.fold_binary(name, SMTP_POLICY.header_factory(name, value))
+# end _fold_header()
+
+#**********************************************************************
+# @Function: _encode_text(text)
+# @Description: encode the text body of template by quoted-printable, the
+#   result is cached in LRU(MIME_TEMPLATE_CACHE) by the text
+# @Parameter: text, the text body
+# @Return: bytes, the encoded body with CRLF line ending
+#**********************************************************************
+@functools.lru_cache(maxsize=config.MIME_TEMPLATE_CACHE)
+def _encode_text(text):
+    text = text.replace("\r\n", "\n")
+    # the body ends with newline like "set_content()"
+    if not text.endswith("\n"):
+        text += "\n"
+    return binascii.b2a_qp(text.replace("\n", "\r\n").encode("utf-8"), istext=True)
+# end _encode_text()
+
+#**********************************************************************
+# @Class: Template
+# @Description: the precompiled outbound email, the MIME email is serialized
+#   once into a skeleton with the slots of "To", "Subject" and text body (the
+#   attachments are encoded into it), and the slots are encoded by LRU cached
+#   functions; so rendering an email for a recipient is joining the skeleton
+#   chunks with the encoded slots, instead of building a new MIME email. the
+#   subject and content are "string.Template", eg:
+#     t = Template("bot@x.com", "hi $name", "your id is $id")
+#     e = t.render("a@x.com", {"name": "a", "id": 1})
+#**********************************************************************
+class Template:
+    #**********************************************************************
+    # @Function: __init__(self, sender, subject="", content="", attachment="", cc="")
+    # @Description: Template object initialize, serialize the skeleton
+    # @Parameter: sender, the email sender
+    # @Parameter: subject="", the email subject template
+    # @Parameter: content="", the email content template
+    # @Parameter: attachment="", the email attachment file path, or the list
+    #   of file paths
+    # @Parameter: cc="", the email carbon copy
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, sender, subject="", content="", attachment="", cc=""):
+        self.sender     = sender
+        self.subject    = string.Template(subject)
+        self.content    = string.Template(content)
+        self.attachment = attachment
+        self.cc         = cc
+
+        # build the skeleton email with the slot marks
+        mark = uuid.uuid4().hex
+        marks = {
+            "to": "emailbot-slot-to-%s" % mark,
+            "subject": "emailbot-slot-subject-%s" % mark,
+            "content": "emailbot-slot-content-%s" % mark,
+        }
+        e = Email(sender, marks["to"], cc, marks["subject"], "", attachment)
+        part = e.MIME.get_payload()[0] if e.MIME.is_multipart() else e.MIME
+        # the encoding of text body is fixed, it doesn't depend on the content
+        part.set_content(marks["content"], cte="quoted-printable")
+        e.preload({})
+        data = b"".join(e.stream())
+
+        # split the skeleton into the bytes chunks and the slot names
+        slots = {
+            "to": b"To: %s\r\n" % marks["to"].encode("ascii"),
+            "subject": b"Subject: %s\r\n" % marks["subject"].encode("ascii"),
+            "content": b"%s\r\n" % marks["content"].encode("ascii"),
+        }
+        self._chunks = []
+        for _, name in sorted((data.find(v), k) for k, v in slots.items()):
+            head, _, data = data.partition(slots[name])
+            self._chunks += [head, name]
+        # end for
+        self._chunks.append(data)
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: fill(self, variables)
+    # @Description: substitute the variables into subject and content, the
+    #   missing variables are kept as they are
+    # @Parameter: variables, the variables dict
+    # @Return: (subject, content), the rendered subject and content
+    #**********************************************************************
+    def fill(self, variables):
+        return (self.subject.safe_substitute(variables),
+                self.content.safe_substitute(variables))
+    # end fill()
+
+    #**********************************************************************
+    # @Function: build(self, receiver, subject, content, bcc="")
+    # @Description: build the email from the skeleton and rendered fields
+    # @Parameter: receiver, the email receiver
+    # @Parameter: subject, the rendered subject
+    # @Parameter: content, the rendered content
+    # @Parameter: bcc="", the email blind carbon copy
+    # @Return: email, the Email object
+    #**********************************************************************
+    def build(self, receiver, subject, content, bcc=""):
+        slots = {
+            "to": _fold_header("To", receiver),
+            "subject": _fold_header("Subject", subject),
+            "content": _encode_text(content),
+        }
+        chunks = [slots[c] if isinstance(c, str) else c for c in self._chunks]
+        return Email(self.sender, receiver, self.cc, subject, content,
+                     self.attachment, source=chunks, bcc=bcc)
+    # end build()
+
+    #**********************************************************************
+    # @Function: render(self, receiver, variables=None, bcc="")
+    # @Description: render the email for the recipient, "$to" is the receiver
+    # @Parameter: receiver, the email receiver
+    # @Parameter: variables=None, the variables dict
+    # @Parameter: bcc="", the email blind carbon copy
+    # @Return: email, the Email object
+    #**********************************************************************
+    def render(self, receiver, variables=None, bcc=""):
+        subject, content = self.fill(dict({"to": receiver}, **(variables or {})))
+        return self.build(receiver, subject, content, bcc)
+    # end render()
+# end class
+
+#**********************************************************************
+# @Class: Attachment
+# @Description: the lazy handle of received attachment, the MIME part is
+#   decoded chunk by chunk on first reading, into memory if it's smaller than
+#   ATTACHMENT_MEMORY_SIZE, otherwise into temporary file which can be memory
+#   mapped; so the decoded attachments are not all in memory.
+#**********************************************************************
+class Attachment:
+    # the encoded chars decoded in one chunk
+    CHUNK = 64 * 1024
+
+    #**********************************************************************
+    # @Function: __init__(self, part)
+    # @Description: Attachment object initialize
+    # @Parameter: part, the MIME part of attachment
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, part):
+        self.filename     = part.get_filename("")
+        if self.filename != "":
+            self.filename = str(make_header(decode_header(self.filename)))
+        self.content_type = part.get_content_type()
+
+        self._part = part
+        self._file = None
+        # the decoded data is rolled over into temporary file
+        self._rolled = False
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: is_attachment(part)
+    # @Description: check the MIME part is attachment, the attachment
+    #   disposition, or the part with filename, or the binary part
+    # @Parameter: part, the MIME part
+    # @Return: bool
+    #**********************************************************************
+    @staticmethod
+    def is_attachment(part):
+        if part.is_multipart() or part.get_content_maintype() == "message":
+            return False
+        if part.get_content_disposition() == "attachment" or part.get_filename():
+            return True
+        return part.get_content_maintype() in ("image", "application", "audio", "video")
+    # end is_attachment()
+
+    #**********************************************************************
+    # @Function: _chunks(self)
+    # @Description: split the encoded payload into chunks of whole lines
+    # @Parameter: None
+    # @Return: generator, the encoded str chunks
+    #**********************************************************************
+    def _chunks(self):
+        # the encoded payload str, it's not decoded by "get_payload()"
+        payload = self._part.get_payload(decode=False)
+        start = 0
+        while start < len(payload):
+            end = payload.find("\n", start + self.CHUNK)
+            end = len(payload) if end < 0 else end + 1
+            yield payload[start:end]
+            start = end
+        # end while
+    # end _chunks()
+
+    #**********************************************************************
+    # @Function: _decode(self, f)
+    # @Description: decode the payload by its transfer encoding into file
+    # @Parameter: f, the output file object
+    # @Return: None
+    #**********************************************************************
+    def _decode(self, f):
+        cte = self._part.get("Content-Transfer-Encoding", "").strip().lower()
+        if cte == "base64":
+            rest = ""
+            for chunk in self._chunks():
+                # decode the complete 4 chars groups, keep the rest
+                data = rest + "".join(chunk.split())
+                end = len(data) - len(data) % 4
+                f.write(binascii.a2b_base64(data[:end]))
+                rest = data[end:]
+            # end for
+            if rest.strip("=") != "":
+                logger.warning("attachment %s base64 is incomplete" % self.filename)
+        elif cte == "quoted-printable":
+            for chunk in self._chunks():
+                f.write(binascii.a2b_qp(chunk.encode("utf-8", "surrogateescape")))
+        else:
+            f.write(self._part.get_payload(decode=True) or b"")
+        # end if
+    # end _decode()
+
+    #**********************************************************************
+    # @Function: file(self)
+    # @Description: get the decoded attachment file object, it's decoded on
+    #   first call; the file is shared by the handle, it's seeked to start
+    # @Parameter: None
+    # @Return: file, the file object, return None when decode failed
+    #**********************************************************************
+    def file(self):
+        # the handle is closed
+        if self._file == None and self._part == None:
+            return None
+        if self._file == None:
+            f = tempfile.SpooledTemporaryFile(max_size=config.ATTACHMENT_MEMORY_SIZE,
+                                              dir=config.ATTACHMENT_TEMP_DIR or None)
+            try:
+                self._decode(f)
+            except Exception as e:
+                logger.error("attachment %s decode failed (%s)" % (self.filename, e))
+                f.close()
+                return None
+            self._file = f
+            # "SpooledTemporaryFile" rolls over when the written size exceeds
+            # max_size, and it's never rolled over when max_size is 0
+            max_size = config.ATTACHMENT_MEMORY_SIZE
+            self._rolled = max_size > 0 and f.tell() > max_size
+            # the encoded payload is not required
+            self._part = None
+        # end if
+        self._file.seek(0)
+        return self._file
+    # end file()
+
+    #**********************************************************************
+    # @Function: read(self)
+    # @Description: read the whole attachment data
+    # @Parameter: None
+    # @Return: bytes, the attachment data
+    #**********************************************************************
+    def read(self):
+        f = self.file()
+        if f == None:
+            return b""
+        return f.read()
+    # end read()
+
+    #**********************************************************************
+    # @Function: mmap(self)
+    # @Description: map the attachment data into memory, the large attachment
+    #   in temporary file is paged in by operating system on demand
+    # @Parameter: None
+    # @Return: data, the read-only mmap object, or bytes for the small attachment
+    #   in memory (and the empty attachment)
+    #**********************************************************************
+    def mmap(self):
+        f = self.file()
+        if f == None:
+            return b""
+        # the attachment is kept in memory
+        if not self._rolled:
+            return f.read()
+        f.flush()
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # end mmap()
+
+    #**********************************************************************
+    # @Function: save(self, path)
+    # @Description: save the attachment into file by chunks
+    # @Parameter: path, the file path
+    # @Return: status, return False when save failed
+    #**********************************************************************
+    def save(self, path):
+        f = self.file()
+        if f == None:
+            return False
+        try:
+            with open(path, "wb") as out:
+                while True:
+                    data = f.read(self.CHUNK)
+                    if not data:
+                        break
+                    out.write(data)
+                # end while
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+    # end save()
+
+    #**********************************************************************
+    # @Function: size(self)
+    # @Description: the decoded attachment size
+    # @Parameter: None
+    # @Return: int, the bytes size
+    #**********************************************************************
+    @property
+    def size(self):
+        f = self.file()
+        if f == None:
+            return 0
+        f.seek(0, os.SEEK_END)
+        return f.tell()
+    # end size()
+
+    #**********************************************************************
+    # @Function: close(self)
+    # @Description: release the decoded data, the temporary file is deleted
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def close(self):
+        if self._file != None:
+            self._file.close()
+        self._file = None
+        self._part = None
+    # end close()
+
+    #**********************************************************************
+    # @Function: __repr__(self)
+    # @Description: rewrite __str__ function, print the attachment information
+    # @Parameter: None
+    # @Return: str
+    #**********************************************************************
+    def __repr__(self):
+        return f"ATTACHMENT {self.filename} ({self.content_type})"
+    # end __repr__()
+# end class
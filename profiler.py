@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: profiler.py
+Description: the opt-in profiling of rules and callbacks
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import collections
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from utils import logger
+
+#**********************************************************************
+# @Class: Profiler
+# @Description: count the cumulative time and calls of each rule matching and
+#   callback, and log the slow rule matching. the rules are matched one by
+#   one for each email, so a slow rule delays all the rules behind it, the
+#   statistics show which rule should be moved backward or rewritten.
+#   the profile is dumped on demand (see "install()"), the dump includes the
+#   statistics and the stacks of all threads sampled for a while, which is
+#   written in folded format (one "frame;frame;frame count" line for each
+#   stack), it can be rendered by flamegraph tools.
+#**********************************************************************
+class Profiler:
+    # the stack sampling interval seconds
+    INTERVAL = 0.005
+
+    #**********************************************************************
+    # @Function: __init__(self, slow=0, path="", seconds=30)
+    # @Description: Profiler object initialize
+    # @Parameter: slow=0, log the rule matching slower than seconds, 0 is
+    #   disabled
+    # @Parameter: path="", the dump directory, system temporary directory if
+    #   it's empty
+    # @Parameter: seconds=30, the stack sampling seconds of each dump
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, slow=0, path="", seconds=30):
+        self.slow    = slow
+        self.path    = path or tempfile.gettempdir()
+        self.seconds = seconds
+        # the {rule: [calls, total, max]} and {callback: [calls, total, max]}
+        self._rules     = {}
+        self._callbacks = {}
+        self._mutex     = threading.Lock()
+        self._sampler   = None
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _count(self, table, key, cost)
+    # @Description: count the cost into the statistics table
+    # @Parameter: table, the statistics dict
+    # @Parameter: key, the rule or callback
+    # @Parameter: cost, the seconds
+    # @Return: None
+    #**********************************************************************
+    def _count(self, table, key, cost):
+        with self._mutex:
+            stat = table.get(key)
+            if stat == None:
+                stat = table[key] = [0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += cost
+            stat[2] = max(stat[2], cost)
+        # end with
+    # end _count()
+
+    #**********************************************************************
+    # @Function: rule(self, r, email, cost)
+    # @Description: the hook of rule matching
+    # @Parameter: r, the Rule object
+    # @Parameter: email, the matched email object
+    # @Parameter: cost, the matching seconds
+    # @Return: None
+    #**********************************************************************
+    def rule(self, r, email, cost):
+        self._count(self._rules, r, cost)
+        if self.slow > 0 and cost >= self.slow:
+            logger.warning("slow rule %.3fs %s, email [%s] by %s" % (
+                cost, r, email.subject, email.sender))
+    # end rule()
+
+    #**********************************************************************
+    # @Function: callback(self, callback, cost)
+    # @Description: the hook of callback execution
+    # @Parameter: callback, the callback function
+    # @Parameter: cost, the execution seconds
+    # @Return: None
+    #**********************************************************************
+    def callback(self, callback, cost):
+        self._count(self._callbacks, callback, cost)
+    # end callback()
+
+    #**********************************************************************
+    # @Function: stats(self)
+    # @Description: get the statistics, sorted by the total time
+    # @Parameter: None
+    # @Return: dict, {"rules": list, "callbacks": list}, each item is the
+    #   {"name", "calls", "total", "avg", "max"} dict
+    #**********************************************************************
+    def stats(self):
+        with self._mutex:
+            tables = {
+                "rules": [(str(k), list(v)) for k, v in self._rules.items()],
+                "callbacks": [(getattr(k, "__name__", str(k)), list(v))
+                              for k, v in self._callbacks.items()],
+            }
+        # end with
+        result = {}
+        for kind, items in tables.items():
+            result[kind] = [{"name": name, "calls": calls, "total": total,
+                             "avg": total / calls, "max": peak}
+                            for name, (calls, total, peak) in items]
+            result[kind].sort(key=lambda item: item["total"], reverse=True)
+        # end for
+        return result
+    # end stats()
+
+    #**********************************************************************
+    # @Function: report(self)
+    # @Description: format the statistics into text table
+    # @Parameter: None
+    # @Return: str
+    #**********************************************************************
+    def report(self):
+        lines = []
+        for kind, items in self.stats().items():
+            lines.append("%-10s %10s %12s %12s %12s  name" % (kind, "calls", "total(s)", "avg(s)", "max(s)"))
+            for item in items:
+                lines.append("%-10s %10d %12.6f %12.6f %12.6f  %s" % ("", item["calls"],
+                             item["total"], item["avg"], item["max"], item["name"]))
+            # end for
+            lines.append("")
+        # end for
+        return "\n".join(lines)
+    # end report()
+
+    #**********************************************************************
+    # @Function: dump(self)
+    # @Description: write the statistics into the dump directory, and start
+    #   the stack sampling thread, the stacks are written when it's done. it
+    #   returns immediately, so it can be called by signal handler
+    # @Parameter: None
+    # @Return: prefix, the dump file path prefix, None if the sampling is
+    #   running
+    #**********************************************************************
+    def dump(self):
+        if self._sampler != None and self._sampler.is_alive():
+            logger.warning("profile sampling is running, ignore the dump")
+            return None
+        prefix = os.path.join(self.path, "emailbot-%d-%s" % (
+            os.getpid(), time.strftime("%Y%m%d%H%M%S")))
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(prefix + ".rules", "w") as f:
+                f.write(self.report())
+        except OSError as e:
+            logger.error(e)
+            return None
+        logger.info("profile statistics dumped into %s.rules" % prefix)
+
+        self._sampler = threading.Thread(target=self._sample, args=(prefix,), daemon=True)
+        self._sampler.start()
+        return prefix
+    # end dump()
+
+    #**********************************************************************
+    # @Function: _sample(self, prefix)
+    # @Description: the sampling thread, take the stacks of all the other
+    #   threads every INTERVAL seconds, and write the folded stacks
+    # @Parameter: prefix, the dump file path prefix
+    # @Return: None
+    #**********************************************************************
+    def _sample(self, prefix):
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame != None:
+                    code = frame.f_code
+                    stack.append("%s:%s:%d" % (os.path.basename(code.co_filename),
+                                               code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                # end while
+                stacks[";".join(reversed(stack))] += 1
+            # end for
+            time.sleep(self.INTERVAL)
+        # end while
+
+        try:
+            with open(prefix + ".folded", "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write("%s %d\n" % (stack, count))
+            # end with
+        except OSError as e:
+            logger.error(e)
+            return
+        logger.info("profile stacks dumped into %s.folded" % prefix)
+    # end _sample()
+
+    #**********************************************************************
+    # @Function: install(self, name)
+    # @Description: dump the profile when the signal is received, it should
+    #   be called by the main thread
+    # @Parameter: name, the signal name, such as "SIGUSR1"
+    # @Return: status, False if the signal can't be handled
+    #**********************************************************************
+    def install(self, name):
+        signum = getattr(signal, name, None)
+        if signum == None:
+            logger.warning("signal %s is not supported, profile dump is disabled" % name)
+            return False
+        try:
+            signal.signal(signum, lambda signum, frame: self.dump())
+        except ValueError as e:
+            # not in the main thread
+            logger.warning("profile dump signal is not installed (%s)" % e)
+            return False
+        logger.info("profile is dumped by signal %s (kill -%s %d)" % (
+            name, name[3:], os.getpid()))
+        return True
+    # end install()
+# end class
+
+# the running profiler, None if the profiling is disabled
+PROFILER = None
+
+#**********************************************************************
+# @Function: enable(slow=0, path="", seconds=30)
+# @Description: enable the profiling of rules and callbacks
+# @Parameter: slow, path, seconds, see "Profiler"
+# @Return: Profiler
+#**********************************************************************
+def enable(slow=0, path="", seconds=30):
+    global PROFILER
+    if PROFILER == None:
+        PROFILER = Profiler(slow, path, seconds)
+    return PROFILER
+# end enable()
@@ -3,18 +3,55 @@
 
 """
 File: protocol.py
-Description: the email protocol wrapper, implement SMTP / POP3
+Description: the email protocol wrapper, implement SMTP / POP3 / IMAP
 Author: 0x7F@knownsec404
 Time: 2021.06.23
 """
 
-import smtplib
+import imaplib
 import poplib
+import re
+import select
+import smtplib
+import threading
+import time
 
 import config
+import metrics
 import mime
 from utils import logger
 
+#**********************************************************************
+# @Function: envelope(email)
+# @Description: get the SMTP envelope of email, the addresses are quoted by
+#   "smtplib.quoteaddr()" (the "Name <a@b>" is normalized to "<a@b>"), the
+#   address with CR/LF is refused by 553, it may inject the SMTP commands,
+#   such as the address taken from the received email
+# @Parameter: email, the mime email object
+# @Return: (sender, recipients, refused), the quoted sender(None if it's
+#   refused), the valid [(addr, quoted), ...] recipients, and the refused
+#   recipients dict {addr: (553, message)}
+#**********************************************************************
+def envelope(email):
+    def quote(addr):
+        if "\r" in addr or "\n" in addr:
+            return None
+        return smtplib.quoteaddr(addr)
+    # end quote()
+
+    sender = quote(email.sender)
+    recipients, refused = [], {}
+    for addr in email.recipients():
+        quoted = quote(addr)
+        if quoted == None:
+            logger.error("refuse the invalid recipient %r" % addr)
+            refused[addr] = (553, b"invalid address")
+        else:
+            recipients.append((addr, quoted))
+    # end for
+    return sender, recipients, refused
+# end envelope()
+
 #**********************************************************************
 # @Class: SMTP
 # @Description: implement and warpper SMTP protocol multi commands, and provide
@@ -40,6 +77,11 @@ class SMTP:
 
         # set value by "check_status()"
         self.status  = False
+
+        # the connection pool, each item is [smtp, create_time, last_used_time],
+        # the most recently used session is at the end of list
+        self._pool = []
+        self._pool_mutex = threading.Lock()
     # end __init__()
 
     #**********************************************************************
@@ -85,31 +127,298 @@ class SMTP:
         status, smtp = self._login_server()
         if status:
             self.status = True
-            smtp.quit()
+            # keep the authed session, it will be reused by the first sending
+            self._release(smtp, time.time())
         return status
     # end check_status()
 
+    #**********************************************************************
+    # @Function: _close(self, smtp)
+    # @Description: quit the SMTP session, and ignore any error because the
+    #   session may be already disconnected by server
+    # @Parameter: smtp, the connected SMTP object
+    # @Return: None
+    #**********************************************************************
+    def _close(self, smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+    # end _close()
+
+    #**********************************************************************
+    # @Function: _acquire(self)
+    # @Description: get an authed SMTP session from the pool, the session
+    #   which exceeds max-age or idle time will be evicted, and the session
+    #   which idle a while will be checked by NOOP; if there is no available
+    #   session in the pool, connect and login a new one.
+    # @Parameter: None
+    # @Return: (status, smtp, created), the SMTP object and its create time
+    #**********************************************************************
+    def _acquire(self):
+        while True:
+            self._pool_mutex.acquire()
+            item = self._pool.pop() if len(self._pool) > 0 else None
+            self._pool_mutex.release()
+            if item == None:
+                break
+
+            smtp, created, used = item
+            now = time.time()
+            if (now - created > config.SMTP_POOL_MAXAGE or
+                now - used > config.SMTP_POOL_IDLE):
+                self._close(smtp)
+                continue
+            # keepalive, the server may close the idle session silently
+            if now - used > config.SMTP_POOL_KEEPALIVE:
+                try:
+                    code, _ = smtp.noop()
+                except Exception:
+                    code = -1
+                if code != 250:
+                    logger.debug("smtp pooled session is dead, evict it")
+                    smtp.close()
+                    continue
+            # end if
+            return True, smtp, created
+        # end while
+
+        # no available session in pool
+        status, smtp = self._login_server()
+        return status, smtp, time.time()
+    # end _acquire()
+
+    #**********************************************************************
+    # @Function: _release(self, smtp, created)
+    # @Description: put the SMTP session back to the pool, when the pool is
+    #   full, the oldest idle session will be closed
+    # @Parameter: smtp, the connected SMTP object
+    # @Parameter: created, the SMTP object create time
+    # @Return: None
+    #**********************************************************************
+    def _release(self, smtp, created):
+        evicted = []
+        self._pool_mutex.acquire()
+        self._pool.append([smtp, created, time.time()])
+        while len(self._pool) > config.SMTP_POOL_SIZE:
+            evicted.append(self._pool.pop(0)[0])
+        self._pool_mutex.release()
+
+        for s in evicted:
+            self._close(s)
+    # end _release()
+
+    #**********************************************************************
+    # @Function: close(self)
+    # @Description: close all the SMTP sessions in the pool
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def close(self):
+        self._pool_mutex.acquire()
+        pool = self._pool
+        self._pool = []
+        self._pool_mutex.release()
+
+        for item in pool:
+            self._close(item[0])
+    # end close()
+
+    #**********************************************************************
+    # @Function: _sendmail(self, smtp, email, reset=False)
+    # @Description: the "smtplib.SMTP.sendmail()" with streaming DATA, the
+    #   email is written into socket by chunks, instead of the whole string.
+    #   when the server supports PIPELINING, the "RSET/MAIL/RCPT/DATA" commands
+    #   are sent by one write and their replies are read together
+    # @Parameter: smtp, the smtp session
+    # @Parameter: email, the mime email object
+    # @Parameter: reset=False, reset the session by RSET before the transaction
+    # @Return: refused, the refused recipients dict, raise exception when fails
+    #**********************************************************************
+    def _sendmail(self, smtp, email, reset=False):
+        sender, recipients, invalid = envelope(email)
+        if sender == None:
+            raise smtplib.SMTPSenderRefused(553, b"invalid address", email.sender)
+        if len(recipients) == 0:
+            raise smtplib.SMTPResponseException(553, b"no valid recipient")
+        if smtp.has_extn("pipelining"):
+            return self._sendmail_pipelined(smtp, email, sender, recipients, invalid, reset)
+
+        if reset:
+            code, resp = smtp.rset()
+            if code != 250:
+                raise smtplib.SMTPResponseException(code, resp)
+        code, resp = smtp.mail(email.sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, email.sender)
+
+        # it fails only if all recipients are refused
+        refused = {}
+        for addr, _ in recipients:
+            code, resp = smtp.rcpt(addr)
+            if code != 250 and code != 251:
+                refused[addr] = (code, resp)
+        # end for
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(dict(refused, **invalid))
+        refused.update(invalid)
+
+        code, resp = smtp.docmd("DATA")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        return self._senddata(smtp, email, refused)
+    # end _sendmail()
+
+    #**********************************************************************
+    # @Function: _sendmail_pipelined(self, smtp, email, sender, recipients,
+    #   invalid, reset)
+    # @Description: the "_sendmail()" by PIPELINING(rfc2920), all the replies
+    #   are read before checking, so the session is still in sync on failure
+    # @Parameter: smtp, the smtp session
+    # @Parameter: email, the mime email object
+    # @Parameter: sender, recipients, invalid, the envelope, see "envelope()"
+    # @Parameter: reset, reset the session by RSET before the transaction
+    # @Return: refused, the refused recipients dict, raise exception when fails
+    #**********************************************************************
+    def _sendmail_pipelined(self, smtp, email, sender, recipients, invalid, reset):
+        cmds = ["RSET"] if reset else []
+        cmds.append("MAIL FROM:%s" % sender)
+        cmds += ["RCPT TO:%s" % quoted for _, quoted in recipients]
+        cmds.append("DATA")
+        smtp.send("\r\n".join(cmds) + "\r\n")
+        replies = [smtp.getreply() for _ in cmds]
+        if reset:
+            replies.pop(0)
+
+        (mail, resp), data = replies[0], replies[-1]
+        refused = {}
+        for (addr, _), (code, text) in zip(recipients, replies[1:-1]):
+            if code != 250 and code != 251:
+                refused[addr] = (code, text)
+        # end for
+        if data[0] == 354 and (mail != 250 or len(refused) == len(recipients)):
+            # the server accepts DATA anyway, end it with an empty email
+            smtp.send(".\r\n")
+            smtp.getreply()
+        if mail != 250:
+            raise smtplib.SMTPSenderRefused(mail, resp, email.sender)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(dict(refused, **invalid))
+        if data[0] != 354:
+            raise smtplib.SMTPDataError(*data)
+        refused.update(invalid)
+        return self._senddata(smtp, email, refused)
+    # end _sendmail_pipelined()
+
+    #**********************************************************************
+    # @Function: _senddata(self, smtp, email, refused)
+    # @Description: write the DATA content by chunks and check the reply
+    # @Parameter: smtp, the smtp session
+    # @Parameter: email, the mime email object
+    # @Parameter: refused, the refused recipients dict
+    # @Return: refused, the refused recipients dict, raise exception when fails
+    #**********************************************************************
+    def _senddata(self, smtp, email, refused):
+        for chunk in email.data():
+            smtp.send(chunk)
+        code, resp = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+    # end _senddata()
+
     #**********************************************************************
     # @Function: send(self, email)
-    # @Description: send email through SMTP server
+    # @Description: send email through SMTP server, the session is taken
+    #   from the pool, when the pooled session is disconnected by server, we
+    #   will reconnect and send again transparently
     # @Parameter: email, the mime email object
     # @Return: status, return True when email send success
     #**********************************************************************
     def send(self, email):
-        # connect/auth smtp server and send
-        status, smtp = self._login_server()
-        if status == False:
-            return False
-
-        try:
-            smtp.sendmail(email.sender, email.receiver+email.cc, email.MIME.as_string())
-            smtp.quit()
-        except Exception as e:
-            logger.error(e)
-            smtp.close()
-            return False
-        return True
+        return self.send_batch([email])[0][0] == 250
     # end send()
+
+    #**********************************************************************
+    # @Function: send_batch(self, emails)
+    # @Description: send the emails over one pooled session in order, the
+    #   transactions are separated by RSET (it's pipelined with the next
+    #   transaction when the server supports PIPELINING, otherwise it's only
+    #   sent after the failed transaction). when the session is
+    #   disconnected, the rest emails are sent by a new session; it gives up
+    #   when the new session is disconnected before any email is sent.
+    # @Parameter: emails, the mime email object list
+    # @Return: list, the (code, refused) of each email, the code is 250 when
+    #   send success, the refused reply code when fails, 0 when there is no
+    #   reply; the refused is the {address: reply code} dict of the refused
+    #   recipients, the other recipients get the email when the code is 250
+    #**********************************************************************
+    def send_batch(self, emails):
+        results = [(0, {})] * len(emails)
+        i, retries = 0, 0
+        while i < len(emails) and retries < 2:
+            # get connected/authed smtp session
+            status, smtp, created = self._acquire()
+            if status == False:
+                break
+
+            reset = False
+            try:
+                while i < len(emails):
+                    try:
+                        refused = self._sendmail(smtp, emails[i], reset)
+                        results[i] = (250, {a: r[0] for a, r in refused.items()})
+                        retries = 0
+                    except smtplib.SMTPServerDisconnected:
+                        raise
+                    except smtplib.SMTPException as e:
+                        # the session is still alive, reset it by the next one
+                        logger.error(e)
+                        refused = getattr(e, "recipients", {})
+                        results[i] = (self._reply_code(e), {a: r[0] for a, r in refused.items()})
+                    # RSET costs a round trip without PIPELINING, so it's
+                    # only sent after the failed transaction
+                    reset = results[i][0] != 250 or smtp.has_extn("pipelining")
+                    i += 1
+                # end while
+            except smtplib.SMTPServerDisconnected as e:
+                logger.warning("smtp session disconnected, reconnect (%s)" % e)
+                smtp.close()
+                retries += 1
+                continue
+            except Exception as e:
+                # such as the attachment is unreadable in DATA, the session is
+                # out of sync, and the email is failed
+                logger.error(e)
+                smtp.close()
+                i += 1
+                continue
+
+            # reset the failed transaction before reuse the session
+            if i > 0 and results[i-1][0] != 250:
+                try:
+                    smtp.rset()
+                except Exception:
+                    smtp.close()
+                    continue
+            self._release(smtp, created)
+        # end while
+        return results
+    # end send_batch()
+
+    #**********************************************************************
+    # @Function: _reply_code(self, e)
+    # @Description: get the smtp reply code of the sending exception
+    # @Parameter: e, the smtplib exception
+    # @Return: code, the reply code, 0 if there is no reply code
+    #**********************************************************************
+    def _reply_code(self, e):
+        if isinstance(e, smtplib.SMTPResponseException):
+            return e.smtp_code
+        if isinstance(e, smtplib.SMTPRecipientsRefused) and len(e.recipients) > 0:
+            return next(iter(e.recipients.values()))[0]
+        return 0
+    # end _reply_code()
 # end class
 
 #**********************************************************************
@@ -187,6 +496,20 @@ class POP3:
         return status
     # end check_status()
 
+    #**********************************************************************
+    # @Function: session(self)
+    # @Description: create a POP3 session, which can execute multiple commands
+    #   over one connected/authed POP3 connection, using as context manager:
+    #     with pop3.session() as s:
+    #         lines = s.uidl()
+    #         email = s.recv(1)
+    # @Parameter: None
+    # @Return: session, the POP3Session object
+    #**********************************************************************
+    def session(self):
+        return POP3Session(self)
+    # end session()
+
     #**********************************************************************
     # @Function: stat(self)
     # @Description: get mailbox status, include message count and mailbox size,
@@ -195,18 +518,122 @@ class POP3:
     # @Return: count, the message count, while error will return -1
     #**********************************************************************
     def stat(self):
-        # connect/auth pop3 server
-        status, pop3 = self._login_server()
-        if status == False:
+        with self.session() as s:
+            return s.stat()
+    # end stat()
+
+    #**********************************************************************
+    # @Function: uidl(self, which=0)
+    # @Description: get all message hash or get the hash of the mail with the
+    #   specified id.
+    # @Parameter: which=0, message id, when the value less than or equal to 0,
+    #   return the specified mail hash.
+    # @Return: result, the email hash list or hash string
+    #   the single hash example: b'1 ZC3130-wi6DhoW5iDuIEDhYOkraUbh'
+    #**********************************************************************
+    def uidl(self, which=0):
+        with self.session() as s:
+            return s.uidl(which)
+    # end uidl()
+
+    #**********************************************************************
+    # @Function: recv(self, which)
+    # @Description: get the email content of the specified id, the original
+    #   content of the received email is parsed through MIME.
+    # @Parameter: which, the email id
+    # @Return: email, our internal warpper Email object
+    #**********************************************************************
+    def recv(self, which):
+        with self.session() as s:
+            return s.recv(which)
+    # end recv()
+# end class
+
+#**********************************************************************
+# @Class: POP3Session
+# @Description: the POP3 session, login once and execute multiple commands
+#   over the same connection, the connection is closed when leaving the "with"
+#   block. when the login or any command fails, the session is broken, and the
+#   subsequent commands will return the error value directly.
+#**********************************************************************
+class POP3Session:
+    #**********************************************************************
+    # @Function: __init__(self, pop3)
+    # @Description: POP3Session object initialize
+    # @Parameter: pop3, the POP3 object which provide server and user/pass
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, pop3):
+        self.pop3 = pop3
+
+        # set value by "__enter__()"
+        self.status = False
+        self.conn   = None
+        # the server supports "TOP" or not, None until the first "TOP" is
+        # replied; it's disabled only if the first one fails, the later
+        # "-ERR" means the message is deleted during polling
+        self.top_supported = None
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: __enter__(self)
+    # @Description: connect and login in POP3 server
+    # @Parameter: None
+    # @Return: session, the POP3Session object itself
+    #**********************************************************************
+    def __enter__(self):
+        self.status, self.conn = self.pop3._login_server()
+        return self
+    # end __enter__()
+
+    #**********************************************************************
+    # @Function: __exit__(self, exc_type, exc_value, traceback)
+    # @Description: quit the POP3 session
+    # @Parameter: exc_type, exc_value, traceback, the exception information
+    # @Return: False, don't suppress the exception
+    #**********************************************************************
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.status:
+            try:
+                self.conn.quit()
+            except Exception as e:
+                logger.error(e)
+                self.conn.close()
+        self.status = False
+        self.conn = None
+        return False
+    # end __exit__()
+
+    #**********************************************************************
+    # @Function: _broken(self, e)
+    # @Description: the command fails, close the connection and set session
+    #   broken, the POP3 server state is unknown after error
+    # @Parameter: e, the exception
+    # @Return: None
+    #**********************************************************************
+    def _broken(self, e):
+        logger.error(e)
+        self.conn.close()
+        self.status = False
+        self.conn = None
+    # end _broken()
+
+    #**********************************************************************
+    # @Function: stat(self)
+    # @Description: get mailbox status, include message count and mailbox size,
+    #   we just return message count
+    # @Parameter: None
+    # @Return: count, the message count, while error will return -1
+    #**********************************************************************
+    def stat(self):
+        if self.status == False:
             return -1
 
         # get email status
         try:
-            count, octets = pop3.stat()
-            pop3.quit()
+            count, octets = self.conn.stat()
         except Exception as e:
-            logger.error(e)
-            pop3.close()
+            self._broken(e)
             return -1
 
         return count
@@ -222,9 +649,7 @@ class POP3:
     #   the single hash example: b'1 ZC3130-wi6DhoW5iDuIEDhYOkraUbh'
     #**********************************************************************
     def uidl(self, which=0):
-        # connect/auth pop3 server
-        status, pop3 = self._login_server()
-        if status == False:
+        if self.status == False:
             return None
 
         # get all email message digest (unique id) list
@@ -232,55 +657,544 @@ class POP3:
         try:
             if which > 0:
                 # get the uuid of the specified mail
-                line = pop3.uidl(which)
+                line = self.conn.uidl(which)
                 # check response with "+OK"
                 if line.decode("utf-8").startswith("+OK"):
                     result = line[4:]
             else:
                 # get the uuid of all emails
-                resp, lines, octets = pop3.uidl()
+                resp, lines, octets = self.conn.uidl()
                 # check response with "+OK"
                 if resp.decode("utf-8").startswith("+OK"):
                     result = lines
             # end if-else
-            pop3.quit()
         except Exception as e:
-            logger.error(e)
-            pop3.close()
+            self._broken(e)
             return None
 
         return result
     # end uidl()
 
+    #**********************************************************************
+    # @Function: list(self)
+    # @Description: get all message size
+    # @Parameter: None
+    # @Return: result, the email size list, while error will return None
+    #   the single line example: b'1 2048'
+    #**********************************************************************
+    def list(self):
+        if self.status == False:
+            return None
+
+        result = None
+        try:
+            resp, lines, octets = self.conn.list()
+            # check response with "+OK"
+            if resp.decode("utf-8").startswith("+OK"):
+                result = lines
+        except Exception as e:
+            self._broken(e)
+            return None
+
+        return result
+    # end list()
+
     #**********************************************************************
     # @Function: recv(self, which)
-    # @Description: get the email content of the specified id, the original
-    #   content of the received email is parsed through MIME.
+    # @Description: get the email content of the specified id, the raw bytes
+    #   are handed to MIME as source, they are not decoded as a whole, and the
+    #   body is parsed on first access by the charset of each part.
     # @Parameter: which, the email id
     # @Return: email, our internal warpper Email object
     #**********************************************************************
     def recv(self, which):
-        # connect/auth pop3 server
-        status, pop3 = self._login_server()
-        if status == False:
+        if self.status == False:
             return None
 
-        # get email message by id
+        # get email message by id, the dot-stuffing is removed by poplib
         try:
-            resp, lines, octets = pop3.retr(which)
-            pop3.quit()
+            resp, lines, octets = self.conn.retr(which)
+        except poplib.error_proto as e:
+            # the server reply "-ERR", such as the message has been deleted,
+            # the session is still available
+            logger.warning("pop3 response ERR: %s" % e)
+            return None
+        except Exception as e:
+            self._broken(e)
+            return None
+
+        lines.append(b"")
+        source = b"\r\n".join(lines)
+        metrics.RECV_EMAILS.inc(1, "pop3")
+        metrics.RECV_BYTES.inc(len(source), "pop3")
+        return mime.Email(source=source)
+    # end recv()
+
+    #**********************************************************************
+    # @Function: top(self, which)
+    # @Description: get the email headers of the specified id by "TOP n 0",
+    #   the body is not downloaded
+    # @Parameter: which, the email id
+    # @Return: email, the Email object with headers only, while error or the
+    #   server doesn't support "TOP" will return None
+    #**********************************************************************
+    def top(self, which):
+        if self.status == False or self.top_supported == False:
+            return None
+
+        try:
+            resp, lines, octets = self.conn.top(which, 0)
+        except poplib.error_proto as e:
+            if self.top_supported == None:
+                # the optional "TOP" command is not supported, use "RETR" in
+                # this session
+                logger.warning("pop3 TOP response ERR: %s, use RETR instead" % e)
+                self.top_supported = False
+            else:
+                logger.warning("pop3 TOP %d response ERR: %s" % (which, e))
+            return None
+        except Exception as e:
+            self._broken(e)
+            return None
+
+        self.top_supported = True
+        return mime.Email(source=b"\r\n".join(lines))
+    # end top()
+# end class
+
+#**********************************************************************
+# @Class: _IMAP4Stream
+# @Description: the imaplib.IMAP4 mixin, read the socket with our own buffer
+#   instead of the buffered socket file, so we can know whether there is any
+#   pending data without blocking, which is required by IDLE waiting.
+#**********************************************************************
+class _IMAP4Stream:
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        self._rbuf = bytearray()
+    # end open()
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        self._rbuf += data
+    # end _fill()
+
+    def read(self, size):
+        while len(self._rbuf) < size:
+            self._fill()
+        data = bytes(self._rbuf[:size])
+        del self._rbuf[:size]
+        return data
+    # end read()
+
+    def readline(self):
+        start = 0
+        while True:
+            pos = self._rbuf.find(b"\n", start)
+            if pos >= 0:
+                return self.read(pos+1)
+            if len(self._rbuf) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            start = len(self._rbuf)
+            self._fill()
+        # end while
+    # end readline()
+
+    def readable(self, timeout):
+        if len(self._rbuf) > 0:
+            return True
+        # the ssl socket may have decrypted data in its own buffer
+        if hasattr(self.sock, "pending") and self.sock.pending() > 0:
+            return True
+        r, _, _ = select.select([self.sock], [], [], timeout)
+        return len(r) > 0
+    # end readable()
+# end class
+
+class _IMAP4(_IMAP4Stream, imaplib.IMAP4):
+    pass
+
+class _IMAP4_SSL(_IMAP4Stream, imaplib.IMAP4_SSL):
+    pass
+
+#**********************************************************************
+# @Function: untagged_responses(lines)
+# @Description: parse the untagged response lines of mailbox status, like
+#   "* 21 EXISTS" and "* OK [UIDNEXT 22] ok", into the same format as imaplib
+#   "untagged_responses"
+# @Parameter: lines, the response line list
+# @Return: dict, the {"EXISTS": [b"21"], "UIDNEXT": [b"22"]}
+#**********************************************************************
+def untagged_responses(lines):
+    result = {}
+    for line in lines:
+        m = re.match(rb"\* (\d+) (EXISTS|RECENT)", line) or \
+            re.match(rb"\* OK \[(UIDVALIDITY|UIDNEXT|HIGHESTMODSEQ) (\d+)\]", line)
+        if m == None:
+            continue
+        if m.group(1).isdigit():
+            value, name = m.group(1), m.group(2)
+        else:
+            name, value = m.group(1), m.group(2)
+        result.setdefault(name.decode("utf-8"), []).append(value)
+    # end for
+    return result
+# end untagged_responses()
+
+#**********************************************************************
+# @Class: IMAP
+# @Description: implement and warpper IMAP protocol multi commands, keep one
+#   long-lived connection to the mailbox, and wait for new emails by IDLE
+#   push notification (fallback to NOOP polling if IDLE is not supported)
+#**********************************************************************
+class IMAP:
+    #**********************************************************************
+    # @Function: __init__(self, address, port, ssl, user, passwd, mailbox="INBOX")
+    # @Description: IMAP object initialize
+    # @Parameter: address, the IMAP server address
+    # @Parameter: port, the IMAP server port
+    # @Parameter: ssl, ssl is required to connect to the IMAP
+    # @Parameter: username, the mailbox username
+    # @Parameter: password, the mailbox password
+    # @Parameter: mailbox="INBOX", the selected mailbox
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, address, port, ssl, user, passwd, mailbox="INBOX"):
+        self.address = address
+        self.port    = port
+        self.ssl     = ssl
+        self.user    = user
+        self.passwd  = passwd
+        self.mailbox = mailbox
+
+        # set value by "check_status()"
+        self.status  = False
+
+        # the long-lived connection, set by "connect()"
+        self.conn      = None
+        self.idle      = False
+        self.condstore = False
+        # the mailbox status, updated by the untagged responses, see
+        # "_untagged()"
+        self.uidvalidity = 0
+        self.uidnext     = 0
+        self.modseq      = 0
+        self.changed     = False
+        self._idle_tag   = 0
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _login_server(self)
+    # @Description: connect and login in IMAP server, and select the mailbox
+    # @Parameter: None
+    # @Return: imap, the connectd IMAP object
+    #**********************************************************************
+    def _login_server(self):
+        # connect imap server
+        try:
+            if self.ssl:
+                imap = _IMAP4_SSL(self.address, self.port)
+            else:
+                imap = _IMAP4(self.address, self.port)
         except Exception as e:
             logger.error(e)
-            pop3.close()
+            return False, None
+
+        # if the log level is DEBUG
+        import logging
+        if config.LOG_LEVEL <= logging.DEBUG:
+            imap.debug = 4
+
+        # login in imap server and select mailbox
+        try:
+            imap.login(self.user, self.passwd)
+            typ, _ = imap.select(self.mailbox, readonly=True)
+            if typ != "OK":
+                raise imaplib.IMAP4.error("select %s failed" % self.mailbox)
+        except Exception as e:
+            logger.error(e)
+            imap.shutdown()
+            return False, None
+
+        return True, imap
+    # end _login_server()
+
+    #**********************************************************************
+    # @Function: check_status(self)
+    # @Description: check IMAP server and user/pass status
+    # @Parameter: None
+    # @Return: status, return True when IMAP server is ok and user/pass is authed
+    #**********************************************************************
+    def check_status(self):
+        status, imap = self._login_server()
+        if status:
+            self.status = True
+            imap.logout()
+        return status
+    # end check_status()
+
+    #**********************************************************************
+    # @Function: connect(self)
+    # @Description: connect the long-lived IMAP session if it is not connected
+    # @Parameter: None
+    # @Return: status, return True when the session is ready
+    #**********************************************************************
+    def connect(self):
+        if self.conn != None:
+            return True
+
+        status, imap = self._login_server()
+        if status == False:
+            return False
+
+        self.conn = imap
+        self.idle = "IDLE" in imap.capabilities
+        self.condstore = "CONDSTORE" in imap.capabilities
+        # the status of the new selected mailbox, the emails may arrive while
+        # it's disconnected, so it needs sync
+        self.uidvalidity = 0
+        self.uidnext     = 0
+        self.modseq      = 0
+        self._untagged(imap.untagged_responses)
+        imap.untagged_responses.clear()
+        self.changed = True
+        logger.debug("imap session ready, idle=%s condstore=%s uidnext=%d" % (
+            self.idle, self.condstore, self.uidnext))
+        return True
+    # end connect()
+
+    #**********************************************************************
+    # @Function: _untagged(self, responses)
+    # @Description: update the mailbox status by the untagged responses of
+    #   SELECT/NOOP/IDLE (rfc3501 forbids checking new emails of the selected
+    #   mailbox by STATUS). "EXISTS"/"RECENT" means new emails may arrive, then
+    #   the UIDNEXT and HIGHESTMODSEQ are unknown until the server sends the
+    #   response codes like "* OK [UIDNEXT n]" again
+    # @Parameter: responses, the dict like imaplib "untagged_responses", the
+    #   {b"EXISTS": [b"21"], b"UIDNEXT": [b"22"]}, the keys are str
+    # @Return: None
+    #**********************************************************************
+    def _untagged(self, responses):
+        if "EXISTS" in responses or "RECENT" in responses:
+            self.changed = True
+            self.uidnext = 0
+            self.modseq  = 0
+        for name, attr in (("UIDVALIDITY", "uidvalidity"), ("UIDNEXT", "uidnext"),
+                           ("HIGHESTMODSEQ", "modseq")):
+            value = responses.get(name, [b""])[-1]
+            if isinstance(value, bytes) and value.isdigit():
+                setattr(self, attr, int(value))
+        # end for
+    # end _untagged()
+
+    #**********************************************************************
+    # @Function: _broken(self, e)
+    # @Description: the command fails, close the connection, it will be
+    #   reconnected by "connect()"
+    # @Parameter: e, the exception
+    # @Return: None
+    #**********************************************************************
+    def _broken(self, e):
+        logger.error(e)
+        try:
+            self.conn.shutdown()
+        except Exception:
+            pass
+        self.conn = None
+    # end _broken()
+
+    #**********************************************************************
+    # @Function: close(self)
+    # @Description: logout the long-lived IMAP session
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def close(self):
+        if self.conn == None:
+            return
+        try:
+            self.conn.logout()
+        except Exception as e:
+            logger.error(e)
+        self.conn = None
+    # end close()
+
+    #**********************************************************************
+    # @Function: last_uid(self)
+    # @Description: get the uid of the newest email in the mailbox, prefer
+    #   the UIDNEXT returned by SELECT, otherwise search all uid
+    # @Parameter: None
+    # @Return: uid, the newest email uid (0 when mailbox is empty), while
+    #   error will return None
+    #**********************************************************************
+    def last_uid(self):
+        if self.conn == None:
             return None
+        if self.uidnext > 0:
+            return self.uidnext - 1
 
-        # check resp
-        if resp.decode("utf-8").startswith("-ERR"):
-            logger.warning("pop3 response ERR: %s" % resp)
+        try:
+            typ, data = self.conn.uid("SEARCH", "ALL")
+        except Exception as e:
+            self._broken(e)
             return None
-        # join each line of email message content and decode the data with
-        # utf-8 charset encoding.  
-        content = b'\r\n'.join(lines).decode("utf-8", "ignore")
-        return mime.Email(source=content)
+        if typ != "OK":
+            return None
+
+        uids = [int(u) for u in data[0].split()]
+        return max(uids) if len(uids) > 0 else 0
+    # end last_uid()
+
+    #**********************************************************************
+    # @Function: sync_status(self)
+    # @Description: get the mailbox sync status, include UIDVALIDITY, UIDNEXT
+    #   and HIGHESTMODSEQ(when server supports CONDSTORE) which are reported by
+    #   SELECT and the following untagged responses, no command is sent.
+    #   "CHANGED" is True after SELECT or the server reports new emails, it's
+    #   cleared by the caller after the mailbox is synced
+    # @Parameter: None
+    # @Return: result, the dict like {"UIDVALIDITY": 1, "UIDNEXT": 5,
+    #   "HIGHESTMODSEQ": 9, "CHANGED": True}, the unknown item is 0, while it's
+    #   not connected will return None
+    #**********************************************************************
+    def sync_status(self):
+        if self.conn == None:
+            return None
+        return {"UIDVALIDITY": self.uidvalidity, "UIDNEXT": self.uidnext,
+                "HIGHESTMODSEQ": self.modseq, "CHANGED": self.changed}
+    # end sync_status()
+
+    #**********************************************************************
+    # @Function: search(self, last)
+    # @Description: search the emails which uid is greater than last uid
+    # @Parameter: last, the last processed email uid
+    # @Return: uids, the new email uid list in ascending order, while error
+    #   will return None
+    #**********************************************************************
+    def search(self, last):
+        if self.conn == None:
+            return None
+
+        try:
+            typ, data = self.conn.uid("SEARCH", "UID", "%d:*" % (last+1))
+        except Exception as e:
+            self._broken(e)
+            return None
+        if typ != "OK":
+            return None
+
+        # "n:*" always contains the largest uid even if it is less than n
+        uids = [int(u) for u in data[0].split()]
+        return sorted(u for u in uids if u > last)
+    # end search()
+
+    #**********************************************************************
+    # @Function: recv(self, uid)
+    # @Description: get the email content of the specified uid, the original
+    #   content of the received email is parsed through MIME. using BODY.PEEK
+    #   so that the email will not be marked as read.
+    # @Parameter: uid, the email uid
+    # @Return: email, our internal warpper Email object
+    #**********************************************************************
+    def recv(self, uid):
+        if self.conn == None:
+            return None
+
+        try:
+            typ, data = self.conn.uid("FETCH", str(uid), "(BODY.PEEK[])")
+        except Exception as e:
+            self._broken(e)
+            return None
+        if typ != "OK":
+            logger.warning("imap response %s: %s" % (typ, data))
+            return None
+
+        # the response like: [(b'1 (UID 5 BODY[] {128}', b'...'), b')']
+        for item in data:
+            if isinstance(item, tuple):
+                metrics.RECV_EMAILS.inc(1, "imap")
+                metrics.RECV_BYTES.inc(len(item[1]), "imap")
+                return mime.Email(source=item[1])
+        # end for
+        return None
     # end recv()
+
+    #**********************************************************************
+    # @Function: wait(self, timeout)
+    # @Description: wait for the new email notification. use IDLE if server
+    #   supports, the server will push "EXISTS" when new email arrives; and
+    #   fallback to sleep and NOOP polling. it returns at once if the new
+    #   emails have been reported by the responses of the last commands
+    # @Parameter: timeout, the max waiting seconds
+    # @Return: status, return False when the connection is broken
+    #**********************************************************************
+    def wait(self, timeout):
+        if self.conn == None:
+            return False
+
+        try:
+            # the untagged responses grow over long-lived connection, drop
+            # them after the status is updated
+            self._untagged(self.conn.untagged_responses)
+            self.conn.untagged_responses.clear()
+            if self.changed:
+                return True
+            if self.idle:
+                self._idle(timeout)
+            else:
+                time.sleep(timeout)
+                self.conn.noop()
+            self._untagged(self.conn.untagged_responses)
+            self.conn.untagged_responses.clear()
+        except Exception as e:
+            self._broken(e)
+            return False
+        return True
+    # end wait()
+
+    #**********************************************************************
+    # @Function: _idle(self, timeout)
+    # @Description: execute the IDLE command, return when the server pushes
+    #   "EXISTS"/"RECENT" or timeout, the imaplib doesn't support IDLE, so we
+    #   talk with server directly, reference from rfc2177. the pushed
+    #   responses update the mailbox status
+    # @Parameter: timeout, the max waiting seconds
+    # @Return: notified, return True when new email arrives
+    #**********************************************************************
+    def _idle(self, timeout):
+        conn = self.conn
+        # the tag of our own, it's not tracked by imaplib
+        self._idle_tag += 1
+        tag = b"IDLE%04d" % self._idle_tag
+
+        conn.send(tag + b" IDLE\r\n")
+        line = conn.readline()
+        if not line.startswith(b"+"):
+            raise imaplib.IMAP4.error("IDLE failed: %s" % line)
+
+        # wait for the server push
+        deadline = time.time() + timeout
+        while not self.changed:
+            remain = deadline - time.time()
+            if remain <= 0 or not conn.readable(remain):
+                break
+            self._untagged(untagged_responses([conn.readline()]))
+        # end while
+
+        # terminate IDLE, and wait the tagged response
+        conn.send(b"DONE\r\n")
+        lines = []
+        while True:
+            line = conn.readline()
+            if line.startswith(tag):
+                break
+            lines.append(line)
+        # end while
+        self._untagged(untagged_responses(lines))
+        if not line.startswith(tag + b" OK"):
+            raise imaplib.IMAP4.error("IDLE failed: %s" % line)
+        return self.changed
+    # end _idle()
 # end class
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: ratelimit.py
+Description: the adaptive send rate limit of account and recipient domains
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import threading
+import time
+
+#**********************************************************************
+# @Class: TokenBucket
+# @Description: the token bucket of send rate, the tokens are refilled by rate
+#   per second up to burst, and an email takes one token. the rate adapts to
+#   the smtp replies: it's halved when the server throttles, and increased
+#   linearly back to the max rate by the successful sending (AIMD)
+#**********************************************************************
+class TokenBucket:
+    # the min rate is the max rate divided by it
+    FLOOR = 64
+    # the rate is increased by the max rate divided by it for each success
+    RAMP  = 20
+    # the throttled replies within seconds decrease the rate only once, the
+    # emails of a batch are rejected together
+    COOLDOWN = 1
+
+    #**********************************************************************
+    # @Function: __init__(self, rate, burst)
+    # @Description: TokenBucket object initialize, the bucket is full
+    # @Parameter: rate, the max emails per second
+    # @Parameter: burst, the max tokens
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate     = rate
+        self.burst    = max(1, burst)
+        self.tokens   = self.burst
+        self._stamp   = time.monotonic()
+        self._decreased = 0
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _refill(self, now)
+    # @Description: add the tokens generated since the last refill
+    # @Parameter: now, the monotonic time
+    # @Return: None
+    #**********************************************************************
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+    # end _refill()
+
+    #**********************************************************************
+    # @Function: wait(self, now)
+    # @Description: get the seconds until a token is available
+    # @Parameter: now, the monotonic time
+    # @Return: seconds, 0 if it can be taken now
+    #**********************************************************************
+    def wait(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+    # end wait()
+
+    #**********************************************************************
+    # @Function: take(self)
+    # @Description: take a token, the tokens may be negative when the bucket
+    #   is shared by concurrent senders, it's paid back by the waiting
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def take(self):
+        self.tokens -= 1
+    # end take()
+
+    #**********************************************************************
+    # @Function: decrease(self, now)
+    # @Description: halve the rate and drop the burst, when the server
+    #   throttles the sending
+    # @Parameter: now, the monotonic time
+    # @Return: None
+    #**********************************************************************
+    def decrease(self, now):
+        if now - self._decreased < self.COOLDOWN:
+            return
+        self._decreased = now
+        self._refill(now)
+        self.rate   = max(self.max_rate / self.FLOOR, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+    # end decrease()
+
+    #**********************************************************************
+    # @Function: increase(self, now)
+    # @Description: ramp up the rate, when the email is sent
+    # @Parameter: now, the monotonic time
+    # @Return: None
+    #**********************************************************************
+    def increase(self, now):
+        if self.rate >= self.max_rate:
+            return
+        self._refill(now)
+        self.rate = min(self.max_rate, self.rate + self.max_rate / self.RAMP)
+    # end increase()
+
+    #**********************************************************************
+    # @Function: idle(self, now)
+    # @Description: check the bucket is full at the max rate, it's the same
+    #   as a new one, so it can be dropped
+    # @Parameter: now, the monotonic time
+    # @Return: status
+    #**********************************************************************
+    def idle(self, now):
+        self._refill(now)
+        return self.rate >= self.max_rate and self.tokens >= self.burst
+    # end idle()
+# end class
+
+#**********************************************************************
+# @Class: RateLimit
+# @Description: limit the send rate of the account and each recipient domain,
+#   the email is sent when all its buckets have a token. the buckets are
+#   slowed down by the throttling replies (421 service not available, 451
+#   local error, 452 insufficient storage, which are used by the providers to
+#   reject the sending too fast), and speed up by the successful sending
+#**********************************************************************
+class RateLimit:
+    # the smtp reply codes of throttling
+    THROTTLE = (421, 451, 452)
+    # the idle domain buckets are dropped when there are more than it
+    DOMAINS = 4096
+
+    #**********************************************************************
+    # @Function: __init__(self, rate, domain_rate, burst)
+    # @Description: RateLimit object initialize
+    # @Parameter: rate, the max emails per second of account, 0 is unlimited
+    # @Parameter: domain_rate, the max emails per second of each recipient
+    #   domain, 0 is unlimited
+    # @Parameter: burst, the max emails sent at once after idle
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, rate, domain_rate, burst):
+        self.domain_rate = domain_rate
+        self.burst       = burst
+        self._account = TokenBucket(rate, burst) if rate > 0 else None
+        self._domains = {}
+        self._mutex   = threading.Lock()
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _buckets(self, task)
+    # @Description: get the buckets of task, the domain bucket is created at
+    #   the first time. it should be called with the lock
+    # @Parameter: task, the SendTask object
+    # @Return: list
+    #**********************************************************************
+    def _buckets(self, task):
+        buckets = [] if self._account == None else [self._account]
+        if self.domain_rate <= 0:
+            return buckets
+        for d in task.domains:
+            bucket = self._domains.get(d)
+            if bucket == None:
+                bucket = self._domains[d] = TokenBucket(self.domain_rate, self.burst)
+            buckets.append(bucket)
+        # end for
+        return buckets
+    # end _buckets()
+
+    #**********************************************************************
+    # @Function: check(self, task)
+    # @Description: get the seconds until the task can be sent
+    # @Parameter: task, the SendTask object
+    # @Return: seconds, 0 if it can be sent now
+    #**********************************************************************
+    def check(self, task):
+        now = time.monotonic()
+        with self._mutex:
+            return max((b.wait(now) for b in self._buckets(task)), default=0)
+    # end check()
+
+    #**********************************************************************
+    # @Function: take(self, task)
+    # @Description: take the tokens of task, it should be checked before
+    # @Parameter: task, the SendTask object
+    # @Return: None
+    #**********************************************************************
+    def take(self, task):
+        with self._mutex:
+            for b in self._buckets(task):
+                b.take()
+            # end for
+    # end take()
+
+    #**********************************************************************
+    # @Function: feedback(self, task, code)
+    # @Description: adapt the rate of task buckets by the smtp reply code
+    # @Parameter: task, the SendTask object
+    # @Parameter: code, the smtp reply code of sending task
+    # @Return: None
+    #**********************************************************************
+    def feedback(self, task, code):
+        if code == 250:
+            adapt = TokenBucket.increase
+        elif code in self.THROTTLE:
+            adapt = TokenBucket.decrease
+        else:
+            return
+        now = time.monotonic()
+        with self._mutex:
+            for b in self._buckets(task):
+                adapt(b, now)
+            # end for
+            if len(self._domains) > self.DOMAINS:
+                self._prune(now)
+        # end with
+    # end feedback()
+
+    #**********************************************************************
+    # @Function: _prune(self, now)
+    # @Description: drop the idle domain buckets. it should be called with
+    #   the lock
+    # @Parameter: now, the monotonic time
+    # @Return: None
+    #**********************************************************************
+    def _prune(self, now):
+        for d in [d for d, b in self._domains.items() if b.idle(now)]:
+            del self._domains[d]
+        # end for
+    # end _prune()
+# end class
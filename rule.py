@@ -10,7 +10,10 @@ Time: 2021.06.23
 
 import re
 import threading
+import time
 
+import metrics
+import profiler
 from utils import logger
 
 #**********************************************************************
@@ -37,43 +40,137 @@ class Rule:
         self.func    = func
 
         self.callback = callback
+        # the rule name in metrics, it's the callback function name
+        self.name = getattr(callback, "__name__", str(callback))
+        self._seconds = metrics.RULE_SECONDS.labels(self.name)
+
+        # compile the regexp rules once, the empty rule means all match and
+        # it's skipped when matching; the invalid rule never matches
+        self.valid = True
+        self._sender  = self._compile(sender)
+        self._subject = self._compile(subject)
+        self._content = self._compile(content)
     # end __init__()
 
     #**********************************************************************
-    # @Function: execute(self, emailbot, email):
-    # @Description: match all rules, call the callback function after the match
-    #   is successful; (multiple conditions are AND)
-    # @Parameter: emailbot, the emailbot object
+    # @Function: _compile(self, pattern):
+    # @Description: compile the regexp rule
+    # @Parameter: pattern, the regexp rule string
+    # @Return: regexp, the compiled pattern object, or None if it's empty
+    #**********************************************************************
+    def _compile(self, pattern):
+        if pattern == "" or pattern == None:
+            return None
+        try:
+            return re.compile(pattern, re.M|re.I)
+        except Exception as e:
+            logger.error("invalid rule '%s' (%s)" % (pattern, e))
+            self.valid = False
+            return None
+    # end _compile()
+
+    #**********************************************************************
+    # @Function: match(self, email):
+    # @Description: match all rules (multiple conditions are AND), the rules
+    #   are evaluated cheapest first: sender, subject, content and custom
+    #   function, and stop as soon as one of them fails
     # @Parameter: email, the email object
-    # @Return: match, rule matched or not
+    # @Return: (match, regx), rule matched or not, and the matched fields
     #**********************************************************************
-    def execute(self, emailbot, email):
+    def match(self, email):
+        start = time.perf_counter()
+        try:
+            return self._match(email)
+        finally:
+            cost = time.perf_counter() - start
+            self._seconds.observe(cost)
+            if profiler.PROFILER != None:
+                profiler.PROFILER.rule(self, email, cost)
+    # end match()
+
+    #**********************************************************************
+    # @Function: _match(self, email):
+    # @Description: the implementation of "match()"
+    # @Parameter: email, the email object
+    # @Return: (match, regx), rule matched or not, and the matched fields
+    #**********************************************************************
+    def _match(self, email):
+        if not self.valid:
+            return False, {}
+
+        fields = {}
         try:
-            match_sender  = re.search(self.sender, email.sender, re.M|re.I)
-            match_subject = re.search(self.subject, email.subject, re.M|re.I)
-            match_content = re.search(self.content, email.content, re.M|re.I)
+            for key, regexp in (("sender", self._sender), ("subject", self._subject),
+                                ("content", self._content)):
+                if regexp == None:
+                    fields[key] = ""
+                    continue
+                m = regexp.search(getattr(email, key))
+                if not m:
+                    return False, {}
+                fields[key] = m.group()
+            # end for
+
             if self.func != None:
                 match_func, regx = self.func(email)
+                if not match_func:
+                    return False, {}
             else:
-                match_func, regx = True, {}
+                regx = {}
+        except Exception as e:
+            logger.error(e)
+            return False, {}
+
+        # matched and set regx dict
+        regx.update(fields)
+        return True, regx
+    # end _match()
+
+    #**********************************************************************
+    # @Function: match_headers(self, email):
+    # @Description: match the header rules (sender and subject) only, the email
+    #   which fails it never matches the rule, it's used before the email body
+    #   is received
+    # @Parameter: email, the email object with headers
+    # @Return: match, header rules matched or not
+    #**********************************************************************
+    def match_headers(self, email):
+        if not self.valid:
+            return False
+        try:
+            if self._sender != None and not self._sender.search(email.sender):
+                return False
+            if self._subject != None and not self._subject.search(email.subject):
+                return False
         except Exception as e:
             logger.error(e)
             return False
+        return True
+    # end match_headers()
 
-        # check each result (AND)
-        if not (match_sender and match_subject and match_content and match_func):
+    #**********************************************************************
+    # @Function: execute(self, emailbot, email):
+    # @Description: match all rules, call the callback function after the match
+    #   is successful; (multiple conditions are AND)
+    # @Parameter: emailbot, the emailbot object
+    # @Parameter: email, the email object
+    # @Return: match, rule matched or not
+    #**********************************************************************
+    def execute(self, emailbot, email):
+        match, regx = self.match(email)
+        if not match:
             return False
-        # matched and set regx dict
-        regx["sender"] = match_sender.group()
-        regx["subject"] = match_subject.group()
-        regx["content"] = match_content.group()
 
-        # execute callback
+        # execute callback by the emailbot bounded executor, or detach thread
         logger.info("MATCH %s" % self)
-        te = threading.Thread(target=self.callback, args=(emailbot, email, regx))
-        te.start()
+        executor = getattr(emailbot, "executor", None)
+        if executor != None:
+            executor.submit(self.callback, emailbot, email, regx)
+        else:
+            te = threading.Thread(target=self.callback, args=(emailbot, email, regx))
+            te.start()
         return True
-    # end check()
+    # end execute()
 
     #**********************************************************************
     # @Function: __repr__(self)
@@ -99,3 +196,205 @@ class Rule:
         return self.__repr__()
     # end __str__()
 # end class
+
+#**********************************************************************
+# @Function: _literal_runs(pattern)
+# @Description: parse the simple regexp rule into the literal strings which
+#   must appear in the matched text; the rule with alternation, group, set or
+#   repeat range is not simple. the literals are lowercase ascii (re.I).
+# @Parameter: pattern, the regexp rule string
+# @Return: (anchored, runs), the rule starts with "^" or not, and the list of
+#   (position, literal) in order; runs is None if the rule is not simple
+#**********************************************************************
+def _literal_runs(pattern):
+    runs = []
+    anchored = pattern.startswith("^")
+    i = 1 if anchored else 0
+    cur, start = "", i
+    while i < len(pattern):
+        token, c = i, pattern[i]
+        literal = None
+        if c == "\\":
+            if i + 1 >= len(pattern):
+                return anchored, None
+            c = pattern[i+1]
+            # "\d", "\w", "\s", "\b", "\A", "\Z" are a single token, the
+            # others (backreference, "\x41", "\N{...}") are not simple
+            if c.isalnum() and c not in "dDwWsSbBAZ":
+                return anchored, None
+            if not c.isalnum():
+                literal = c
+            i += 2
+        elif c in "|()[]{}":
+            return anchored, None
+        elif c in "*?":
+            # the previous char is optional
+            cur = cur[:-1]
+            i += 1
+        elif c in "+.^$":
+            # the previous char is required but not followed by the next one
+            i += 1
+        else:
+            literal = c
+            i += 1
+        # end if
+
+        if literal != None and literal.isascii():
+            if cur == "":
+                start = token
+            cur += literal.lower()
+            continue
+        # the literal string is broken
+        if cur != "":
+            runs.append((start, cur))
+        cur = ""
+    # end while
+    if cur != "":
+        runs.append((start, cur))
+    return anchored, runs
+# end _literal_runs()
+
+# the non-ascii chars which match ascii letters with re.I
+_FOLD = str.maketrans({"İ": "i", "ı": "i", "ſ": "s", "K": "k"})
+
+#**********************************************************************
+# @Class: RuleIndex
+# @Description: the rule index for dispatching, the simple rule is bucketed by
+#   the literal sender domain (the literal address is in its domain bucket) or
+#   the anchored subject prefix, the other rules are in the fallback list. for
+#   each email, only the rules in hit buckets and the fallback list are the
+#   candidates, and they are kept in the order of addition.
+#**********************************************************************
+class RuleIndex:
+    #**********************************************************************
+    # @Function: __init__(self)
+    # @Description: RuleIndex object initialize
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def __init__(self):
+        self.rules     = []
+        self._domain   = {}
+        self._subject  = {}
+        self._fallback = []
+        # the distinct key lengths of buckets
+        self._domain_lengths  = set()
+        self._subject_lengths = set()
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _key(r)
+    # @Description: get the index key of rule
+    # @Parameter: r, the Rule object
+    # @Return: (bucket, key), the bucket is "domain"/"subject", or (None, None)
+    #   if the rule is not simple
+    #**********************************************************************
+    @staticmethod
+    def _key(r):
+        if r.sender:
+            _, runs = _literal_runs(r.sender)
+            for _, literal in runs or []:
+                _, _, domain = literal.partition("@")
+                if domain != "":
+                    return "domain", domain
+            # end for
+        # end if
+        if r.subject:
+            anchored, runs = _literal_runs(r.subject)
+            if anchored and runs and runs[0][0] == 1:
+                return "subject", runs[0][1]
+        # end if
+        return None, None
+    # end _key()
+
+    #**********************************************************************
+    # @Function: add(self, r)
+    # @Description: add the rule at the end of index
+    # @Parameter: r, the Rule object
+    # @Return: None
+    #**********************************************************************
+    def add(self, r):
+        index = len(self.rules)
+        self.rules.append(r)
+        # the invalid rule never matches
+        if not getattr(r, "valid", True):
+            return
+
+        bucket, key = self._key(r)
+        if bucket == "domain":
+            self._domain.setdefault(key, []).append(index)
+            self._domain_lengths.add(len(key))
+        elif bucket == "subject":
+            self._subject.setdefault(key, []).append(index)
+            self._subject_lengths.add(len(key))
+        else:
+            self._fallback.append(index)
+    # end add()
+
+    #**********************************************************************
+    # @Function: sync(self, rules)
+    # @Description: follow the rule list, the appended rules are added to the
+    #   index, and it's rebuilt if the list has been modified in other ways
+    # @Parameter: rules, the rule list
+    # @Return: None
+    #**********************************************************************
+    def sync(self, rules):
+        count = len(self.rules)
+        if len(rules) < count or (count > 0 and rules[count-1] is not self.rules[-1]):
+            self.__init__()
+            count = 0
+        for r in rules[count:]:
+            self.add(r)
+    # end sync()
+
+    #**********************************************************************
+    # @Function: _lookup(self, bucket, lengths, text, starts)
+    # @Description: find the rules whose key is a prefix of the text at the
+    #   start positions
+    # @Parameter: bucket, the key dict
+    # @Parameter: lengths, the distinct key lengths of bucket
+    # @Parameter: text, the folded text
+    # @Parameter: starts, the start positions list
+    # @Return: list, the rule index list
+    #**********************************************************************
+    def _lookup(self, bucket, lengths, text, starts):
+        result = []
+        for s in starts:
+            for n in lengths:
+                if s + n <= len(text):
+                    result.extend(bucket.get(text[s:s+n], ()))
+            # end for
+        # end for
+        return result
+    # end _lookup()
+
+    #**********************************************************************
+    # @Function: candidates(self, email)
+    # @Description: get the rules which may match the email
+    # @Parameter: email, the email object
+    # @Return: list, the Rule list in the order of addition
+    #**********************************************************************
+    def candidates(self, email):
+        result = list(self._fallback)
+        if self._domain and isinstance(email.sender, str):
+            sender = email.sender.translate(_FOLD).lower()
+            starts = [i+1 for i, c in enumerate(sender) if c == "@"]
+            result.extend(self._lookup(self._domain, self._domain_lengths, sender, starts))
+        if self._subject and isinstance(email.subject, str):
+            subject = email.subject.translate(_FOLD).lower()
+            # "^" matches at the beginning of each line (re.M)
+            starts = [0] + [i+1 for i, c in enumerate(subject) if c == "\n"]
+            result.extend(self._lookup(self._subject, self._subject_lengths, subject, starts))
+        return [self.rules[i] for i in sorted(set(result))]
+    # end candidates()
+
+    #**********************************************************************
+    # @Function: __len__(self)
+    # @Description: get the count of rules
+    # @Parameter: None
+    # @Return: int
+    #**********************************************************************
+    def __len__(self):
+        return len(self.rules)
+    # end __len__()
+# end class
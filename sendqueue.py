@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: sendqueue.py
+Description: the queue of emails waiting to be sent
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import collections
+import heapq
+import itertools
+import random
+import threading
+import time
+
+#**********************************************************************
+# @Function: backoff(attempts, base, limit)
+# @Description: the exponential backoff delay with jitter, the delay is
+#   doubled for each failure, and randomized in [delay/2, delay]
+# @Parameter: attempts, the failed times
+# @Parameter: base, the first delay seconds
+# @Parameter: limit, the max delay seconds
+# @Return: seconds, the delay
+#**********************************************************************
+def backoff(attempts, base, limit):
+    delay = min(limit, base * (2 ** max(attempts - 1, 0)))
+    return random.uniform(delay / 2, delay)
+# end backoff()
+
+#**********************************************************************
+# @Class: SendTask
+# @Description: the email waiting to be sent, and its retry state
+#**********************************************************************
+class SendTask:
+    #**********************************************************************
+    # @Function: __init__(self, email, key=None)
+    # @Description: SendTask object initialize
+    # @Parameter: email, the mime email object
+    # @Parameter: key=None, the spool key of email, None if it's not spooled
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, email, key=None):
+        self.email    = email
+        self.key      = key
+        # the failed times
+        self.attempts = 0
+        # the queued time, used by the send latency metric
+        self.created  = time.monotonic()
+        # the recipient domains, used by the domain concurrency limit
+        self.domains  = {addr.rpartition("@")[2].lower() for addr in email.recipients()}
+    # end __init__()
+# end class
+
+#**********************************************************************
+# @Class: DomainLimit
+# @Description: limit the concurrent sending of each recipient domain, so a
+#   slow provider can't occupy all the send workers
+#**********************************************************************
+class DomainLimit:
+    #**********************************************************************
+    # @Function: __init__(self, limit)
+    # @Description: DomainLimit object initialize
+    # @Parameter: limit, the max concurrent sending of a domain, 0 is unlimited
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, limit):
+        self.limit   = limit
+        self._active = collections.Counter()
+        self._mutex  = threading.Lock()
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: acquire(self, task, held=None)
+    # @Description: take the sending slots of all recipient domains
+    # @Parameter: task, the SendTask object
+    # @Parameter: held=None, the domain set already taken by the same batch,
+    #   the emails of a batch are sent one by one over one session, so a domain
+    #   takes one slot for the batch; the new taken domains are added into it
+    # @Return: status, return False if any domain is full, nothing is taken
+    #**********************************************************************
+    def acquire(self, task, held=None):
+        if self.limit <= 0:
+            return True
+        domains = task.domains if held == None else task.domains - held
+        with self._mutex:
+            for d in domains:
+                if self._active[d] >= self.limit:
+                    return False
+            # end for
+            self._active.update(domains)
+        if held != None:
+            held.update(domains)
+        return True
+    # end acquire()
+
+    #**********************************************************************
+    # @Function: release(self, domains)
+    # @Description: give back the sending slots of domains
+    # @Parameter: domains, the domain set taken by "acquire()"
+    # @Return: None
+    #**********************************************************************
+    def release(self, domains):
+        if self.limit <= 0:
+            return
+        with self._mutex:
+            self._active.subtract(domains)
+            for d in domains:
+                if self._active[d] <= 0:
+                    del self._active[d]
+            # end for
+    # end release()
+# end class
+
+#**********************************************************************
+# @Class: SendQueue
+# @Description: the thread-safe FIFO queue of emails to be sent, it's a deque
+#   guarded by condition variable, so both putting and getting are O(1), and
+#   the waiting send manager is woken up immediately by "put()". the failed
+#   email is rescheduled in a delay heap, it's moved back to the queue when
+#   it's due, so it doesn't block the emails behind it.
+#**********************************************************************
+class SendQueue:
+    # the max number of emails checked by "accept" for each taking
+    LOOKAHEAD = 1000
+
+    #**********************************************************************
+    # @Function: __init__(self)
+    # @Description: SendQueue object initialize
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def __init__(self):
+        self._items = collections.deque()
+        self._cond  = threading.Condition()
+        # the (due, sequence, item) heap of delayed emails
+        self._delayed = []
+        self._seq     = itertools.count()
+        # the time when the email skipped by accept can be taken
+        self._retry   = None
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: put(self, item)
+    # @Description: add the email at the end of queue, and wake up a waiting
+    #   getter
+    # @Parameter: item, the email object
+    # @Return: None
+    #**********************************************************************
+    def put(self, item):
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify()
+    # end put()
+
+    #**********************************************************************
+    # @Function: put_front(self, items)
+    # @Description: add the emails back at the head of queue in order, such as
+    #   the emails which are taken but not sent
+    # @Parameter: items, the email object list
+    # @Return: None
+    #**********************************************************************
+    def put_front(self, items):
+        with self._cond:
+            self._items.extendleft(reversed(items))
+            self._cond.notify(len(items))
+    # end put_front()
+
+    #**********************************************************************
+    # @Function: put_later(self, item, delay)
+    # @Description: add the email into the delay heap, it will be at the end
+    #   of queue after delay seconds
+    # @Parameter: item, the email object
+    # @Parameter: delay, the delay seconds
+    # @Return: None
+    #**********************************************************************
+    def put_later(self, item, delay):
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), item))
+            # the waiting getter recomputes its timeout
+            self._cond.notify_all()
+    # end put_later()
+
+    #**********************************************************************
+    # @Function: notify(self)
+    # @Description: wake up all waiting getters to check the queue again, such
+    #   as a domain concurrency slot is released
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+    # end notify()
+
+    #**********************************************************************
+    # @Function: _promote(self)
+    # @Description: move the due emails from delay heap to the end of queue,
+    #   it should be called with the lock
+    # @Parameter: None
+    # @Return: delay, the seconds until the next delayed email is due, None if
+    #   there is no delayed email
+    #**********************************************************************
+    def _promote(self):
+        now = time.monotonic()
+        while len(self._delayed) > 0 and self._delayed[0][0] <= now:
+            self._items.append(heapq.heappop(self._delayed)[2])
+        if len(self._delayed) == 0:
+            return None
+        return self._delayed[0][0] - now
+    # end _promote()
+
+    #**********************************************************************
+    # @Function: _take(self, count, accept)
+    # @Description: take at most count accepted emails from the head of queue,
+    #   the emails which are not accepted keep their positions, and at most
+    #   LOOKAHEAD emails are checked. it should be called with the lock
+    # @Parameter: count, the max email count
+    # @Parameter: accept, the function check the email can be taken, or None
+    # @Return: (list, wait), the email list, and the min seconds returned by
+    #   accept for the skipped emails (None if there is not)
+    #**********************************************************************
+    def _take(self, count, accept):
+        if accept == None:
+            count = min(count, len(self._items))
+            return [self._items.popleft() for _ in range(count)], None
+
+        result, skipped, wait = [], [], None
+        while len(self._items) > 0 and len(result) < count and len(skipped) < self.LOOKAHEAD:
+            item = self._items.popleft()
+            status = accept(item)
+            if status is True:
+                result.append(item)
+                continue
+            skipped.append(item)
+            # the email can be taken after the seconds
+            if status is not False and (wait == None or status < wait):
+                wait = status
+        # end while
+        self._items.extendleft(reversed(skipped))
+        return result, wait
+    # end _take()
+
+    #**********************************************************************
+    # @Function: get_batch(self, count, timeout=None, accept=None)
+    # @Description: take at most count emails from the head of queue, wait
+    #   until there is any email or timeout
+    # @Parameter: count, the max email count
+    # @Parameter: timeout=None, the max waiting seconds, wait forever if None,
+    #   and don't wait if 0
+    # @Parameter: accept=None, the function check the email can be taken now,
+    #   it returns True to take the email, False or the seconds after which it
+    #   can be taken to skip it; the skipped emails are kept in queue
+    # @Return: list, the email list, it's empty when timeout
+    #**********************************************************************
+    def get_batch(self, count, timeout=None, accept=None):
+        deadline = None if timeout == None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                due = self._promote()
+                result, wait = self._take(count, accept)
+                self._retry = None if wait == None else time.monotonic() + wait
+                if len(result) > 0:
+                    return result
+
+                # wait until a new email, the next delayed email due, the
+                # skipped email can be taken, or timeout
+                remain = None if deadline == None else deadline - time.monotonic()
+                if remain != None and remain <= 0:
+                    return []
+                for t in (due, wait):
+                    if t != None and (remain == None or t < remain):
+                        remain = t
+                # end for
+                self._cond.wait(remain)
+            # end while
+    # end get_batch()
+
+    #**********************************************************************
+    # @Function: get(self, timeout=None, accept=None)
+    # @Description: take an email from the head of queue, wait until there is
+    #   any email or timeout
+    # @Parameter: timeout=None, the max waiting seconds, wait forever if None,
+    #   and don't wait if 0
+    # @Parameter: accept=None, the function check the email can be taken now
+    # @Return: item, the email object, return None when timeout
+    #**********************************************************************
+    def get(self, timeout=None, accept=None):
+        items = self.get_batch(1, timeout, accept)
+        if len(items) == 0:
+            return None
+        return items[0]
+    # end get()
+
+    #**********************************************************************
+    # @Function: next_due(self)
+    # @Description: get the seconds until the next delayed email is due, or
+    #   the email skipped by the last getting can be taken
+    # @Parameter: None
+    # @Return: seconds, None if there is no such email
+    #**********************************************************************
+    def next_due(self):
+        with self._cond:
+            due = self._promote()
+            if self._retry != None:
+                retry = max(0, self._retry - time.monotonic())
+                due = retry if due == None else min(due, retry)
+            return due
+    # end next_due()
+
+    #**********************************************************************
+    # @Function: __len__(self)
+    # @Description: get the count of waiting emails, include delayed ones
+    # @Parameter: None
+    # @Return: int
+    #**********************************************************************
+    def __len__(self):
+        return len(self._items) + len(self._delayed)
+    # end __len__()
+# end class
@@ -0,0 +1,435 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: spool.py
+Description: the crash-safe on-disk spool of emails waiting to be sent
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import itertools
+import os
+import struct
+import threading
+import time
+import zlib
+
+from utils import logger
+
+#**********************************************************************
+# @Class: Spool
+# @Description: the append-only log of outbound emails, it's a directory of
+#   segment files, each record is a "put"(the email recipients line and the
+#   email source) or an "ack"(the email is sent). the email source is written
+#   by chunks, and the record header is patched after the last one, so the
+#   record torn by the process crash fails the crc check; the fsync() is
+#   batched by a flusher thread (group commit), so the enqueue is cheap:
+#     interval == 0: "put()" returns after the record is fsynced, the waiting
+#                    puts of all threads share one fsync
+#     interval > 0:  "put()" returns immediately, the spool is fsynced every
+#                    interval seconds, the emails of the last interval may
+#                    be lost by power failure
+#   the segment is removed when all the emails in it and the older segments
+#   are acknowledged. the unacknowledged emails are loaded by "replay()".
+#**********************************************************************
+class Spool:
+    # the record header: type, key, payload length, payload crc32
+    HEADER = struct.Struct("!BQII")
+    PUT = 1
+    ACK = 2
+
+    #**********************************************************************
+    # @Function: __init__(self, path, interval=0, segment_size=64*1024*1024)
+    # @Description: Spool object initialize, load the existing segments
+    # @Parameter: path, the spool directory
+    # @Parameter: interval=0, the fsync interval seconds, 0 is sync on put
+    # @Parameter: segment_size=64MB, the new segment is started when the
+    #   current one is larger than it
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, path, interval=0, segment_size=64*1024*1024):
+        self.path         = path
+        self.interval     = interval
+        self.segment_size = segment_size
+        os.makedirs(self.path, exist_ok=True)
+
+        self._cond = threading.Condition()
+        # the {key: segment number} of unacknowledged emails
+        self._where = {}
+        # the {segment number: unacknowledged count} of all segments
+        self._live  = {}
+        # the unacknowledged (key, payload) list loaded from disk
+        self._replay = []
+        self._next_key = 1
+        self._load()
+
+        # the segment being written
+        self._segment = max(self._live, default=0) + 1
+        self._live[self._segment] = 0
+        self._fd   = self._open(self._segment)
+        self._size = 0
+        # the count of records written and fsynced
+        self._written = 0
+        self._synced  = 0
+        self._flusher = None
+        self._remove()
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _name(self, segment)
+    # @Description: get the file path of segment
+    # @Parameter: segment, the segment number
+    # @Return: str
+    #**********************************************************************
+    def _name(self, segment):
+        return os.path.join(self.path, "%020d.seg" % segment)
+    # end _name()
+
+    #**********************************************************************
+    # @Function: _open(self, segment)
+    # @Description: create the segment file, and persist the directory entry,
+    #   it's not opened by O_APPEND, the record header is patched in place
+    # @Parameter: segment, the segment number
+    # @Return: fd, the file descriptor
+    #**********************************************************************
+    def _open(self, segment):
+        fd = os.open(self._name(segment), os.O_WRONLY|os.O_CREAT, 0o600)
+        self._sync_dir()
+        return fd
+    # end _open()
+
+    #**********************************************************************
+    # @Function: _sync_dir(self)
+    # @Description: fsync the spool directory, so the created or removed
+    #   segment file is persisted
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _sync_dir(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            # the directory can't be opened on some platforms (windows)
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    # end _sync_dir()
+
+    #**********************************************************************
+    # @Function: _read(self, segment)
+    # @Description: read the records of segment file, it stops at the torn
+    #   or corrupted record, which is the tail written by the crash
+    # @Parameter: segment, the segment number
+    # @Return: generator, the (type, key, payload) records
+    #**********************************************************************
+    def _read(self, segment):
+        with open(self._name(segment), "rb") as f:
+            while True:
+                header = f.read(self.HEADER.size)
+                if len(header) == 0:
+                    return
+                if len(header) < self.HEADER.size:
+                    break
+                kind, key, length, crc = self.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                yield kind, key, payload
+            # end while
+        # end with
+        logger.warning("spool segment %d is truncated, the tail is ignored" % segment)
+    # end _read()
+
+    #**********************************************************************
+    # @Function: _load(self)
+    # @Description: load the existing segments, collect the unacknowledged
+    #   emails and count them by segment
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _load(self):
+        segments = sorted(int(f[:-4]) for f in os.listdir(self.path)
+                          if f.endswith(".seg") and f[:-4].isdigit())
+        sources = {}
+        for segment in segments:
+            self._live[segment] = 0
+            for kind, key, payload in self._read(segment):
+                if kind == self.PUT:
+                    sources[key] = payload
+                    self._where[key] = segment
+                    self._live[segment] += 1
+                elif kind == self.ACK and key in self._where:
+                    del sources[key]
+                    self._live[self._where.pop(key)] -= 1
+                self._next_key = max(self._next_key, key + 1)
+            # end for
+        # end for
+
+        self._replay = sorted(sources.items())
+    # end _load()
+
+    #**********************************************************************
+    # @Function: _remove(self)
+    # @Description: remove the oldest segments which are all acknowledged, the
+    #   ack record of an email is never older than its put record, so the
+    #   segments are removed in order. it should be called with the lock
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _remove(self):
+        removed = False
+        for segment in sorted(self._live):
+            if self._live[segment] > 0 or segment == self._segment:
+                break
+            try:
+                os.remove(self._name(segment))
+            except OSError as e:
+                logger.error(e)
+                break
+            del self._live[segment]
+            removed = True
+        # end for
+        if removed:
+            self._sync_dir()
+    # end _remove()
+
+    #**********************************************************************
+    # @Function: replay(self)
+    # @Description: get the unacknowledged emails which are spooled before
+    #   restart, they should be sent again and acknowledged
+    # @Parameter: None
+    # @Return: list, the (key, recipients, email source bytes) list in put
+    #   order, the recipients is the comma separated address string
+    #**********************************************************************
+    def replay(self):
+        result = []
+        for key, payload in self._replay:
+            recipients, _, source = payload.partition(b"\r\n")
+            result.append((key, recipients.decode("utf-8"), source))
+        # end for
+        self._replay = []
+        return result
+    # end replay()
+
+    #**********************************************************************
+    # @Function: _write(self, data)
+    # @Description: write the data at the end of current segment. it should
+    #   be called with the lock
+    # @Parameter: data, the bytes
+    # @Return: None
+    #**********************************************************************
+    def _write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(self._fd, view):]
+        self._size += len(data)
+    # end _write()
+
+    #**********************************************************************
+    # @Function: _append(self, kind, key, payload)
+    # @Description: write a record into the current segment by one write()
+    #   call, and start a new segment if it's full. it should be called with
+    #   the lock
+    # @Parameter: kind, the record type, PUT or ACK
+    # @Parameter: key, the email key
+    # @Parameter: payload, the record payload bytes
+    # @Return: None
+    #**********************************************************************
+    def _append(self, kind, key, payload):
+        self._write(self.HEADER.pack(kind, key, len(payload), zlib.crc32(payload)) + payload)
+        self._written += 1
+        self._rotate()
+    # end _append()
+
+    #**********************************************************************
+    # @Function: _append_chunks(self, kind, key, chunks)
+    # @Description: write a record into the current segment by chunks, the
+    #   length and crc32 are counted while writing, and patched into the
+    #   header at last. the partial record is truncated when the chunks raise.
+    #   it should be called with the lock
+    # @Parameter: kind, the record type, PUT or ACK
+    # @Parameter: key, the email key
+    # @Parameter: chunks, the iterable of payload bytes
+    # @Return: None
+    #**********************************************************************
+    def _append_chunks(self, kind, key, chunks):
+        offset = self._size
+        # the crc32 of empty payload is 0, so the unpatched header is torn
+        self._write(self.HEADER.pack(kind, key, 0, 1))
+        length, crc = 0, 0
+        try:
+            for chunk in chunks:
+                self._write(chunk)
+                length += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+            # end for
+        except Exception:
+            # the records behind the partial one would be unreadable
+            os.ftruncate(self._fd, offset)
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            self._size = offset
+            raise
+
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        os.write(self._fd, self.HEADER.pack(kind, key, length, crc))
+        os.lseek(self._fd, self._size, os.SEEK_SET)
+        self._written += 1
+        self._rotate()
+    # end _append_chunks()
+
+    #**********************************************************************
+    # @Function: _rotate(self)
+    # @Description: start a new segment if the current one is full. it should
+    #   be called with the lock
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _rotate(self):
+        if self._size < self.segment_size:
+            return
+
+        # the records of old segment are persisted before switching
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._synced = self._written
+        self._cond.notify_all()
+        self._segment += 1
+        self._live[self._segment] = 0
+        self._fd   = self._open(self._segment)
+        self._size = 0
+        self._remove()
+    # end _rotate()
+
+    #**********************************************************************
+    # @Function: put(self, email)
+    # @Description: spool the email, it waits until the record is fsynced if
+    #   the interval is 0. the email source is streamed into the segment, it's
+    #   not built in memory
+    # @Parameter: email, the mime email object
+    # @Return: key, the email key, which is acknowledged by "ack()"
+    #**********************************************************************
+    def put(self, email):
+        # the recipients are kept, the blind carbon copy is not in the source
+        recipients = (", ".join(email.recipients()) + "\r\n").encode("utf-8")
+        with self._cond:
+            key = self._next_key
+            self._next_key += 1
+            # count it before writing, the segment may be switched by writing
+            segment = self._segment
+            self._where[key] = segment
+            self._live[segment] += 1
+            try:
+                self._append_chunks(self.PUT, key, itertools.chain([recipients], email.stream()))
+            except Exception:
+                del self._where[key]
+                self._live[segment] -= 1
+                raise
+            seq = self._written
+            self._start()
+            self._cond.notify_all()
+            # wait for the group commit
+            if self.interval == 0:
+                while self._synced < seq:
+                    self._cond.wait()
+        # end with
+        return key
+    # end put()
+
+    #**********************************************************************
+    # @Function: ack(self, key)
+    # @Description: acknowledge the email is sent, it won't be replayed. the
+    #   ack record is not waiting for fsync, the email may be sent again after
+    #   power failure
+    # @Parameter: key, the email key returned by "put()"
+    # @Return: None
+    #**********************************************************************
+    def ack(self, key):
+        with self._cond:
+            segment = self._where.pop(key, None)
+            if segment == None:
+                return
+            self._append(self.ACK, key, b"")
+            self._live[segment] -= 1
+            if self._live[segment] == 0:
+                self._remove()
+            self._cond.notify_all()
+        # end with
+    # end ack()
+
+    #**********************************************************************
+    # @Function: _start(self)
+    # @Description: start the flusher thread if it is not running, it should
+    #   be called with the lock
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _start(self):
+        if self._flusher != None:
+            return
+        self._flusher = threading.Thread(target=self._flush, daemon=True)
+        self._flusher.start()
+    # end _start()
+
+    #**********************************************************************
+    # @Function: _flush(self)
+    # @Description: the flusher thread, fsync the written records by batch,
+    #   and wake up the waiting puts
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _flush(self):
+        while True:
+            with self._cond:
+                while self._synced >= self._written:
+                    self._cond.wait()
+            # end with
+            if self.interval > 0:
+                time.sleep(self.interval)
+
+            with self._cond:
+                seq, fd = self._written, self._fd
+            # the puts during fsync are batched into the next one
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                # the segment is switched and closed, it has been fsynced
+                if fd == self._fd:
+                    logger.error(e)
+            with self._cond:
+                self._synced = max(self._synced, seq)
+                self._cond.notify_all()
+            # end with
+        # end while
+    # end _flush()
+
+    #**********************************************************************
+    # @Function: flush(self)
+    # @Description: wait until all the written records are fsynced
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def flush(self):
+        with self._cond:
+            seq = self._written
+            self._start()
+            self._cond.notify_all()
+            while self._synced < seq:
+                self._cond.wait()
+        # end with
+    # end flush()
+
+    #**********************************************************************
+    # @Function: __len__(self)
+    # @Description: get the count of unacknowledged emails
+    # @Parameter: None
+    # @Return: int
+    #**********************************************************************
+    def __len__(self):
+        return len(self._where)
+    # end __len__()
+# end class
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: store.py
+Description: the persistent store of received email hash and IMAP sync
+    state, remember which emails have been processed across restarts
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import json
+import os
+
+from utils import logger
+
+#**********************************************************************
+# @Class: UIDStore
+# @Description: the seen uid(the uidl() hash) set which persisted as an append
+#   log file, one hash per line. the log is loaded into memory set at startup,
+#   so the membership check is O(1); the new hash is appended and synced to
+#   disk once per polling, and the log is compacted when it contains too many
+#   stale lines. the log is written only after it's seeded by the whole
+#   mailbox, its first line is the SEEDED marker; the store without marker
+#   (missing, or the process stopped before seeding) has no history.
+#   the object is not thread-safe, it should be used by the receive manager.
+#**********************************************************************
+class UIDStore:
+    # the first line of the seeded log file
+    SEEDED = b"#seeded"
+
+    #**********************************************************************
+    # @Function: __init__(self, path)
+    # @Description: UIDStore object initialize, load the log file if exists
+    # @Parameter: path, the append log file path
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, path):
+        self.path = path
+        # the store is not seeded, there is no history, it's cleared by the
+        # first "update()"
+        self.created = True
+
+        self._seen  = set()
+        self._fp    = None
+        self._dirty = False
+        self._load()
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: _load(self)
+    # @Description: load all hash from the seeded log file, the incomplete
+    #   last line (crash while appending) is dropped by compaction
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+        lines = data.split(b"\n")
+        if lines[0] != self.SEEDED:
+            logger.warning("uid store %s is not seeded, initialize it" % self.path)
+            return
+        self.created = False
+        # the last item is empty when the file ends with newline
+        broken = lines.pop() != b""
+        self._seen = set(lines[1:])
+        self._seen.discard(b"")
+        logger.info("load %d uid from %s" % (len(self._seen), self.path))
+
+        if broken:
+            logger.warning("uid store %s is incomplete, compact it" % self.path)
+            self._compact()
+        else:
+            self._fp = open(self.path, "ab")
+    # end _load()
+
+    #**********************************************************************
+    # @Function: _compact(self)
+    # @Description: rewrite the log file with the marker and the current hash
+    #   set, the new file is written and synced aside, and atomically replace
+    #   the old one
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def _compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.SEEDED + b"\n")
+            f.write(b"".join(h + b"\n" for h in self._seen))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+        # reopen the append log
+        if self._fp != None:
+            self._fp.close()
+        self._fp = open(self.path, "ab")
+        self._dirty = False
+    # end _compact()
+
+    #**********************************************************************
+    # @Function: update(self, hashes)
+    # @Description: add multiple hash and sync them to disk once, the store is
+    #   seeded by the first update: the log file is created with the marker
+    # @Parameter: hashes, the iterable of hash bytes
+    # @Return: None
+    #**********************************************************************
+    def update(self, hashes):
+        if self.created:
+            self._seen.update(hashes)
+            self._compact()
+            self.created = False
+            return
+
+        news = [h for h in hashes if h not in self._seen]
+        if len(news) == 0:
+            return
+        self._seen.update(news)
+        self._fp.write(b"".join(h + b"\n" for h in news))
+        self._dirty = True
+        self.sync()
+    # end update()
+
+    #**********************************************************************
+    # @Function: add(self, h)
+    # @Description: add a hash, it's written but not synced to disk until
+    #   "sync()", the receive manager syncs once per polling; the hashes lost
+    #   by crash are received again (at least once)
+    # @Parameter: h, the hash bytes
+    # @Return: None
+    #**********************************************************************
+    def add(self, h):
+        if h in self._seen:
+            return
+        self._seen.add(h)
+        if self._fp != None:
+            self._fp.write(h + b"\n")
+            self._dirty = True
+    # end add()
+
+    #**********************************************************************
+    # @Function: sync(self)
+    # @Description: flush and fsync the added hash to disk
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def sync(self):
+        if not self._dirty:
+            return
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._dirty = False
+    # end sync()
+
+    #**********************************************************************
+    # @Function: retain(self, hashes)
+    # @Description: drop the hash which no longer exists in mailbox(deleted or
+    #   out of receiving time range), it only happens when the stale hash is
+    #   more than half, then the log file is compacted
+    # @Parameter: hashes, the collection of hash which exists in mailbox
+    # @Return: None
+    #**********************************************************************
+    def retain(self, hashes):
+        # the empty list may be caused by server error, keep everything
+        if len(hashes) == 0:
+            return
+
+        live = self._seen.intersection(hashes)
+        if len(self._seen) - len(live) > len(live):
+            self._seen = live
+            self._compact()
+    # end retain()
+
+    #**********************************************************************
+    # @Function: close(self)
+    # @Description: close the log file
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def close(self):
+        if self._fp != None:
+            self.sync()
+            self._fp.close()
+            self._fp = None
+    # end close()
+
+    #**********************************************************************
+    # @Function: __contains__(self, h)
+    # @Description: check the hash has been seen
+    # @Parameter: h, the hash bytes
+    # @Return: bool
+    #**********************************************************************
+    def __contains__(self, h):
+        return h in self._seen
+    # end __contains__()
+
+    #**********************************************************************
+    # @Function: __len__(self)
+    # @Description: get the count of seen hash
+    # @Parameter: None
+    # @Return: int
+    #**********************************************************************
+    def __len__(self):
+        return len(self._seen)
+    # end __len__()
+# end class
+
+#**********************************************************************
+# @Class: IMAPState
+# @Description: the IMAP incremental sync state, include the UIDVALIDITY of
+#   mailbox, the last processed uid and the HIGHESTMODSEQ(CONDSTORE), it can
+#   be persisted as a json file, so the sync continues after restart.
+#**********************************************************************
+class IMAPState:
+    #**********************************************************************
+    # @Function: __init__(self, path="")
+    # @Description: IMAPState object initialize, load the state file if exists
+    # @Parameter: path="", the state file path, keep it in memory if empty
+    # @Return: None
+    #**********************************************************************
+    def __init__(self, path=""):
+        self.path = path
+
+        # the uidvalidity 0 means the state is not initialized
+        self.uidvalidity = 0
+        self.last        = 0
+        self.modseq      = 0
+
+        if self.path == "" or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.uidvalidity = int(data["uidvalidity"])
+            self.last        = int(data["last"])
+            self.modseq      = int(data["modseq"])
+        except Exception as e:
+            logger.error("load imap state %s failed (%s)" % (self.path, e))
+            return
+        logger.info("load imap state from %s, uidvalidity=%d last=%d" % (
+            self.path, self.uidvalidity, self.last))
+    # end __init__()
+
+    #**********************************************************************
+    # @Function: save(self)
+    # @Description: write the state file and atomically replace the old one
+    # @Parameter: None
+    # @Return: None
+    #**********************************************************************
+    def save(self):
+        if self.path == "":
+            return
+
+        data = {"uidvalidity": self.uidvalidity, "last": self.last, "modseq": self.modseq}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+    # end save()
+# end class
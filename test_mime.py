@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+File: test_mime.py
+Description: the unit tests of mime.py, run by "python -m unittest"
+Author: 0x7F@knownsec404
+Time: 2026.10.18
+"""
+
+import unittest
+
+import mime
+
+#**********************************************************************
+# @Class: TemplateTest
+# @Description: the tests of "mime.Template" rendering
+#**********************************************************************
+class TemplateTest(unittest.TestCase):
+    def test_render(self):
+        t = mime.Template("bot@x.com", "hi $name", "body")
+        data = b"".join(t.render("a@x.com", {"name": "x"}).stream())
+        self.assertIn(b"To: a@x.com\r\n", data)
+        self.assertIn(b"Subject: hi x\r\n", data)
+    # end test_render()
+
+    def test_subject_injection(self):
+        t = mime.Template("bot@x.com", "hi $name", "body")
+        for value in ("x\r\nBcc: evil@x.com", "x\nBcc: evil@x.com", "x\rBcc: evil@x.com"):
+            with self.assertRaises(ValueError):
+                t.render("a@x.com", {"name": value})
+        # end for
+    # end test_subject_injection()
+
+    def test_receiver_injection(self):
+        t = mime.Template("bot@x.com", "hi", "body")
+        with self.assertRaises(ValueError):
+            t.render("a@x.com\r\nBcc: evil@x.com")
+    # end test_receiver_injection()
+# end class
+
+if __name__ == "__main__":
+    unittest.main()
+# end main()